@@ -0,0 +1,318 @@
+"""Incremental aggregates over metrics uploads received by metrics_stub.py."""
+
+import math
+import threading
+import time
+from collections import deque
+
+# name -> window length in seconds
+WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+BUCKETS_PER_WINDOW = 60
+
+# DDSketch relative accuracy used for server-side merging.
+SKETCH_ALPHA = 0.01
+_GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+_LOG_GAMMA = math.log(_GAMMA)
+DEFAULT_QUANTILES = (0.5, 0.9, 0.95, 0.99, 0.999)
+# Uploaded sketch bins are clamped to this latency range (ms), which keeps
+# bin values finite and the number of keys a window can hold bounded.
+SKETCH_MIN_MS = 0.001
+SKETCH_MAX_MS = 3_600_000
+MAX_SKETCH_BINS = 4096
+_MIN_INDEX = math.ceil(math.log(SKETCH_MIN_MS) / _LOG_GAMMA)
+_MAX_INDEX = math.ceil(math.log(SKETCH_MAX_MS) / _LOG_GAMMA)
+# Legacy uploads only carry three percentiles; spread each upload's request
+# count over them (in percent, so window arithmetic stays integral) as a
+# coarse stand-in for the missing distribution.
+LEGACY_MASS = (("p50", 50), ("p95", 45), ("p99", 5))
+
+
+def _add_into(target, key, counters, sign=1):
+    group = target.get(key)
+    if group is None:
+        group = target[key] = {}
+    for name, value in counters.items():
+        total = group.get(name, 0) + sign * value
+        if total or sign > 0:
+            group[name] = total
+        else:
+            group.pop(name, None)
+    if not group:
+        del target[key]
+
+
+def _nest(flat):
+    """``{(kind, id): counters}`` -> ``{kind: {id: counters}}`` for JSON output."""
+    nested = {}
+    for (kind, ident), counters in flat.items():
+        nested.setdefault(kind, {})[ident] = dict(counters)
+    return nested
+
+
+class _Window:
+    """One window length tracked both as a sliding total and as tumbling periods.
+
+    The sliding total is kept up to date by adding each upload to it and
+    subtracting whole buckets as they fall out of the window, so reads
+    never walk history.
+    """
+
+    def __init__(self, span):
+        self.span = span
+        self.width = span / BUCKETS_PER_WINDOW
+        self.buckets = deque()  # (bucket index, {key: counters})
+        self.sliding = {}
+        self.period = None
+        self.current = {}
+        self.previous = {}
+
+    def _advance(self, now):
+        index = int(now // self.width)
+        while self.buckets and self.buckets[0][0] <= index - BUCKETS_PER_WINDOW:
+            for key, counters in self.buckets.popleft()[1].items():
+                _add_into(self.sliding, key, counters, sign=-1)
+        period = int(now // self.span)
+        if period != self.period:
+            self.previous = self.current if self.period is not None and period == self.period + 1 else {}
+            self.current = {}
+            self.period = period
+        return index
+
+    def add(self, now, keys, counters):
+        index = self._advance(now)
+        if not self.buckets or self.buckets[-1][0] != index:
+            self.buckets.append((index, {}))
+        bucket = self.buckets[-1][1]
+        for key in keys:
+            for target in (bucket, self.sliding, self.current):
+                _add_into(target, key, counters)
+
+    def snapshot(self, now, modes):
+        self._advance(now)
+        out = {}
+        if "sliding" in modes:
+            out["sliding"] = _nest(self.sliding)
+        if "tumbling" in modes:
+            out["tumbling"] = {
+                "start": int(self.period * self.span * 1000),
+                "current": _nest(self.current),
+                "previous": _nest(self.previous),
+            }
+        return out
+
+
+class WindowAggregator:
+    """Per-app, per-SDK and fleet-wide counter totals over 1m/5m/1h windows.
+
+    Each upload costs O(counters x windows) regardless of how much history
+    has been seen; an ``uploads`` pseudo-counter tracks the upload count.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._windows = {name: _Window(span) for name, span in WINDOWS.items()}
+
+    def values(self, record):
+        """The additive values one upload contributes to every group it belongs to."""
+        return dict(record["counters"], uploads=1)
+
+    def add(self, record):
+        self.add_many((record,))
+
+    def add_many(self, records):
+        """``add`` for a batch, under one lock acquisition."""
+        batch = []
+        for record in records:
+            values = self.values(record)
+            if values:
+                batch.append(((("app", record["appId"]), ("sdk", record["sdk"]), ("all", "*")), values))
+        if not batch:
+            return
+        with self._lock:
+            now = self._clock()
+            for window in self._windows.values():
+                for keys, values in batch:
+                    window.add(now, keys, values)
+
+    def snapshot(self, windows=None, modes=("sliding", "tumbling")):
+        with self._lock:
+            now = self._clock()
+            return {
+                "now": int(now * 1000),
+                "windows": {
+                    name: window.snapshot(now, modes)
+                    for name, window in self._windows.items()
+                    if windows is None or name in windows
+                },
+            }
+
+
+class CounterTotals:
+    """Counter sums and upload counts per (appId, sdk) since the stub started.
+
+    Unlike the windows these never expire, which is what Prometheus
+    counters expect; the key space is bounded by the cardinality guard.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._uploads = {}  # (appId, sdk) -> uploads
+        self._counters = {}  # (appId, sdk, name) -> sum
+
+    def add_many(self, records):
+        with self._lock:
+            uploads, counters = self._uploads, self._counters
+            for record in records:
+                group = (record["appId"], record["sdk"])
+                uploads[group] = uploads.get(group, 0) + 1
+                for name, value in record["counters"].items():
+                    key = group + (name,)
+                    counters[key] = counters.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._uploads), dict(self._counters)
+
+
+def bin_key(value):
+    if value <= 0:
+        return "zero"
+    return f"b{math.ceil(math.log(value) / _LOG_GAMMA)}"
+
+
+def sketch_bins(sketch):
+    """Decode an uploaded ``request_latency_sketch`` into ``{bin key: count}``, or None.
+
+    Expected shape (DDSketch, log-spaced bins)::
+
+        {"alpha": 0.01, "bins": {"<index>": <count>, ...}, "zeroCount": <count>}
+
+    ``bins`` may also be a list of ``[index, count]`` pairs. Sketches built with
+    another ``alpha`` are re-binned through each bin's representative value.
+    Bins outside ``SKETCH_MIN_MS``..``SKETCH_MAX_MS`` count toward the nearest
+    end, and a sketch with more than ``MAX_SKETCH_BINS`` bins is rejected.
+    """
+    if not isinstance(sketch, dict):
+        return None
+    try:
+        alpha = float(sketch.get("alpha", SKETCH_ALPHA))
+        if not 0 < alpha < 1:
+            return None
+        raw = sketch.get("bins") or {}
+        if len(raw) > MAX_SKETCH_BINS:
+            return None
+        pairs = raw.items() if isinstance(raw, dict) else raw
+        gamma = (1 + alpha) / (1 - alpha)
+        # Re-binning happens in log space so huge indexes cannot overflow.
+        scale, offset = math.log(gamma) / _LOG_GAMMA, math.log(2 / (gamma + 1)) / _LOG_GAMMA
+        bins = {}
+        for index, count in pairs:
+            count = int(count)
+            if count <= 0:
+                continue
+            index = int(index)
+            if alpha != SKETCH_ALPHA:
+                index = math.ceil(index * scale + offset)
+            key = f"b{min(max(index, _MIN_INDEX), _MAX_INDEX)}"
+            bins[key] = bins.get(key, 0) + count
+        zeros = int(sketch.get("zeroCount", 0))
+    except (TypeError, ValueError, OverflowError, ZeroDivisionError):
+        return None
+    if zeros > 0:
+        bins["zero"] = bins.get("zero", 0) + zeros
+    return bins or None
+
+
+def _bin_value(key):
+    if key == "zero":
+        return 0.0
+    return 2 * _GAMMA ** int(key[1:]) / (_GAMMA + 1)
+
+
+def sketch_quantiles(bins, quantiles=DEFAULT_QUANTILES):
+    ordered = sorted((_bin_value(key), count) for key, count in bins.items() if count > 0)
+    total = sum(count for _, count in ordered)
+    out = {}
+    for q in quantiles:
+        rank, seen = q * (total - 1), 0
+        for value, count in ordered:
+            seen += count
+            if seen > rank:
+                out[f"p{q * 100:g}"] = round(value, 3)
+                break
+    return total, out
+
+
+class LatencyAggregator(WindowAggregator):
+    """Fleet-wide ``request_latency_ms`` distributions per app, SDK and window.
+
+    Uploads carrying a DDSketch contribute its bins, which are plain counts,
+    so they merge and expire through the same additive windows as the
+    counters. Uploads carrying only p50/p95/p99 go into a separate legacy
+    distribution where each percentile is weighted by ``requests_total``.
+    """
+
+    def values(self, record):
+        bins = sketch_bins(record.get("sketch"))
+        if bins is not None:
+            return bins
+        if record["latency"] is None:
+            return {}
+        weight = max(1, record["counters"].get("requests_total", 0))
+        legacy = dict(zip(("p50", "p95", "p99"), record["latency"]))
+        values = {"legacy_requests": weight}
+        for field, mass in LEGACY_MASS:
+            if not math.isnan(legacy[field]):
+                key = "legacy_" + bin_key(legacy[field])
+                values[key] = values.get(key, 0) + weight * mass
+        return values
+
+    def latency(self, windows=None, quantiles=DEFAULT_QUANTILES, raw=False):
+        if raw:
+            return self.snapshot(windows, ("sliding",))
+        return render_latency(self.snapshot(windows, ("sliding",)), quantiles)
+
+
+def render_group(values, quantiles=DEFAULT_QUANTILES):
+    """Quantiles for one group of ``LatencyAggregator`` values (sketch bins and/or legacy keys)."""
+    sketch = {key: count for key, count in values.items() if key[0] in "bz"}
+    legacy = {key[7:]: count for key, count in values.items() if key.startswith("legacy_b") or key == "legacy_zero"}
+    out = {"source": None}
+    if sketch:
+        count, out["sketch"] = sketch_quantiles(sketch, quantiles)
+        out["sketch"]["count"] = count
+    if legacy:
+        _, out["legacy"] = sketch_quantiles(legacy, quantiles)
+        out["legacy"]["requests"] = values.get("legacy_requests", 0)
+    if sketch:
+        out["source"], out["quantiles"] = "sketch", out["sketch"]
+    elif legacy:
+        out["source"], out["quantiles"] = "legacy", out["legacy"]
+    return out
+
+
+def render_latency(raw, quantiles=DEFAULT_QUANTILES):
+    """Turn a raw ``LatencyAggregator`` snapshot (possibly merged across workers) into quantiles."""
+    return {
+        "now": raw["now"],
+        "windows": {
+            name: {
+                kind: {ident: render_group(values, quantiles) for ident, values in groups.items()}
+                for kind, groups in window["sliding"].items()
+            }
+            for name, window in raw["windows"].items()
+        },
+    }
+
+
+def merge_counts(into, other):
+    """Recursively add the numeric leaves of ``other`` into ``into``."""
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merge_counts(into.setdefault(key, {}), value)
+        elif key in ("now", "start"):
+            into[key] = max(into.get(key, value), value)
+        else:
+            into[key] = into.get(key, 0) + value
+    return into
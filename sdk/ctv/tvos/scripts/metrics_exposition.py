@@ -0,0 +1,93 @@
+"""Prometheus text exposition of the aggregates kept by metrics_stub.py."""
+
+import math
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name -> (type, help)
+FAMILIES = {
+    "metrics_stub_uploads_total": ("counter", "Metrics uploads stored, by app and SDK."),
+    "metrics_stub_sdk_counter_total": ("counter", "Sum of each counter reported in metrics uploads."),
+    "metrics_stub_ingest_uploads_per_second": ("gauge", "Uploads per second over a sliding window."),
+    "metrics_stub_request_latency_ms": ("summary", "SDK request latency quantiles over the last minute."),
+    "metrics_stub_http_requests_total": ("counter", "Requests handled by the stub, by route and status."),
+    "metrics_stub_http_request_seconds_total": ("counter", "Time spent routing requests, by route."),
+    "metrics_stub_ring_entries": ("gauge", "Raw uploads held in the ring buffer."),
+    "metrics_stub_ingest_queue_depth": ("gauge", "Uploads waiting for the ingest threads."),
+    "metrics_stub_ingest_rejected_total": ("counter", "Uploads refused because the ingest queue was full."),
+    "metrics_stub_dedup_duplicates_total": ("counter", "Retried uploads dropped by the dedup window."),
+    "metrics_stub_cardinality_folded_keys_total": ("counter", "Counter names folded into __other__."),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+class Exposition:
+    """Renders ``{(family, labels): value}`` samples as Prometheus text.
+
+    Each series' formatted line is kept between renders and only rebuilt
+    when its value changes. Whole bodies are reused for ``max_age``
+    seconds (the default matches a 5 s scrape interval), so frequent
+    scrapes cost one cache lookup. Both caches are
+    kept per ``scope`` (e.g. one worker's samples vs the whole fleet's),
+    so one scope is never answered with another's body.
+    """
+
+    def __init__(self, max_age=5.0, clock=time.monotonic):
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._lines = {}  # scope -> {(family, labels): (value, line)}
+        self._bodies = {}  # scope -> (expires, body)
+        self.renders = 0
+        self.cache_hits = 0
+
+    def cached(self, scope=None):
+        """The last body rendered for ``scope`` if it is younger than ``max_age``, else None."""
+        with self._lock:
+            expires, body = self._bodies.get(scope, (None, b""))
+            if expires is not None and self._clock() < expires:
+                self.cache_hits += 1
+                return body
+            return None
+
+    def render(self, samples, scope=None):
+        with self._lock:
+            previous = self._lines.get(scope, {})
+            by_family = {}
+            for key, value in samples.items():
+                by_family.setdefault(key[0], []).append((key, value))
+            out = []
+            lines = {}
+            for family in sorted(by_family):
+                kind, text = FAMILIES[family]
+                out.append(f"# HELP {family} {text}")
+                out.append(f"# TYPE {family} {kind}")
+                for key, value in sorted(by_family[family], key=lambda item: item[0][1]):
+                    cached = previous.get(key)
+                    if cached is None or cached[0] != value:
+                        labels = ",".join(f'{name}="{_escape(label)}"' for name, label in key[1])
+                        cached = (value, f"{family}{{{labels}}} {_format_value(value)}" if labels
+                                  else f"{family} {_format_value(value)}")
+                    lines[key] = cached
+                    out.append(cached[1])
+            # Series that vanished are dropped from the line cache.
+            self._lines[scope] = lines
+            body = ("\n".join(out) + "\n").encode("utf-8")
+            self._bodies[scope] = (self._clock() + self.max_age, body)
+            self.renders += 1
+            return body
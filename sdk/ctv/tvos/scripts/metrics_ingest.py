@@ -0,0 +1,108 @@
+"""Background ingest queue for metrics uploads received by metrics_stub.py."""
+
+import threading
+import traceback
+from collections import deque
+
+DEFAULT_QUEUE_DEPTH = 10_000
+DEFAULT_INGEST_WORKERS = 2
+DEFAULT_INGEST_BATCH = 256
+
+
+class IngestQueue:
+    """Bounded hand-off of raw upload bodies from request handlers to background threads.
+
+    Handlers only ``offer`` bytes and reply; ``workers`` threads take up to
+    ``batch`` bodies at a time and pass them to ``sink``, so parsing,
+    aggregation and persistence stay off the request path. The sink
+    returns how many of its bodies failed (None for none). Once
+    ``max_depth`` bodies are waiting, ``offer`` refuses and the caller is
+    expected to push back on the client.
+    """
+
+    def __init__(self, sink, max_depth=DEFAULT_QUEUE_DEPTH, workers=DEFAULT_INGEST_WORKERS,
+                 batch=DEFAULT_INGEST_BATCH):
+        self.max_depth = max_depth
+        self.batch = batch
+        self._sink = sink
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._in_flight = 0
+        self.high_water = 0
+        self.enqueued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.batches = 0
+        self.errors = 0
+        self._threads = [
+            threading.Thread(target=self._run, name=f"ingest-{index}", daemon=True) for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def offer(self, body):
+        """Queue one body; False when the queue is full or closed."""
+        with self._cond:
+            if self._closed or len(self._items) >= self.max_depth:
+                self.rejected += 1
+                return False
+            self._items.append(body)
+            self.enqueued += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+                if not self._items:
+                    return
+                batch = [self._items.popleft() for _ in range(min(self.batch, len(self._items)))]
+                self._in_flight += len(batch)
+            try:
+                failed = self._sink(batch) or 0
+            except Exception:  # keep the worker alive; the batch is counted as failed
+                traceback.print_exc()
+                failed = len(batch)
+            with self._cond:
+                self._in_flight -= len(batch)
+                self.processed += len(batch) - failed
+                self.errors += failed
+                self.batches += 1
+                self._cond.notify_all()
+
+    def drain(self, timeout=None):
+        """Wait until every queued body has gone through the sink; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._items and not self._in_flight, timeout)
+
+    def close(self, timeout=5.0):
+        """Refuse new bodies, let the workers finish what is queued, and stop them."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": len(self._items),
+                "in_flight": self._in_flight,
+                "max_depth": self.max_depth,
+                "high_water": self.high_water,
+                "enqueued": self.enqueued,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "errors": self.errors,
+                "batches": self.batches,
+                "workers": len(self._threads),
+            }
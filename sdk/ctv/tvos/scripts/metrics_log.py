@@ -0,0 +1,256 @@
+"""Append-only, segmented on-disk log of metrics uploads for metrics_stub.py."""
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_right
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 16
+DEFAULT_INDEX_EVERY = 64
+
+# Record header: payload length, crc32 of payload, arrival time in ms.
+_HEADER = struct.Struct("<IIq")
+# Sparse index entry: arrival time in ms, sequence number, byte offset.
+_INDEX = struct.Struct("<qQQ")
+
+
+class _Segment:
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.idx_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.index = []  # (ts, seq, offset), sorted by seq
+        self.end_seq = base_seq
+        self.size = 0
+        self._map = None
+        self._mapped_size = 0
+
+    def view(self):
+        """A read-only mmap covering everything written so far (None while empty)."""
+        if self.size == 0:
+            return None
+        if self._map is None or self._mapped_size != self.size:
+            # The previous map is left to the GC: scan() results may still reference it.
+            with open(self.log_path, "rb") as handle:
+                self._map = mmap.mmap(handle.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._mapped_size = self.size
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+
+
+def _walk(view, offset, end):
+    """Yield ``(offset, ts, payload start, payload end)`` for each intact record in ``view``."""
+    while offset + _HEADER.size <= end:
+        length, crc, ts = _HEADER.unpack_from(view, offset)
+        start = offset + _HEADER.size
+        if start + length > end or zlib.crc32(view[start:start + length]) != crc:
+            return
+        yield offset, ts, start, start + length
+        offset = start + length
+
+
+class SegmentLog:
+    """Rotating segment files of length-prefixed records with a sparse timestamp index.
+
+    Each record stores one upload as a JSON string literal, so readers splice
+    mmap slices straight into a JSON array. Every ``index_every``-th record
+    (and the first of each segment) is noted in a ``.idx`` side file, which
+    lets a restart reopen closed segments without reading them and lets
+    ``scan(since=...)`` seek close to the first matching record.
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, max_segments=DEFAULT_MAX_SEGMENTS,
+                 index_every=DEFAULT_INDEX_EVERY, clock=time.time):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.index_every = index_every
+        self._clock = clock
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._segments = [self._reopen(base) for base in self._existing_bases()]
+        if not self._segments:
+            self._segments.append(_Segment(directory, 0))
+        self._log = open(self._segments[-1].log_path, "ab", buffering=0)
+        self._idx = open(self._segments[-1].idx_path, "ab", buffering=0)
+
+    def _existing_bases(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    def _reopen(self, base):
+        segment = _Segment(self.directory, base)
+        stored = 0
+        if os.path.exists(segment.idx_path):
+            with open(segment.idx_path, "rb") as handle:
+                data = handle.read()
+            stored = len(data)
+            usable = len(data) - len(data) % _INDEX.size
+            segment.index = list(_INDEX.iter_unpack(data[:usable]))
+        size = os.path.getsize(segment.log_path)
+        segment.size = size
+        # The index is written after its records, but a crash can still keep it while losing them.
+        segment.index = [entry for entry in segment.index if entry[2] < size]
+        _ts, seq, offset = segment.index[-1] if segment.index else (0, base, 0)
+        # Only the tail after the last index entry has to be read to find the end.
+        end, count = offset, 0
+        view = segment.view()
+        if view is not None:
+            for _offset, _ts, _start, stop in _walk(view, offset, size):
+                end, count = stop, count + 1
+        segment.end_seq = seq + count
+        if end != size:
+            segment.close()
+            # Drop a torn tail left by a crash mid-append.
+            with open(segment.log_path, "r+b") as handle:
+                handle.truncate(end)
+            segment.size = end
+            segment.index = [entry for entry in segment.index if entry[2] < end]
+        if stored != len(segment.index) * _INDEX.size:
+            # Kept entries are a prefix; cut the rest so later appends do not follow stale ones.
+            with open(segment.idx_path, "r+b") as handle:
+                handle.truncate(len(segment.index) * _INDEX.size)
+        return segment
+
+    def append(self, fragment):
+        """Append one encoded upload and return its sequence number."""
+        return self.extend((fragment,))
+
+    def extend(self, fragments):
+        """Append several encoded uploads in one write per segment; returns the last sequence number."""
+        payloads = [fragment.encode("utf-8") if isinstance(fragment, str) else fragment for fragment in fragments]
+        seq = None
+        with self._lock:
+            ts = int(self._clock() * 1000)
+            records, entries = [], []
+            for payload in payloads:
+                segment = self._segments[-1]
+                if segment.size and segment.size + _HEADER.size + len(payload) > self.segment_bytes:
+                    self._flush(records, entries)
+                    records, entries = [], []
+                    segment = self._rotate()
+                seq = segment.end_seq
+                if (seq - segment.base_seq) % self.index_every == 0:
+                    entry = (ts, seq, segment.size)
+                    entries.append(_INDEX.pack(*entry))
+                    segment.index.append(entry)
+                records.append(_HEADER.pack(len(payload), zlib.crc32(payload), ts) + payload)
+                segment.size += _HEADER.size + len(payload)
+                segment.end_seq = seq + 1
+            self._flush(records, entries)
+        return seq
+
+    def _flush(self, records, entries):
+        # Records first, so an index entry never points past a crash-truncated log.
+        if records:
+            self._log.write(b"".join(records))
+        if entries:
+            self._idx.write(b"".join(entries))
+
+    def _rotate(self):
+        self._log.close()
+        self._idx.close()
+        segment = _Segment(self.directory, self._segments[-1].end_seq)
+        self._segments.append(segment)
+        self._log = open(segment.log_path, "ab", buffering=0)
+        self._idx = open(segment.idx_path, "ab", buffering=0)
+        while len(self._segments) > self.max_segments:
+            oldest = self._segments.pop(0)
+            oldest.close()
+            for path in (oldest.log_path, oldest.idx_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return segment
+
+    def scan(self, since=None, after=None, limit=None):
+        """Return ``(seq, ts, memoryview)`` records with ``ts >= since`` and ``seq > after``.
+
+        The memoryviews point into the segment mmaps; copy them before the
+        log rotates if they must outlive the call.
+        """
+        out = []
+        with self._lock:
+            segments = list(self._segments)
+            for position, segment in enumerate(segments):
+                following = segments[position + 1] if position + 1 < len(segments) else None
+                if following is not None:
+                    if after is not None and following.base_seq <= after + 1:
+                        continue
+                    if since is not None and following.index and following.index[0][0] < since:
+                        continue
+                view = segment.view()
+                if view is None:
+                    continue
+                start, seq = 0, segment.base_seq
+                if segment.index:
+                    slot = 0
+                    if since is not None:
+                        slot = max(slot, bisect_right([entry[0] for entry in segment.index], since - 1) - 1)
+                    if after is not None:
+                        slot = max(slot, bisect_right([entry[1] for entry in segment.index], after + 1) - 1)
+                    _ts, seq, start = segment.index[max(0, slot)]
+                for _offset, ts, begin, stop in _walk(view, start, segment.size):
+                    if (after is None or seq > after) and (since is None or ts >= since):
+                        out.append((seq, ts, memoryview(view)[begin:stop]))
+                        if limit is not None and len(out) >= limit:
+                            return out
+                    seq += 1
+        return out
+
+    @property
+    def next_seq(self):
+        return self._segments[-1].end_seq
+
+    def page_bounds(self, after=None, limit=None):
+        """``(start, stop)`` sequence range a page after cursor ``after`` covers."""
+        with self._lock:
+            first, end = self._segments[0].base_seq, self._segments[-1].end_seq
+        start = first if after is None else max(first, after + 1)
+        stop = end if limit is None else min(end, start + limit)
+        return start, max(start, stop)
+
+    def iter_encoded(self, start, stop, since=None, batch=256):
+        """Yield a JSON array of records ``start <= seq < stop`` (and ``ts >= since``) in batches."""
+        yield b"["
+        separator = b""
+        while start < stop:
+            records = self.scan(after=start - 1, limit=min(batch, stop - start))
+            if not records:
+                break
+            views = [view for seq, ts, view in records if seq < stop and (since is None or ts >= since)]
+            if views:
+                yield separator + b", ".join(views)
+                separator = b", "
+            start = records[-1][0] + 1
+        yield b"]"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "bytes": sum(segment.size for segment in self._segments),
+                "first_seq": self._segments[0].base_seq,
+                "next_seq": self._segments[-1].end_seq,
+                "segment_bytes": self.segment_bytes,
+                "max_segments": self.max_segments,
+            }
+
+    def close(self):
+        with self._lock:
+            self._log.close()
+            self._idx.close()
+            for segment in self._segments:
+                segment.close()
@@ -0,0 +1,238 @@
+"""Retention tiers for metrics_stub.py: raw rows for an hour, then 1-minute and 1-hour rollups."""
+
+import threading
+import time
+from collections import deque
+
+from metrics_aggregates import LatencyAggregator
+
+RAW_RETENTION = 3600
+# name -> (bucket seconds, retention seconds), finest first
+TIERS = {"1m": (60, 86_400), "1h": (3600, 30 * 86_400)}
+DEFAULT_COMPACT_INTERVAL = 30.0
+# Uploads stamped further ahead of the server clock than this are dropped.
+MAX_CLOCK_SKEW = 300
+
+_LATENCY = LatencyAggregator(clock=lambda: 0)
+
+
+def rollup_values(record):
+    """Additive values one upload adds to its rollup group.
+
+    ``c:<name>`` sums a counter, ``n:<name>`` counts the uploads reporting
+    it and ``l:<bin>`` holds latency sketch (or legacy) bins, so buckets
+    merge by plain addition.
+    """
+    values = {"uploads": 1}
+    for name, value in record["counters"].items():
+        values["c:" + name] = value
+        values["n:" + name] = 1
+    for key, count in _LATENCY.values(record).items():
+        values["l:" + key] = count
+    return values
+
+
+def _merge(target, values):
+    for key, value in values.items():
+        target[key] = target.get(key, 0) + value
+
+
+def _due(marks, cutoff):
+    """Pop every mark taken at or before ``cutoff``; the newest popped id, or None."""
+    due = None
+    while marks and marks[0][0] <= cutoff:
+        due = marks.popleft()[1]
+    return due
+
+
+class RollupTier:
+    """Additive buckets of one resolution: ``{bucket start ms: {(appId, sdk): values}}``."""
+
+    def __init__(self, name, step, retention):
+        self.name = name
+        self.step = step * 1000
+        self.retention = retention * 1000
+        self.buckets = {}
+
+    def start(self, ts):
+        return ts - ts % self.step
+
+    def add(self, start, group, values):
+        groups = self.buckets.get(start)
+        if groups is None:
+            groups = self.buckets[start] = {}
+        target = groups.get(group)
+        if target is None:
+            groups[group] = dict(values)
+        else:
+            _merge(target, values)
+
+    def query(self, app_id, sdk, since, until, prefix):
+        """Same shape as ``ColumnarStore.query`` plus merged ``latency`` bins."""
+        sums, counts, latency = {}, {}, {}
+        rows, scanned, first, last = 0, 0, None, None
+        for start, groups in self.buckets.items():
+            if (since is not None and start < since) or (until is not None and start >= until):
+                continue
+            for (group_app, group_sdk), values in groups.items():
+                scanned += 1
+                if (app_id is not None and group_app != app_id) or (sdk is not None and group_sdk != sdk):
+                    continue
+                rows += values.get("uploads", 0)
+                first = start if first is None or start < first else first
+                last = start if last is None or start > last else last
+                for key, value in values.items():
+                    if key.startswith("c:"):
+                        if key.startswith(prefix, 2):
+                            sums[key[2:]] = sums.get(key[2:], 0) + value
+                    elif key.startswith("n:"):
+                        if key.startswith(prefix, 2):
+                            counts[key[2:]] = counts.get(key[2:], 0) + value
+                    elif key.startswith("l:"):
+                        latency[key[2:]] = latency.get(key[2:], 0) + value
+        return {"rows": rows, "scanned": scanned, "first_ts": first, "last_ts": last, "sums": sums,
+                "counts": counts, "latency": latency}
+
+    def stats(self):
+        return {
+            "buckets": len(self.buckets),
+            "groups": sum(len(groups) for groups in self.buckets.values()),
+            "oldest": min(self.buckets) if self.buckets else None,
+        }
+
+
+class RetentionManager:
+    """Keeps raw rows for ``RAW_RETENTION`` seconds and rollups per ``TIERS``.
+
+    Every upload is rolled into its 1-minute bucket as it is ingested,
+    because only the upload still carries the mergeable latency sketch.
+    ``compact`` runs on a background schedule. It folds whole hours of
+    1-minute buckets older than a day into 1-hour buckets, drops 1-hour
+    buckets past a month, and expires raw columnar rows (and SQLite rows
+    past the longest tier) by arrival age. ``plan`` splits a time range
+    into pieces, each served by the coarsest tier that holds it at a
+    resolution its endpoints line up with. Uploads stamped more than
+    ``MAX_CLOCK_SKEW`` seconds in the future are dropped, since their
+    buckets would never be compacted or expired.
+    """
+
+    def __init__(self, columns, sqlite=None, clock=time.time, interval=DEFAULT_COMPACT_INTERVAL):
+        self.columns = columns
+        self.sqlite = sqlite
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.minutes = RollupTier("1m", *TIERS["1m"])
+        self.hours = RollupTier("1h", *TIERS["1h"])
+        now = int(clock() * 1000)
+        # 1m buckets hold everything from minute_floor on; 1h buckets hold [hour_floor, minute_floor).
+        self.minute_floor = self.hours.start(now - self.minutes.retention)
+        self.hour_floor = self.hours.start(now - self.hours.retention)
+        # (arrival time, next id) samples taken each pass, for expiry by arrival age.
+        self._raw_marks = deque()
+        self._sqlite_marks = deque()
+        self.compactions = 0
+        self.late_dropped = 0
+        self.future_dropped = 0
+        self.raw_expired = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_many(self, records):
+        ceiling = int((self._clock() + MAX_CLOCK_SKEW) * 1000)
+        with self._lock:
+            for record in records:
+                ts = record["timestamp"]
+                if ts > ceiling:
+                    self.future_dropped += 1
+                    continue
+                if ts >= self.minute_floor:
+                    tier = self.minutes
+                elif ts >= self.hour_floor:
+                    tier = self.hours
+                else:
+                    self.late_dropped += 1
+                    continue
+                tier.add(tier.start(ts), (record["appId"], record["sdk"]), rollup_values(record))
+
+    def compact(self):
+        now = self._clock()
+        now_ms = int(now * 1000)
+        with self._lock:
+            minute_floor = self.hours.start(now_ms - self.minutes.retention)
+            for start in [start for start in self.minutes.buckets if start < minute_floor]:
+                for group, values in self.minutes.buckets.pop(start).items():
+                    self.hours.add(self.hours.start(start), group, values)
+            self.minute_floor = max(self.minute_floor, minute_floor)
+            self.hour_floor = max(self.hour_floor, self.hours.start(now_ms - self.hours.retention))
+            for start in [start for start in self.hours.buckets if start < self.hour_floor]:
+                del self.hours.buckets[start]
+            self.compactions += 1
+        # Rows that had arrived by a mark's time are the ones below its id.
+        self._raw_marks.append((now, self.columns.next_row))
+        expire = _due(self._raw_marks, now - RAW_RETENTION)
+        if expire is not None:
+            self.raw_expired += self.columns.expire(expire)
+        if self.sqlite is not None:
+            self._sqlite_marks.append((now, self.sqlite.stats()["next_id"] + 1))
+            prune = _due(self._sqlite_marks, now - TIERS["1h"][1])
+            if prune is not None:
+                self.sqlite.prune(prune)
+
+    def plan(self, since, until):
+        """``[(tier name, since, until)]`` covering the range, coarsest usable tier per piece.
+
+        A rollup piece whose endpoints do not line up with its buckets is
+        widened to whole buckets (and reported as such) unless raw rows
+        still cover it.
+        """
+        now_ms = int(self._clock() * 1000)
+        raw_floor = now_ms - RAW_RETENTION * 1000
+        pieces = []
+        with self._lock:
+            minute_floor, hour_floor = self.minute_floor, self.hour_floor
+        if since is None or since < minute_floor:
+            low = hour_floor if since is None else max(since, hour_floor)
+            high = minute_floor if until is None else min(until, minute_floor)
+            if low < high:
+                pieces.append(("1h", self.hours.start(low), -(-high // self.hours.step) * self.hours.step))
+        low = minute_floor if since is None else max(since, minute_floor)
+        if until is None or low < until:
+            aligned = low % self.minutes.step == 0 and (until is None or until % self.minutes.step == 0)
+            if not aligned and low >= raw_floor:
+                pieces.append(("raw", low, until))
+            else:
+                high = None if until is None else -(-until // self.minutes.step) * self.minutes.step
+                pieces.append(("1m", self.minutes.start(low), high))
+        return pieces
+
+    def query(self, tier, app_id, sdk, since, until, prefix):
+        with self._lock:
+            return (self.minutes if tier == "1m" else self.hours).query(app_id, sdk, since, until, prefix)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.compact()
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "raw_retention_s": RAW_RETENTION,
+                "tiers": {
+                    tier.name: dict(tier.stats(), step_s=tier.step // 1000, retention_s=tier.retention // 1000)
+                    for tier in (self.minutes, self.hours)
+                },
+                "minute_floor": self.minute_floor,
+                "hour_floor": self.hour_floor,
+                "compactions": self.compactions,
+                "raw_expired": self.raw_expired,
+                "late_dropped": self.late_dropped,
+                "future_dropped": self.future_dropped,
+            }
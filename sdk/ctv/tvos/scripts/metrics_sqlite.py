@@ -0,0 +1,267 @@
+"""SQLite persistence for parsed metrics uploads received by metrics_stub.py."""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from metrics_store import LATENCY_FIELDS
+
+DEFAULT_BATCH = 2000
+DEFAULT_LINGER = 0.05
+DEFAULT_MAX_PENDING = 100_000
+DEFAULT_PRUNE_EVERY = 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS sdks (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS counter_names (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    app INTEGER NOT NULL REFERENCES apps (id),
+    sdk INTEGER NOT NULL REFERENCES sdks (id)
+);
+CREATE INDEX IF NOT EXISTS uploads_app_ts ON uploads (app, ts);
+CREATE TABLE IF NOT EXISTS counters (
+    upload INTEGER NOT NULL REFERENCES uploads (id),
+    name INTEGER NOT NULL REFERENCES counter_names (id),
+    value INTEGER NOT NULL,
+    PRIMARY KEY (upload, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS latency (
+    upload INTEGER PRIMARY KEY REFERENCES uploads (id),
+    p50 REAL,
+    p95 REAL,
+    p99 REAL
+);
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SqliteStore:
+    """Parsed uploads in a WAL-mode SQLite file, written by a single background thread.
+
+    ``ingest_many`` only queues records. The writer waits up to ``linger``
+    seconds for ``batch`` of them and commits each group in one transaction,
+    so a commit's cost is spread over the whole group. Apps, SDKs and
+    counter names are normalized into lookup tables. Counters and latency
+    percentiles go in their own tables keyed by upload, and uploads are
+    indexed on (app, ts). Readers use their own connections and see
+    committed groups only.
+
+    Requested prunes run when the queue is empty, or after ``prune_every``
+    groups when uploads never stop arriving. A group or prune that fails
+    is logged and skipped; ``errors`` counts the records dropped by failed
+    groups plus one per failed prune.
+    """
+
+    def __init__(self, path, batch=DEFAULT_BATCH, linger=DEFAULT_LINGER, max_pending=DEFAULT_MAX_PENDING,
+                 prune_every=DEFAULT_PRUNE_EVERY):
+        self.path = path
+        self.batch = batch
+        self.linger = linger
+        self.max_pending = max_pending
+        self.prune_every = prune_every
+        self._pending = []
+        self._in_flight = 0
+        self._prune_below = 0
+        self._pruned_below = 0
+        self._groups_since_prune = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._local = threading.local()
+        self.written = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.errors = 0
+        self.pruned = 0
+        conn = _connect(path)
+        conn.executescript(_SCHEMA)
+        self._load(conn)
+        self._writer = threading.Thread(target=self._run, args=(conn,), name="sqlite-writer", daemon=True)
+        self._writer.start()
+
+    def _load(self, conn):
+        """Cache the lookup tables and the last upload id; only the writer changes them."""
+        self._codes = {table: dict(conn.execute(f"SELECT name, id FROM {table}")) for table in
+                       ("apps", "sdks", "counter_names")}
+        self._next_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM uploads").fetchone()[0]
+
+    def ingest_many(self, records):
+        """Queue parsed records for the writer; blocks while ``max_pending`` are already queued."""
+        records = [record for record in records if record is not None]
+        if not records:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._pending) < self.max_pending or self._closed)
+            if self._closed:
+                return
+            self._pending.extend(records)
+            self._cond.notify_all()
+
+    def prune(self, below_id):
+        """Ask the writer to delete uploads with ids below ``below_id`` (oldest first)."""
+        with self._cond:
+            self._prune_below = max(self._prune_below, below_id)
+            self._cond.notify_all()
+
+    def _prune(self, conn):
+        below = self._prune_below
+        with conn:
+            for table, column in (("counters", "upload"), ("latency", "upload"), ("uploads", "id")):
+                deleted = conn.execute(f"DELETE FROM {table} WHERE {column} < ?", (below,)).rowcount
+                if table == "uploads":
+                    self.pruned += deleted
+        self._pruned_below = below
+
+    def _prune_due(self):
+        return self._prune_below > self._pruned_below and (
+            not self._pending or self._groups_since_prune >= self.prune_every)
+
+    def _run(self, conn):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed or self._prune_below > self._pruned_below)
+                prune = self._prune_due()
+            if prune:
+                try:
+                    self._prune(conn)
+                except Exception:
+                    traceback.print_exc()
+                    self._pruned_below = self._prune_below
+                    with self._cond:
+                        self.errors += 1
+                self._groups_since_prune = 0
+                continue
+            with self._cond:
+                if not self._pending:
+                    break
+                # Group commit: give a partial batch a moment to fill up.
+                self._cond.wait_for(lambda: len(self._pending) >= self.batch or self._closed, self.linger)
+                records, self._pending = self._pending, []
+                self._in_flight = len(records)
+                self._cond.notify_all()
+            started = time.perf_counter()
+            failed = 0
+            try:
+                self._write(conn, records)
+            except Exception:
+                # The transaction rolled back; drop the group and resync the caches.
+                traceback.print_exc()
+                failed = len(records)
+                try:
+                    self._load(conn)
+                except sqlite3.Error:
+                    traceback.print_exc()
+            elapsed = time.perf_counter() - started
+            self._groups_since_prune += 1
+            with self._cond:
+                self._in_flight = 0
+                self.written += len(records) - failed
+                self.errors += failed
+                self.commits += 0 if failed else 1
+                self.commit_seconds += elapsed
+                self._cond.notify_all()
+        conn.close()
+
+    def _code(self, conn, table, name):
+        codes = self._codes[table]
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = conn.execute(f"INSERT INTO {table} (name) VALUES (?)", (name,)).lastrowid
+        return code
+
+    def _write(self, conn, records):
+        uploads, counters, latency = [], [], []
+        with conn:
+            for record in records:
+                self._next_id += 1
+                upload = self._next_id
+                uploads.append((upload, record["timestamp"], self._code(conn, "apps", record["appId"]),
+                                self._code(conn, "sdks", record["sdk"])))
+                for name, value in record["counters"].items():
+                    counters.append((upload, self._code(conn, "counter_names", name), value))
+                if record["latency"] is not None:
+                    latency.append((upload, *(None if math.isnan(value) else value for value in record["latency"])))
+            conn.executemany("INSERT INTO uploads (id, ts, app, sdk) VALUES (?, ?, ?, ?)", uploads)
+            conn.executemany("INSERT INTO counters (upload, name, value) VALUES (?, ?, ?)", counters)
+            conn.executemany("INSERT INTO latency (upload, p50, p95, p99) VALUES (?, ?, ?, ?)", latency)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is committed; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._in_flight, timeout)
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+        return conn
+
+    def summary(self, app_id=None, sdk=None, since=None, until=None):
+        """Same shape as ``ColumnarStore.summary``, over every committed upload."""
+        clauses, params = [], []
+        if app_id is not None:
+            clauses.append("u.app = (SELECT id FROM apps WHERE name = ?)")
+            params.append(app_id)
+        if sdk is not None:
+            clauses.append("u.sdk = (SELECT id FROM sdks WHERE name = ?)")
+            params.append(sdk)
+        if since is not None:
+            clauses.append("u.ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("u.ts < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        conn = self._reader()
+        rows = conn.execute(f"SELECT COUNT(*) FROM uploads u {where}", params).fetchone()[0]
+        counters = conn.execute(
+            f"SELECT n.name, SUM(c.value) FROM uploads u JOIN counters c ON c.upload = u.id "
+            f"JOIN counter_names n ON n.id = c.name {where} GROUP BY c.name",
+            params,
+        ).fetchall()
+        complete = " AND ".join(f"l.{field} IS NOT NULL" for field in LATENCY_FIELDS)
+        samples, p50, p95, p99, worst = conn.execute(
+            f"SELECT COUNT(*), AVG(l.p50), AVG(l.p95), AVG(l.p99), MAX(l.p99) FROM uploads u "
+            f"JOIN latency l ON l.upload = u.id {where} {'AND' if where else 'WHERE'} {complete}",
+            params,
+        ).fetchone()
+        return {
+            "rows": rows,
+            "counters": dict(counters),
+            "latency": {"samples": samples, "p50_mean": p50, "p95_mean": p95, "p99_mean": p99, "p99_max": worst},
+        }
+
+    def stats(self):
+        with self._cond:
+            stats = {
+                "path": self.path,
+                "pending": len(self._pending) + self._in_flight,
+                "max_pending": self.max_pending,
+                "written": self.written,
+                "commits": self.commits,
+                "errors": self.errors,
+                "pruned": self.pruned,
+                "mean_commit_ms": round(self.commit_seconds * 1000 / self.commits, 3) if self.commits else 0,
+                "next_id": self._next_id,
+            }
+        stats["bytes"] = sum(os.path.getsize(self.path + suffix) for suffix in ("", "-wal")
+                             if os.path.exists(self.path + suffix))
+        return stats
+
+    def close(self, timeout=30.0):
+        """Commit what is queued and stop the writer."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join(timeout)
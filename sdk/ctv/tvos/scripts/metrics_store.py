@@ -0,0 +1,806 @@
+"""In-memory stores for metrics uploads received by metrics_stub.py."""
+
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 100_000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_ROWS = 1_000_000
+DEFAULT_DEDUP_KEYS = 100_000
+DEFAULT_MAX_KEYS_PER_APP = 512
+DEFAULT_MAX_GUARDED_APPS = 4096
+DEFAULT_MAX_INTERNED_NAMES = 100_000
+OVERFLOW_KEY = "__other__"
+DEFAULT_RESERVOIR_SIZE = 100
+DEFAULT_MAX_SAMPLED_APPS = 1024
+
+LATENCY_FIELDS = ("p50", "p95", "p99")
+# Counters and timestamps are stored in array("q") columns and SQLite INTEGERs.
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _int64(value):
+    """``value`` as an int if it is a finite number that fits in int64, else None."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    value = int(value)
+    return value if INT64_MIN <= value <= INT64_MAX else None
+
+
+def parse_upload(text):
+    """Normalize a ``MetricsRecorder.buildPayloadLocked`` body, or return None if it is not one."""
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        return None
+    return normalize_upload(payload)
+
+
+def normalize_upload(payload):
+    """``parse_upload`` for an already decoded payload.
+
+    A timestamp or counter that is not finite or does not fit in int64
+    rejects the whole upload; non-numeric counters are just skipped.
+    """
+    if not isinstance(payload, dict):
+        return None
+    timestamp = payload.get("timestamp")
+    if _number(timestamp):
+        timestamp = _int64(timestamp)
+        if timestamp is None:
+            return None
+    else:
+        timestamp = int(time.time() * 1000)
+    counters = {}
+    for name, value in (payload["counters"].items() if isinstance(payload.get("counters"), dict) else ()):
+        if _number(value):
+            value = _int64(value)
+            if value is None:
+                return None
+            counters[str(name)] = value
+    latency = payload.get("request_latency_ms")
+    if isinstance(latency, dict):
+        latency = tuple(float(latency[f]) if _number(latency.get(f)) and math.isfinite(latency[f]) else math.nan
+                        for f in LATENCY_FIELDS)
+    else:
+        latency = None
+    return {
+        "timestamp": timestamp,
+        "appId": str(payload.get("appId") or ""),
+        "sdk": str(payload.get("sdk") or ""),
+        "counters": counters,
+        "latency": latency,
+        # Optional mergeable DDSketch; see metrics_aggregates.sketch_bins.
+        "sketch": payload.get("request_latency_sketch"),
+    }
+
+
+def has_errors(record):
+    """True for an upload reporting request errors or tracker failures (or one that did not parse)."""
+    if record is None:
+        return True
+    return any(value > 0 and (name.startswith("requests_error") or name.endswith("_failure"))
+               for name, value in record["counters"].items())
+
+
+def upload_key(record, idempotency_key=None):
+    """16-byte digest identifying an upload for dedup, or None if it cannot be identified.
+
+    A client-supplied idempotency key wins; otherwise the digest covers
+    ``appId``, ``sdk``, ``timestamp`` and ``counters``, so a resent body
+    matches even if its other fields were re-serialized differently.
+    """
+    if idempotency_key:
+        source = "key:" + idempotency_key
+    elif record is not None:
+        source = json.dumps([record["appId"], record["sdk"], record["timestamp"], sorted(record["counters"].items())])
+    else:
+        return None
+    return hashlib.blake2b(source.encode("utf-8"), digest_size=16).digest()
+
+
+def iter_batch(text):
+    """Yield ``(item text, record or None)`` for each upload in an NDJSON or JSON-array batch.
+
+    Items are decoded one at a time. A body starting with ``[`` is a JSON
+    array; anything else is one payload per line, blank lines skipped. A
+    bad NDJSON line only rejects that item, but an array that cannot be
+    split into items raises ValueError.
+    """
+    pos = _WHITESPACE.match(text).end()
+    if not text.startswith("[", pos):
+        for line in io.StringIO(text):
+            line = line.strip()
+            if line:
+                yield line, parse_upload(line)
+        return
+    pos = _WHITESPACE.match(text, pos + 1).end()
+    closed = text.startswith("]", pos)
+    while not closed:
+        try:
+            payload, end = _DECODER.raw_decode(text, pos)
+        except ValueError as exc:
+            raise ValueError(f"malformed batch item at offset {pos}") from exc
+        yield text[pos:end], normalize_upload(payload)
+        pos = _WHITESPACE.match(text, end).end()
+        if text.startswith(",", pos):
+            pos = _WHITESPACE.match(text, pos + 1).end()
+        elif text.startswith("]", pos):
+            closed = True
+        else:
+            raise ValueError(f"expected ',' or ']' at offset {pos}")
+    if _WHITESPACE.match(text, pos + 1).end() != len(text):
+        raise ValueError(f"trailing data after batch array at offset {pos + 1}")
+
+
+class RingStore:
+    """Bounded FIFO of raw uploads, capped by entry count and by encoded bytes.
+
+    Entries are kept as their JSON-encoded form so ``/admin/metrics`` joins
+    fragments instead of re-serializing every upload on each call. When
+    either cap is exceeded the oldest entries are evicted and counted.
+    Every stored entry gets a sequence number that readers use as a cursor;
+    the backing list is addressed by sequence in O(1) and compacted lazily.
+    Arrival times (ms) are kept alongside, as in SegmentLog, for ``since``.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._entries = []
+        self._times = array("q")
+        self._head = 0
+        self._next_seq = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.appended = 0
+        self.dropped_entries = 0
+        self.dropped_bytes = 0
+
+    def append(self, text):
+        """Store ``text`` and return its encoded fragment for reuse by other sinks."""
+        return self.extend((text,))[0]
+
+    def extend(self, texts):
+        """Store several uploads under one lock acquisition; returns their encoded fragments."""
+        fragments = [json.dumps(text) for text in texts]
+        self.extend_encoded(fragments)
+        return fragments
+
+    def extend_encoded(self, fragments):
+        """Store uploads already encoded as JSON strings."""
+        with self._lock:
+            ts = int(self._clock() * 1000)
+            for fragment in fragments:
+                size = len(fragment)
+                self.appended += 1
+                if size > self.max_bytes:
+                    self.dropped_entries += 1
+                    self.dropped_bytes += size
+                    continue
+                self._entries.append(fragment)
+                self._times.append(ts)
+                self._next_seq += 1
+                self._bytes += size
+                while len(self._entries) - self._head > self.max_entries or self._bytes > self.max_bytes:
+                    evicted = len(self._entries[self._head])
+                    self._entries[self._head] = None
+                    self._head += 1
+                    self._bytes -= evicted
+                    self.dropped_entries += 1
+                    self.dropped_bytes += evicted
+            if self._head > 1024 and self._head * 2 > len(self._entries):
+                del self._entries[:self._head]
+                del self._times[:self._head]
+                self._head = 0
+
+    def __len__(self):
+        return len(self._entries) - self._head
+
+    @property
+    def next_seq(self):
+        return self._next_seq
+
+    def _first_seq(self):
+        return self._next_seq - (len(self._entries) - self._head)
+
+    def page_bounds(self, after=None, limit=None):
+        """``(start, stop)`` sequence range a page after cursor ``after`` covers."""
+        with self._lock:
+            start = self._first_seq() if after is None else max(self._first_seq(), after + 1)
+            stop = self._next_seq if limit is None else min(self._next_seq, start + limit)
+            return start, max(start, stop)
+
+    def iter_encoded(self, start, stop, since=None, batch=256):
+        """Yield a JSON array of entries ``start <= seq < stop`` (and arrived at ``since`` ms or later).
+
+        Only one batch is held in memory; entries evicted while the response
+        is being written are skipped.
+        """
+        yield b"["
+        separator = b""
+        while start < stop:
+            with self._lock:
+                start = max(start, self._first_seq())
+                end = min(stop, start + batch)
+                offset = self._head - self._first_seq()
+                fragments = self._entries[offset + start:offset + end]
+                if since is not None:
+                    times = self._times[offset + start:offset + end]
+                    fragments = [fragment for fragment, ts in zip(fragments, times) if ts >= since]
+            if fragments:
+                yield separator + ", ".join(fragments).encode("utf-8")
+                separator = b", "
+            start = end
+        yield b"]"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries) - self._head,
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "appended": self.appended,
+                "dropped_entries": self.dropped_entries,
+                "dropped_bytes": self.dropped_bytes,
+            }
+
+
+class DedupWindow:
+    """Bounded LRU of recently seen ``upload_key`` digests.
+
+    Memory is fixed by ``max_keys``; the least recently seen key is
+    forgotten first. Unlike a Bloom filter it never mistakes a new upload
+    for a retry, so dropping duplicates keeps the aggregates exact.
+    """
+
+    def __init__(self, max_keys=DEFAULT_DEDUP_KEYS):
+        self.max_keys = max_keys
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.forgotten = 0
+
+    def seen(self, key):
+        """Record ``key``; True if it was already in the window."""
+        with self._lock:
+            self.checked += 1
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.duplicates += 1
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+                self.forgotten += 1
+            return False
+
+    def forget(self, keys):
+        """Drop ``keys`` again, e.g. when the uploads they claimed failed to store."""
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._keys),
+                "max_keys": self.max_keys,
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "forgotten": self.forgotten,
+            }
+
+
+class _Dictionary:
+    """Dictionary encoding: each distinct string is stored once and referenced by a small int."""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def encode(self, value):
+        found = self.ids.get(value)
+        if found is None:
+            found = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return found
+
+    def __len__(self):
+        return len(self.values)
+
+
+class CardinalityGuard:
+    """Caps how many distinct counter names each app can introduce.
+
+    ``MetricsRecorder`` builds counter names from runtime values, so one bad
+    client could otherwise grow every downstream store without bound. Names
+    are interned: each gets a small integer id and one canonical string that
+    every stored record shares. An app's first ``max_keys_per_app`` names
+    are admitted. After that, new names are folded into ``__other__`` (their
+    values summed) and counted.
+
+    The guard's own memory is bounded too. It remembers the ``max_apps``
+    most recently seen apps and evicts the least recent one; an evicted
+    app that returns starts a fresh allowance. Once ``max_names`` names are
+    interned, every app folds names it has not been admitted before.
+    """
+
+    def __init__(self, max_keys_per_app=DEFAULT_MAX_KEYS_PER_APP, max_apps=DEFAULT_MAX_GUARDED_APPS,
+                 max_names=DEFAULT_MAX_INTERNED_NAMES):
+        self.max_keys_per_app = max_keys_per_app
+        self.max_apps = max_apps
+        self.max_names = max_names
+        self._lock = threading.Lock()
+        self.names = _Dictionary()
+        self._overflow = self.names.encode(OVERFLOW_KEY)
+        self._apps = OrderedDict()  # appId -> set of admitted name ids, least recently seen first
+        self._folded = {}  # appId -> counter values folded into __other__
+        self.folded_keys = 0
+        self.folded_uploads = 0
+        self.evicted_apps = 0
+
+    def apply(self, record):
+        """Return ``record`` with counter names interned and overflow names folded."""
+        counters = {}
+        folded = 0
+        with self._lock:
+            admitted = self._apps.get(record["appId"])
+            if admitted is None:
+                admitted = self._apps[record["appId"]] = set()
+                if len(self._apps) > self.max_apps:
+                    evicted, _names = self._apps.popitem(last=False)
+                    self._folded.pop(evicted, None)
+                    self.evicted_apps += 1
+            else:
+                self._apps.move_to_end(record["appId"])
+            for name, value in record["counters"].items():
+                code = self.names.ids.get(name)
+                if code is None or code not in admitted:
+                    if len(admitted) >= self.max_keys_per_app or (code is None and len(self.names) >= self.max_names):
+                        code = self._overflow
+                        folded += 1
+                    else:
+                        code = self.names.encode(name)
+                        admitted.add(code)
+                key = self.names.values[code]
+                counters[key] = counters.get(key, 0) + value
+            if folded:
+                self.folded_keys += folded
+                self.folded_uploads += 1
+                self._folded[record["appId"]] = self._folded.get(record["appId"], 0) + folded
+        return dict(record, counters=counters)
+
+    def stats(self, top=100):
+        with self._lock:
+            limited = sorted(self._folded.items(), key=lambda item: -item[1])[:top]
+            return {
+                "max_keys_per_app": self.max_keys_per_app,
+                "apps": len(self._apps),
+                "max_apps": self.max_apps,
+                "evicted_apps": self.evicted_apps,
+                "interned_names": len(self.names),
+                "max_names": self.max_names,
+                "folded_keys": self.folded_keys,
+                "folded_uploads": self.folded_uploads,
+                "limited_apps": {
+                    app_id: {"keys": len(self._apps[app_id]), "folded_keys": count} for app_id, count in limited
+                },
+            }
+
+
+class ReservoirSampler:
+    """A uniform sample of at most ``size`` raw uploads per app (Vitter's Algorithm L).
+
+    Each reservoir draws the number of uploads to skip before its next
+    replacement, so once it is full most uploads cost a counter bump and
+    one comparison. With ``stratify`` an app has separate reservoirs for
+    uploads with and without errors. Rare failures then keep their own
+    samples instead of being crowded out by healthy traffic. Apps past
+    ``max_apps`` share the ``__other__`` reservoirs.
+    """
+
+    def __init__(self, size=DEFAULT_RESERVOIR_SIZE, stratify=False, max_apps=DEFAULT_MAX_SAMPLED_APPS, rng=None):
+        self.size = size
+        self.stratify = stratify
+        self.max_apps = max_apps
+        self._random = (rng or random.Random()).random
+        self._lock = threading.Lock()
+        self._strata = {}  # (appId, errors) -> [seen, next admission, w, [(seq, fragment)]]
+        self._apps = set()
+        self._seq = 0
+
+    def _skip(self, w):
+        # 1 - random() is in (0, 1], so the logs stay finite.
+        return int(math.log(1.0 - self._random()) / math.log(1.0 - w)) + 1
+
+    def extend(self, texts, records):
+        """Offer raw uploads; returns the encoded fragments of the ones admitted.
+
+        ``records[i]`` is the parsed ``texts[i]``, or None if it did not parse.
+        Only admitted uploads are encoded, so a skipped one costs no copy.
+        """
+        admitted = []
+        with self._lock:
+            for text, record in zip(texts, records):
+                self._seq += 1
+                app_id = "" if record is None else record["appId"]
+                if app_id not in self._apps:
+                    if len(self._apps) >= self.max_apps:
+                        app_id = OVERFLOW_KEY
+                    self._apps.add(app_id)
+                stratum = (app_id, has_errors(record) if self.stratify else None)
+                state = self._strata.get(stratum)
+                if state is None:
+                    state = self._strata[stratum] = [0, self.size, 1.0, []]
+                state[0] += 1
+                samples = state[3]
+                if len(samples) < self.size:
+                    fragment = json.dumps(text)
+                    samples.append((self._seq, fragment))
+                    admitted.append(fragment)
+                    if len(samples) == self.size:
+                        state[2] = math.exp(math.log(1.0 - self._random()) / self.size)
+                        state[1] = self.size + self._skip(state[2])
+                elif state[0] == state[1]:
+                    fragment = json.dumps(text)
+                    samples[int(self._random() * self.size)] = (self._seq, fragment)
+                    admitted.append(fragment)
+                    state[2] *= math.exp(math.log(1.0 - self._random()) / self.size)
+                    state[1] += self._skip(state[2])
+        return admitted
+
+    def sample(self, app_id=None, errors=None, limit=None):
+        """``(fragments oldest first, seen, kept)`` over the matching reservoirs."""
+        with self._lock:
+            picked, seen = [], 0
+            for (stratum_app, stratum_errors), state in self._strata.items():
+                if (app_id is not None and stratum_app != app_id) or (
+                        errors is not None and stratum_errors != errors):
+                    continue
+                seen += state[0]
+                picked.extend(state[3])
+        picked.sort()
+        kept = len(picked)
+        if limit is not None:
+            picked = picked[-limit:] if limit else []
+        return [fragment for _seq, fragment in picked], seen, kept
+
+    def stats(self, top=100):
+        with self._lock:
+            strata = sorted(self._strata.items(), key=lambda item: -item[1][0])
+            seen = sum(state[0] for _stratum, state in strata)
+            kept = sum(len(state[3]) for _stratum, state in strata)
+            reservoirs = {}
+            for (app_id, errors), state in strata[:top]:
+                key = app_id if errors is None else f"{app_id}/{'errors' if errors else 'ok'}"
+                reservoirs[key] = {"seen": state[0], "kept": len(state[3]),
+                                   "rate": len(state[3]) / state[0]}
+            return {
+                "size": self.size,
+                "stratify": self.stratify,
+                "apps": len(self._apps),
+                "seen": seen,
+                "kept": kept,
+                "rate": kept / seen if seen else 1.0,
+                "reservoirs": reservoirs,
+            }
+
+
+class _Postings:
+    """Row ids ordered by upload timestamp, so a time range is two bisects away.
+
+    Uploads mostly arrive in timestamp order and are appended; late ones
+    are inserted in place.
+    """
+
+    __slots__ = ("ts", "rows")
+
+    def __init__(self):
+        self.ts = array("q")
+        self.rows = array("Q")
+
+    def add(self, ts, row):
+        if not self.ts or ts >= self.ts[-1]:
+            self.ts.append(ts)
+            self.rows.append(row)
+        else:
+            at = bisect_right(self.ts, ts)
+            self.ts.insert(at, ts)
+            self.rows.insert(at, row)
+
+    def between(self, since=None, until=None):
+        lo = 0 if since is None else bisect_left(self.ts, since)
+        hi = len(self.ts) if until is None else bisect_left(self.ts, until)
+        return self.rows[lo:hi]
+
+    def prune(self, first_live):
+        """Drop ids of evicted rows (below ``first_live``)."""
+        keep = [at for at, row in enumerate(self.rows) if row >= first_live]
+        if len(keep) != len(self.rows):
+            self.ts = array("q", (self.ts[at] for at in keep))
+            self.rows = array("Q", (self.rows[at] for at in keep))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ColumnarStore:
+    """Parsed uploads held column by column for scans without re-parsing JSON.
+
+    Timestamps and latency percentiles live in typed arrays, ``appId``/``sdk``
+    are dictionary-encoded, and counters form a sparse matrix in CSR layout
+    (per-row offsets into parallel key/value arrays). Once ``max_rows`` is
+    reached the oldest eighth of the rows is evicted in one block.
+
+    Rows are also indexed by timestamp, both overall and in one posting
+    list per app, so ``query`` only touches rows inside the requested app
+    and time range.
+    """
+
+    def __init__(self, max_rows=DEFAULT_MAX_ROWS):
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self.apps = _Dictionary()
+        self.sdks = _Dictionary()
+        self.counter_names = _Dictionary()
+        self.ts = array("q")
+        self.app = array("I")
+        self.sdk = array("I")
+        self.latency = {field: array("f") for field in LATENCY_FIELDS}
+        # Absolute offset of each row's first counter cell; subtract _cell_base to index.
+        self.cell_start = array("Q")
+        self.cell_key = array("I")
+        self.cell_value = array("q")
+        self._cell_base = 0
+        self._by_time = _Postings()
+        self._by_app = {}  # app code -> _Postings; row ids count evicted rows too
+        self.rows_evicted = 0
+        self.parse_errors = 0
+
+    def ingest(self, record):
+        """Append one ``parse_upload`` record; ``None`` counts as a parse error."""
+        self.ingest_many((record,))
+
+    def ingest_many(self, records):
+        """``ingest`` for a batch, under one lock acquisition."""
+        with self._lock:
+            for record in records:
+                if record is None:
+                    self.parse_errors += 1
+                    continue
+                if len(self.ts) >= self.max_rows:
+                    self._evict(max(1, self.max_rows // 8))
+                row = self.rows_evicted + len(self.ts)
+                app = self.apps.encode(record["appId"])
+                postings = self._by_app.get(app)
+                if postings is None:
+                    postings = self._by_app[app] = _Postings()
+                postings.add(record["timestamp"], row)
+                self._by_time.add(record["timestamp"], row)
+                self.ts.append(record["timestamp"])
+                self.app.append(app)
+                self.sdk.append(self.sdks.encode(record["sdk"]))
+                latency = record["latency"] or (math.nan,) * len(LATENCY_FIELDS)
+                for field, value in zip(LATENCY_FIELDS, latency):
+                    self.latency[field].append(value)
+                self.cell_start.append(self._cell_base + len(self.cell_key))
+                for name, value in record["counters"].items():
+                    self.cell_key.append(self.counter_names.encode(name))
+                    self.cell_value.append(value)
+
+    def _evict(self, rows):
+        rows = min(rows, len(self.ts))
+        cut = (self.cell_start[rows] - self._cell_base) if rows < len(self.ts) else len(self.cell_key)
+        for column in (self.ts, self.app, self.sdk, self.cell_start, *self.latency.values()):
+            del column[:rows]
+        del self.cell_key[:cut]
+        del self.cell_value[:cut]
+        self._cell_base += cut
+        self.rows_evicted += rows
+        for postings in (self._by_time, *self._by_app.values()):
+            postings.prune(self.rows_evicted)
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def next_row(self):
+        """Id the next ingested row will get; ids keep counting across evictions."""
+        return self.rows_evicted + len(self.ts)
+
+    def expire(self, before_row):
+        """Evict every row with an id below ``before_row``; returns how many went."""
+        with self._lock:
+            rows = min(len(self.ts), before_row - self.rows_evicted)
+            if rows <= 0:
+                return 0
+            self._evict(rows)
+            return rows
+
+    def _rows(self, app_id, sdk, since, until):
+        """Row indexes matching the filters, or None when every row matches."""
+        if app_id is None and sdk is None and since is None and until is None:
+            return None
+        rows = range(len(self.ts))
+        if app_id is not None:
+            code = self.apps.ids.get(app_id)
+            if code is None:
+                return []
+            rows = [i for i in rows if self.app[i] == code]
+        if sdk is not None:
+            code = self.sdks.ids.get(sdk)
+            if code is None:
+                return []
+            rows = [i for i in rows if self.sdk[i] == code]
+        if since is not None:
+            rows = [i for i in rows if self.ts[i] >= since]
+        if until is not None:
+            rows = [i for i in rows if self.ts[i] < until]
+        return rows
+
+    def summary(self, app_id=None, sdk=None, since=None, until=None):
+        """Counter totals and mean percentiles over the matching rows."""
+        with self._lock:
+            rows = self._rows(app_id, sdk, since, until)
+            sums = {}
+            if rows is None:
+                for key, value in zip(self.cell_key, self.cell_value):
+                    sums[key] = sums.get(key, 0) + value
+                rows = range(len(self.ts))
+            else:
+                total_cells, base = len(self.cell_key), self._cell_base
+                for i in rows:
+                    end = self.cell_start[i + 1] - base if i + 1 < len(self.ts) else total_cells
+                    for j in range(self.cell_start[i] - base, end):
+                        key = self.cell_key[j]
+                        sums[key] = sums.get(key, 0) + self.cell_value[j]
+            samples, totals, worst = 0, dict.fromkeys(LATENCY_FIELDS, 0.0), 0.0
+            columns = [self.latency[field] for field in LATENCY_FIELDS]
+            for i in rows:
+                values = [column[i] for column in columns]
+                if any(math.isnan(value) for value in values):
+                    continue
+                samples += 1
+                for field, value in zip(LATENCY_FIELDS, values):
+                    totals[field] += value
+                worst = max(worst, values[-1])
+            names = self.counter_names.values
+            return {
+                "rows": len(rows),
+                "counters": {names[key]: value for key, value in sums.items()},
+                "latency": {
+                    "samples": samples,
+                    **{f"{field}_mean": (totals[field] / samples if samples else None) for field in LATENCY_FIELDS},
+                    "p99_max": worst if samples else None,
+                },
+            }
+
+    def query(self, app_id=None, sdk=None, since=None, until=None, prefix=""):
+        """Sum and count counters whose names start with ``prefix`` over the matching rows.
+
+        Candidates come from the app's posting list (or the overall time
+        index) cut to ``[since, until)``, so the cost follows the rows in
+        range rather than the whole store. ``scanned`` reports how many
+        rows were looked at.
+        """
+        result = {"rows": 0, "scanned": 0, "first_ts": None, "last_ts": None, "sums": {}, "counts": {}}
+        with self._lock:
+            if app_id is None:
+                postings = self._by_time
+            else:
+                code = self.apps.ids.get(app_id)
+                postings = self._by_app.get(code) if code is not None else None
+                if postings is None:
+                    return result
+            sdk_code = None
+            if sdk is not None:
+                sdk_code = self.sdks.ids.get(sdk)
+                if sdk_code is None:
+                    return result
+            names = self.counter_names.values
+            wanted = {code for code, name in enumerate(names) if name.startswith(prefix)} if prefix else None
+            candidates = postings.between(since, until)
+            sums, counts = {}, {}
+            rows, first, last = 0, None, None
+            base, cell_base, total = self.rows_evicted, self._cell_base, len(self.ts)
+            for row in candidates:
+                i = row - base
+                if sdk_code is not None and self.sdk[i] != sdk_code:
+                    continue
+                rows += 1
+                ts = self.ts[i]
+                first = ts if first is None or ts < first else first
+                last = ts if last is None or ts > last else last
+                end = self.cell_start[i + 1] - cell_base if i + 1 < total else len(self.cell_key)
+                for j in range(self.cell_start[i] - cell_base, end):
+                    key = self.cell_key[j]
+                    if wanted is None or key in wanted:
+                        sums[key] = sums.get(key, 0) + self.cell_value[j]
+                        counts[key] = counts.get(key, 0) + 1
+            result.update(
+                rows=rows,
+                scanned=len(candidates),
+                first_ts=first,
+                last_ts=last,
+                sums={names[key]: value for key, value in sums.items()},
+                counts={names[key]: value for key, value in counts.items()},
+            )
+            return result
+
+    def stats(self):
+        with self._lock:
+            columns = (self.ts, self.app, self.sdk, self.cell_start, self.cell_key, self.cell_value,
+                       *self.latency.values())
+            memory = sum(len(column) * column.itemsize for column in columns)
+            return {
+                "rows": len(self.ts),
+                "max_rows": self.max_rows,
+                "rows_evicted": self.rows_evicted,
+                "parse_errors": self.parse_errors,
+                "counter_cells": len(self.cell_key),
+                "column_bytes": memory,
+                "bytes_per_row": round(memory / len(self.ts), 1) if self.ts else 0,
+                "apps": len(self.apps),
+                "sdks": len(self.sdks),
+                "counter_names": len(self.counter_names),
+                "posting_lists": len(self._by_app),
+                "index_bytes": sum(len(postings) * 16 for postings in (self._by_time, *self._by_app.values())),
+            }
+
+
+def merge_queries(parts):
+    """Combine ``ColumnarStore.query`` results from several workers."""
+    merged = {"rows": 0, "scanned": 0, "first_ts": None, "last_ts": None, "sums": {}, "counts": {}, "latency": {}}
+    for part in parts:
+        merged["rows"] += part["rows"]
+        merged["scanned"] += part["scanned"]
+        if part["first_ts"] is not None:
+            merged["first_ts"] = part["first_ts"] if merged["first_ts"] is None else min(merged["first_ts"], part["first_ts"])
+            merged["last_ts"] = part["last_ts"] if merged["last_ts"] is None else max(merged["last_ts"], part["last_ts"])
+        for field in ("sums", "counts", "latency"):
+            for name, value in part.get(field, {}).items():
+                merged[field][name] = merged[field].get(name, 0) + value
+        if "tiers" in part:
+            merged.setdefault("tiers", part["tiers"])
+    return merged
+
+
+def merge_summaries(parts):
+    """Combine ``ColumnarStore.summary`` results from several workers."""
+    merged = {"rows": 0, "counters": {}, "latency": {"samples": 0}}
+    totals, worst = dict.fromkeys(LATENCY_FIELDS, 0.0), None
+    for part in parts:
+        merged["rows"] += part["rows"]
+        for name, value in part["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+        samples = part["latency"]["samples"]
+        if samples:
+            merged["latency"]["samples"] += samples
+            for field in LATENCY_FIELDS:
+                totals[field] += part["latency"][f"{field}_mean"] * samples
+            worst = max(worst or 0.0, part["latency"]["p99_max"])
+    samples = merged["latency"]["samples"]
+    for field in LATENCY_FIELDS:
+        merged["latency"][f"{field}_mean"] = totals[field] / samples if samples else None
+    merged["latency"]["p99_max"] = worst
+    return merged
@@ -1,84 +1,1627 @@
 #!/usr/bin/env python3
 """Simple dev backend stub for tvOS metrics testing."""
 
+import argparse
+import asyncio
+import functools
+import hashlib
+import http.client
 import json
+import multiprocessing
 import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+from email.utils import formatdate
+from http import HTTPStatus
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from metrics_aggregates import (
+    DEFAULT_QUANTILES,
+    WINDOWS,
+    CounterTotals,
+    LatencyAggregator,
+    WindowAggregator,
+    merge_counts,
+    render_group,
+    render_latency,
+)
+from metrics_exposition import CONTENT_TYPE as EXPOSITION_CONTENT_TYPE, Exposition
+from metrics_ingest import DEFAULT_INGEST_BATCH, DEFAULT_INGEST_WORKERS, DEFAULT_QUEUE_DEPTH, IngestQueue
+from metrics_log import DEFAULT_MAX_SEGMENTS, DEFAULT_SEGMENT_BYTES, SegmentLog
+from metrics_retention import DEFAULT_COMPACT_INTERVAL, TIERS as RETENTION_TIERS, RetentionManager
+from metrics_sqlite import SqliteStore
+from stub_auction import TRACKING_EVENTS, AuctionEngine, load_config as load_auction_config, render_stats
+from stub_faults import DelayScheduler, Fault, FaultInjector, load_config as load_fault_config
+from metrics_store import (
+    DEFAULT_MAX_BYTES,
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_MAX_ROWS,
+    DEFAULT_DEDUP_KEYS,
+    DEFAULT_MAX_KEYS_PER_APP,
+    CardinalityGuard,
+    ColumnarStore,
+    DedupWindow,
+    RingStore,
+    ReservoirSampler,
+    iter_batch,
+    merge_queries,
+    merge_summaries,
+    parse_upload,
+    upload_key,
+)
 
 STATE = {
-    "metrics_enabled": os.environ.get("METRICS_ENABLED", "false").lower() in {"1", "true", "yes"},
-    "metrics": [],
+    # Shared memory, so a toggle handled by one worker process is seen by all of them.
+    "metrics_enabled": multiprocessing.RawValue(
+        "b", os.environ.get("METRICS_ENABLED", "false").lower() in {"1", "true", "yes"}
+    ),
+    # Bumped on every config change so ConfigManager adopts the new payload.
+    "config_version": multiprocessing.Value("q", 1),
+    "metrics": RingStore(
+        int(os.environ.get("METRICS_STUB_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+        int(os.environ.get("METRICS_STUB_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    ),
+    # The same uploads parsed into typed columns for aggregate queries.
+    "columns": ColumnarStore(int(os.environ.get("METRICS_STUB_MAX_ROWS", DEFAULT_MAX_ROWS))),
+    # Live 1m/5m/1h counter totals per app and per SDK.
+    "aggregates": WindowAggregator(),
+    # Mergeable request_latency_ms distributions over the same windows.
+    "latency": LatencyAggregator(),
+    # Optional SegmentLog persisting every upload; see --log-dir.
+    "log": None,
+    # Optional ReservoirSampler keeping raw uploads for /admin/metrics_log
+    # (and the ring and log) instead of every one; see --sample-reservoir.
+    "sampler": None,
+    # Never-expiring counter sums behind /metrics.
+    "totals": CounterTotals(),
+    # Optional RetentionManager (raw rows, 1m and 1h rollups); see --retention.
+    "retention": None,
+    # Optional SqliteStore holding every parsed upload; see --sqlite.
+    "sqlite": None,
+    # CardinalityGuard applied before parsed uploads reach the columns and
+    # aggregates; None disables it (--max-counter-keys 0).
+    "cardinality": CardinalityGuard(),
+    # DedupWindow of recent upload keys; None disables dedup (--dedup-keys 0).
+    "dedup": DedupWindow(),
+    # IngestQueue feeding /api/v1/sdk/metrics bodies to background threads;
+    # None stores them on the request thread (--ingest-workers 0).
+    "ingest": None,
+    # Optional AuctionEngine answering /api/v1/rtb/bid and /pod; None always answers 204 (see --auction).
+    "auction": None,
+    # Optional FaultInjector delaying or breaking non-admin responses; see --faults.
+    "faults": None,
+    # DelayScheduler that sends the threaded engine's delayed responses
+    # (injected latency and auction fan-out time).
+    "timer": None,
+    # Uploads stored by any worker; waiters in other processes watch it change.
+    "upload_count": multiprocessing.RawValue("q", 0),
 }
 
+# Callables invoked after every stored upload (wakes long-poll and SSE waiters).
+LISTENERS = set()
+
+# Prometheus rendering of /metrics; see --metrics-cache-seconds.
+EXPOSITION = Exposition()
+# (method, route, status) -> [requests, seconds spent in dispatch]
+REQUEST_STATS = {}
+_REQUEST_LOCK = threading.Lock()
+
+# ``(version, payload, etag)`` for STATE["config_version"]; rebuilt only when the version moves.
+CONFIG_CACHE = {"entry": (None, None, None)}
+CONFIG_STATS = {"requests": 0, "not_modified": 0, "bytes_sent": 0}
+_CONFIG_LOCK = threading.Lock()
+
+# Filled in for --workers mode: this worker's index and every worker's private admin port.
+WORKER = {"index": None, "admin_ports": None}
+
+ENGINES = ("threaded", "asyncio")
+IDLE_TIMEOUT = float(os.environ.get("METRICS_STUB_IDLE_TIMEOUT", "15"))
+# Batch responses list at most this many rejected item indexes.
+MAX_REPORTED_REJECTS = 100
+
+
+def config_snapshot():
+    """Return ``(payload, etag)`` for the current config, re-encoding only after a change."""
+    version = STATE["config_version"].value
+    entry = CONFIG_CACHE["entry"]
+    if entry[0] != version:
+        body = {
+            "version": version,
+            "rolloutPercent": 100,
+            "features": {
+                "killSwitch": False,
+                "disableShow": False,
+                "metricsEnabled": bool(STATE["metrics_enabled"].value),
+            },
+            "placements": {},
+        }
+        payload = json.dumps(body).encode("utf-8")
+        etag = f'"v{version}-{hashlib.sha1(payload).hexdigest()[:16]}"'
+        # Swapped in as one tuple so concurrent readers never see a torn entry.
+        entry = CONFIG_CACHE["entry"] = (version, payload, etag)
+    return entry[1], entry[2]
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def set_metrics_enabled(value):
+    with STATE["config_version"].get_lock():
+        if bool(STATE["metrics_enabled"].value) != value:
+            STATE["metrics_enabled"].value = value
+            STATE["config_version"].value += 1
+
+
+def route_get(parsed, headers):
+    """Return ``(status, payload, content_type[, headers])`` for a GET request."""
+    if parsed.path == "/metrics":
+        if parse_qs(parsed.query).get("format") == ["samples"]:
+            return 200, json.dumps(exposition_state()).encode("utf-8"), "application/json"
+        fan_out = fans_out(parsed)
+        body = EXPOSITION.cached(fan_out)
+        if body is None:
+            body = EXPOSITION.render(exposition_samples(fan_out), fan_out)
+        return 200, body, EXPOSITION_CONTENT_TYPE
+    if parsed.path == "/api/v1/sdk/config":
+        payload, etag = config_snapshot()
+        extra = [("ETag", etag), ("Cache-Control", "no-cache")]
+        not_modified = etag_matches(headers.get("if-none-match"), etag)
+        with _CONFIG_LOCK:
+            CONFIG_STATS["requests"] += 1
+            if not_modified:
+                CONFIG_STATS["not_modified"] += 1
+            else:
+                CONFIG_STATS["bytes_sent"] += len(payload)
+        if not_modified:
+            return 304, None, "application/json", extra
+        return 200, payload, "application/json", extra
+    if parsed.path == "/admin/config_stats":
+        with _CONFIG_LOCK:
+            stats = dict(CONFIG_STATS)
+        if fans_out(parsed):
+            stats = gather_sum(parsed.path, stats)
+        stats["version"] = STATE["config_version"].value
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/metrics/wait" or parsed.path == "/admin/metrics/stream":
+        params = parse_qs(parsed.query)
+        stream = parsed.path.endswith("/stream")
+        cursor = params.get("after", [""])[0] or headers.get("last-event-id") or "now"
+        try:
+            if cursor != "now":
+                [int(part) for part in cursor.split(",") if part]
+            limit = int(params["limit"][0]) if "limit" in params else None
+            if "timeout" in params:
+                timeout = min(max(float(params["timeout"][0]), 0.0), MetricsWaiter.MAX_TIMEOUT)
+            else:
+                timeout = None if stream else MetricsWaiter.DEFAULT_TIMEOUT
+        except ValueError as exc:
+            return 400, json.dumps({"error": f"bad wait parameter: {exc}"}).encode("utf-8"), "application/json"
+        waiter = MetricsWaiter(parsed, cursor, limit, timeout, stream)
+        if stream:
+            return 200, waiter, "text/event-stream", [("Cache-Control", "no-cache")]
+        return 200, waiter, "application/json"
+    if parsed.path == "/admin/metrics_log" and STATE["sampler"] is not None:
+        return sampled_log(parsed)
+    if parsed.path == "/admin/metrics" or parsed.path == "/admin/metrics_log":
+        # /admin/metrics_log reads the on-disk segments when persistence is on.
+        if parsed.path == "/admin/metrics_log" and STATE["log"] is not None:
+            return paged_response(parsed, STATE["log"], since_ts=True)
+        return paged_response(parsed, STATE["metrics"])
+    if parsed.path == "/admin/metrics/summary":
+        params = parse_qs(parsed.query)
+        source = params.get("source", ["columns"])[0]
+        if source not in ("columns", "sqlite"):
+            return 400, json.dumps({"error": "source must be columns or sqlite"}).encode("utf-8"), "application/json"
+        if source == "sqlite" and STATE["sqlite"] is None:
+            return 404, json.dumps({"error": "sqlite is off; start with --sqlite"}).encode("utf-8"), "application/json"
+        try:
+            since = int(params["since"][0]) if "since" in params else None
+            until = int(params["until"][0]) if "until" in params else None
+        except ValueError:
+            return 400, json.dumps({"error": "since and until must be epoch milliseconds"}).encode("utf-8"), "application/json"
+
+        def local():
+            store = STATE[source]
+            summary = store.summary(
+                app_id=params.get("appId", [None])[0],
+                sdk=params.get("sdk", [None])[0],
+                since=since,
+                until=until,
+            )
+            summary["store"] = [store.stats()]
+            return summary
+
+        if fans_out(parsed):
+            parts = gather(f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path, local)
+            summary = merge_summaries(parts)
+            summary["store"] = [stats for part in parts for stats in part["store"]]
+        else:
+            summary = local()
+        return 200, json.dumps(summary).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/metrics/query":
+        return metrics_query(parsed)
+    if parsed.path == "/admin/aggregates":
+        params = parse_qs(parsed.query)
+        windows = params.get("window")
+        if windows and not set(windows) <= set(WINDOWS):
+            return 400, json.dumps({"error": f"window must be one of {sorted(WINDOWS)}"}).encode("utf-8"), "application/json"
+        modes = params.get("mode") or ("sliding", "tumbling")
+        snapshot = STATE["aggregates"].snapshot(windows, modes)
+        if fans_out(parsed):
+            merged = {}
+            for part in gather(f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path, lambda: snapshot):
+                merge_counts(merged, part)
+            snapshot = merged
+        return 200, json.dumps(snapshot).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/latency":
+        params = parse_qs(parsed.query)
+        windows = params.get("window")
+        if windows and not set(windows) <= set(WINDOWS):
+            return 400, json.dumps({"error": f"window must be one of {sorted(WINDOWS)}"}).encode("utf-8"), "application/json"
+        try:
+            quantiles = [float(q) for q in params["q"][0].split(",")] if "q" in params else DEFAULT_QUANTILES
+        except ValueError:
+            return 400, json.dumps({"error": "q must be a comma-separated list of fractions"}).encode("utf-8"), "application/json"
+        if params.get("raw") == ["1"]:
+            return 200, json.dumps(STATE["latency"].latency(windows, raw=True)).encode("utf-8"), "application/json"
+        if fans_out(parsed):
+            merged = {}
+            query = "&".join(f"window={w}" for w in windows or ()) + "&raw=1"
+            for part in gather(f"{parsed.path}?{query}", lambda: STATE["latency"].latency(windows, raw=True)):
+                merge_counts(merged, part)
+            report = render_latency(merged, quantiles)
+        else:
+            report = STATE["latency"].latency(windows, quantiles)
+        return 200, json.dumps(report).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/metrics_stats":
+        stats = STATE["metrics"].stats()
+        if fans_out(parsed):
+            stats = gather_sum(parsed.path, stats)
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/cardinality":
+        if STATE["cardinality"] is None:
+            return 404, json.dumps({"error": "the cardinality guard is off; start with --max-counter-keys > 0"}).encode("utf-8"), "application/json"
+        stats = STATE["cardinality"].stats()
+        if fans_out(parsed):
+            stats = {"workers": gather(parsed.path, lambda: stats)}
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/dedup_stats":
+        if STATE["dedup"] is None:
+            return 404, json.dumps({"error": "dedup is off; start with --dedup-keys > 0"}).encode("utf-8"), "application/json"
+        stats = STATE["dedup"].stats()
+        if fans_out(parsed):
+            stats = gather_sum(parsed.path, stats)
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/ingest_stats":
+        if STATE["ingest"] is None:
+            return 404, json.dumps({"error": "the ingest queue is off; uploads are stored inline"}).encode("utf-8"), "application/json"
+        stats = STATE["ingest"].stats()
+        if fans_out(parsed):
+            stats = gather_sum(parsed.path, stats)
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/retention":
+        if STATE["retention"] is None:
+            return 404, json.dumps({"error": "rollup tiers are off; start with --retention"}).encode("utf-8"), "application/json"
+        stats = STATE["retention"].stats()
+        if fans_out(parsed):
+            stats = {"workers": gather(parsed.path, lambda: stats)}
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/sqlite_stats":
+        if STATE["sqlite"] is None:
+            return 404, json.dumps({"error": "sqlite is off; start with --sqlite"}).encode("utf-8"), "application/json"
+        stats = STATE["sqlite"].stats()
+        if fans_out(parsed):
+            stats = {"workers": gather(parsed.path, lambda: stats)}
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/sampling":
+        if STATE["sampler"] is None:
+            return 404, json.dumps({"error": "sampling is off; start with --sample-reservoir > 0"}).encode("utf-8"), "application/json"
+        stats = STATE["sampler"].stats()
+        if fans_out(parsed):
+            stats = {"workers": gather(parsed.path, lambda: stats)}
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/faults":
+        if STATE["faults"] is None:
+            return 404, json.dumps({"error": "fault injection is off; start with --faults"}).encode("utf-8"), "application/json"
+        stats = {"rules": STATE["faults"].stats(), "timer": STATE["timer"].stats()}
+        if fans_out(parsed):
+            stats = {"workers": gather(parsed.path, lambda: stats)}
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/auction_stats":
+        if STATE["auction"] is None:
+            return 404, json.dumps({"error": "the auction engine is off; start with --auction"}).encode("utf-8"), "application/json"
+        stats = STATE["auction"].stats()
+        if parse_qs(parsed.query).get("raw") == ["1"]:
+            return 200, json.dumps(stats).encode("utf-8"), "application/json"
+        if fans_out(parsed):
+            merged = {}
+            for part in gather(f"{parsed.path}?raw=1", lambda: stats):
+                merge_counts(merged, part)
+            stats = merged
+        return 200, json.dumps(render_stats(stats)).encode("utf-8"), "application/json"
+    if parsed.path.startswith("/api/v1/track/"):
+        # Beacons from the tracking URLs in AuctionWin responses.
+        if STATE["auction"] is None or not STATE["auction"].track(parsed.path[len("/api/v1/track/"):]):
+            return 404, b"{}", "application/json"
+        return 204, None, "application/json"
+    if parsed.path == "/admin/metrics_log_stats":
+        if STATE["log"] is None:
+            return 404, json.dumps({"error": "persistence is off; start with --log-dir"}).encode("utf-8"), "application/json"
+        stats = STATE["log"].stats()
+        if fans_out(parsed):
+            stats = {"workers": gather(parsed.path, lambda: stats)}
+        return 200, json.dumps(stats).encode("utf-8"), "application/json"
+    return 404, b"{}", "application/json"
+
+
+QUERY_AGGREGATIONS = ("sum", "count", "rate")
+QUERY_TIERS = ("auto", "raw", *RETENTION_TIERS)
+
+
+def metrics_query(parsed):
+    """``/admin/metrics/query``: counter sum/count/rate over the columnar store's indexes.
+
+    Filters: ``appId``, ``sdk``, ``since``/``until`` (ms, half-open) and
+    ``prefix`` on counter names; ``agg`` picks any of sum, count and rate.
+    Rates are per second over ``[since, until)`` when both are given,
+    otherwise over the span between the first and last matching upload.
+    With --retention, ``tier=auto`` (the default) serves each part of the
+    range from the coarsest tier that holds it; ``raw``, ``1m`` and ``1h``
+    force one tier.
+    """
+    params = parse_qs(parsed.query)
+    aggregations = [name for value in params.get("agg", ["sum"]) for name in value.split(",")]
+    if not set(aggregations) <= set(QUERY_AGGREGATIONS):
+        return 400, json.dumps({"error": f"agg must be among {list(QUERY_AGGREGATIONS)}"}).encode("utf-8"), "application/json"
+    try:
+        since = int(params["since"][0]) if "since" in params else None
+        until = int(params["until"][0]) if "until" in params else None
+    except ValueError:
+        return 400, json.dumps({"error": "since and until must be epoch milliseconds"}).encode("utf-8"), "application/json"
+    tier = params.get("tier", ["auto"])[0]
+    if tier not in QUERY_TIERS:
+        return 400, json.dumps({"error": f"tier must be one of {list(QUERY_TIERS)}"}).encode("utf-8"), "application/json"
+    retention = STATE["retention"]
+    if retention is None and tier not in ("auto", "raw"):
+        return 404, json.dumps({"error": "rollup tiers are off; start with --retention"}).encode("utf-8"), "application/json"
+    filters = {"app_id": params.get("appId", [None])[0], "sdk": params.get("sdk", [None])[0],
+               "prefix": params.get("prefix", [""])[0]}
+
+    def local():
+        if retention is None or tier == "raw":
+            pieces = [("raw", since, until)]
+        elif tier == "auto":
+            pieces = retention.plan(since, until)
+        else:
+            pieces = [(tier, since, until)]
+        parts = [
+            STATE["columns"].query(since=low, until=high, **filters) if name == "raw"
+            else retention.query(name, since=low, until=high, **filters)
+            for name, low, high in pieces
+        ]
+        result = merge_queries(parts)
+        result["tiers"] = [{"tier": name, "since": low, "until": high} for name, low, high in pieces]
+        return result
+
+    if fans_out(parsed):
+        result = merge_queries(gather(f"{parsed.path}?{parsed.query}&raw=1" if parsed.query else f"{parsed.path}?raw=1", local))
+    else:
+        result = local()
+    if params.get("raw") == ["1"]:
+        return 200, json.dumps(result).encode("utf-8"), "application/json"
+    report = {
+        "rows": result["rows"],
+        "scanned": result["scanned"],
+        "range": {"since": since, "until": until, "first_ts": result["first_ts"], "last_ts": result["last_ts"]},
+        "tiers": result["tiers"],
+    }
+    if result["latency"]:
+        report["latency"] = render_group(result["latency"])
+    if "sum" in aggregations:
+        report["sum"] = result["sums"]
+    if "count" in aggregations:
+        report["count"] = {"uploads": result["rows"], "counters": result["counts"]}
+    if "rate" in aggregations:
+        if since is not None and until is not None:
+            span = (until - since) / 1000
+        elif result["first_ts"] is not None:
+            span = (result["last_ts"] - result["first_ts"]) / 1000
+        else:
+            span = 0
+        report["rate"] = {"seconds": span, "per_second": {
+            name: value / span for name, value in result["sums"].items()} if span > 0 else {}}
+    return 200, json.dumps(report).encode("utf-8"), "application/json"
+
+
+def record_upload(text, idempotency_key=None):
+    """Store one metrics upload: raw in the ring buffer, parsed into columns and aggregates."""
+    stored, _duplicates = store_uploads([text], [parse_upload(text)], [idempotency_key])
+    print(f"[metrics] {text}" if stored else f"[metrics] duplicate {text}")
+
+
+def ingest_bodies(items):
+    """IngestQueue sink: store queued ``(body, idempotency key)`` uploads; returns how many failed.
+
+    Each upload is parsed and stored on its own, so one that raises is the
+    only one lost; every upload here was already answered with 200.
+    """
+    lines, duplicates, failed = [], 0, 0
+    for body, key in items:
+        text = body.decode("utf-8", errors="replace")
+        try:
+            stored, dropped = store_uploads([text], [parse_upload(text)], [key])
+            if stored:
+                lines.append(f"[metrics] {text}")
+            duplicates += dropped
+        except Exception:  # count this upload as failed and keep going with the rest
+            traceback.print_exc()
+            failed += 1
+    if duplicates:
+        lines.append(f"[metrics] dropped {duplicates} duplicate uploads")
+    if lines:
+        print("\n".join(lines))
+    return failed
+
+
+def drop_duplicates(texts, records, keys):
+    """Filter out uploads already in the dedup window; returns ``(texts, records, claimed)``.
+
+    ``keys`` holds each upload's idempotency key, or None to dedup on content.
+    The digests of the kept uploads are recorded in the window right away,
+    so concurrent retries still collapse to one, and returned as ``claimed``.
+    """
+    window = STATE["dedup"]
+    if window is None:
+        return texts, records, []
+    kept_texts, kept_records, claimed = [], [], []
+    for text, record, key in zip(texts, records, keys):
+        digest = upload_key(record, key)
+        if digest is None or not window.seen(digest):
+            kept_texts.append(text)
+            kept_records.append(record)
+            if digest is not None:
+                claimed.append(digest)
+    return kept_texts, kept_records, claimed
+
+
+def store_uploads(texts, records, keys):
+    """Store the uploads not already seen; returns ``(stored texts, duplicates)``.
+
+    If storing raises, the keys claimed for the batch are released before
+    the error propagates, so a retry of a failed upload is stored instead
+    of being dropped as a duplicate.
+    """
+    kept_texts, kept_records, claimed = drop_duplicates(texts, records, keys)
+    if kept_texts:
+        try:
+            record_uploads(kept_texts, kept_records)
+        except Exception:
+            if claimed:
+                STATE["dedup"].forget(claimed)
+            raise
+    return kept_texts, len(texts) - len(kept_texts)
+
+
+def record_uploads(texts, records):
+    """Store a batch of uploads, taking each store's lock once; ``records[i]`` parses ``texts[i]``."""
+    if STATE["sampler"] is None:
+        fragments = STATE["metrics"].extend(texts)
+    else:
+        # Sampling thins the raw copies before they are encoded: only admitted
+        # uploads reach the ring and the log. Every record below is still aggregated.
+        fragments = STATE["sampler"].extend(texts, records)
+        STATE["metrics"].extend_encoded(fragments)
+    if STATE["log"] is not None and fragments:
+        STATE["log"].extend(fragments)
+    guard = STATE["cardinality"]
+    if guard is not None:
+        records = [guard.apply(record) if record is not None else None for record in records]
+    STATE["columns"].ingest_many(records)
+    if STATE["sqlite"] is not None:
+        STATE["sqlite"].ingest_many(records)
+    parsed = [record for record in records if record is not None]
+    STATE["totals"].add_many(parsed)
+    if STATE["retention"] is not None:
+        STATE["retention"].add_many(parsed)
+    STATE["aggregates"].add_many(parsed)
+    STATE["latency"].add_many(parsed)
+    STATE["upload_count"].value += len(texts)
+    for listener in list(LISTENERS):
+        listener()
+
+
+def record_batch(body, idempotency_key=None):
+    """Handle a ``/api/v1/sdk/metrics/batch`` body; returns ``(status, report)``.
+
+    Items that are not metrics payloads are rejected and reported by index;
+    the rest are committed together. A body that cannot be split into items
+    is rejected as a whole. A batch-level idempotency key is extended with
+    each item's index, so replaying the same batch drops every item.
+    """
+    texts, records, rejected = [], [], []
+    try:
+        for index, (text, record) in enumerate(iter_batch(body.decode("utf-8"))):
+            if record is None:
+                rejected.append(index)
+            else:
+                texts.append(text)
+                records.append(record)
+    except (UnicodeDecodeError, ValueError) as exc:
+        return 400, {"accepted": 0, "rejected": len(texts) + len(rejected), "error": str(exc)}
+    accepted = len(texts)
+    keys = [None] * accepted
+    if idempotency_key:
+        keys = [f"{idempotency_key}#{index}" for index in range(accepted)]
+    _stored, duplicates = store_uploads(texts, records, keys)
+    print(f"[metrics] batch accepted={accepted} rejected={len(rejected)} duplicates={duplicates}")
+    report = {"accepted": accepted, "rejected": len(rejected), "duplicates": duplicates}
+    if rejected:
+        report["rejected_items"] = rejected[:MAX_REPORTED_REJECTS]
+    return 200, report
+
+
+class MetricsWaiter:
+    """A parked ``/admin/metrics/wait`` (long-poll) or ``/admin/metrics/stream`` (SSE) request.
+
+    Engines resolve it with ``wait_blocking`` (threaded) or ``wait_async``
+    (asyncio); both are woken through LISTENERS the moment an upload is
+    stored. Uploads stored by other workers cannot reach LISTENERS, so in
+    --workers mode the shared upload counter is also checked every TICK.
+    Any stored upload answers a waiter, even one that never reaches the
+    ring (--sample-reservoir keeps only admitted uploads there); it then
+    gets an empty page, or an SSE keep-alive.
+    """
+
+    DEFAULT_TIMEOUT = 30.0
+    MAX_TIMEOUT = 300.0
+    HEARTBEAT = 15.0
+    TICK = 0.05
+
+    def __init__(self, parsed, cursor, limit, timeout, stream):
+        self.local = parse_qs(parsed.query).get("scope") == ["local"]
+        self.cursor = cursor
+        self.limit = limit
+        self.timeout = timeout
+        self.stream = stream
+        self._seen = None
+
+    def poll(self):
+        """Entries past the cursor (advancing it), or None while nothing new is stored."""
+        seen = STATE["upload_count"].value
+        if seen == self._seen:
+            return None
+        # The first look only answers with entries already past the cursor.
+        first = self._seen is None
+        self._seen = seen
+        query = {"since": self.cursor}
+        if self.limit is not None:
+            query["limit"] = self.limit
+        if self.local:
+            query["scope"] = "local"
+        status, body, _content_type, headers = paged_response(
+            urlparse(f"/admin/metrics?{urlencode(query)}"), STATE["metrics"]
+        )
+        if status != 200:
+            return None
+        entries = json.loads(body if isinstance(body, bytes) else b"".join(body))
+        self.cursor = dict(headers)["X-Next-Cursor"]
+        if self.limit is not None and len(entries) >= self.limit:
+            self._seen = None  # a full page: more may be waiting
+        return None if first and not entries else entries
+
+    def _nap(self, remaining):
+        return min(remaining, self.TICK) if WORKER["admin_ports"] is not None else remaining
+
+    def wait_blocking(self, timeout):
+        event = threading.Event()
+        listener = event.set
+        LISTENERS.add(listener)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                event.clear()
+                entries = self.poll()
+                remaining = deadline - time.monotonic()
+                if entries is not None or remaining <= 0:
+                    return entries or []
+                event.wait(self._nap(remaining))
+        finally:
+            LISTENERS.discard(listener)
+
+    async def wait_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(event.set)
+
+        LISTENERS.add(listener)
+        try:
+            deadline = loop.time() + timeout
+            while True:
+                event.clear()
+                if WORKER["admin_ports"] is not None:
+                    entries = await loop.run_in_executor(None, self.poll)  # peer fan-out blocks
+                else:
+                    entries = self.poll()
+                remaining = deadline - loop.time()
+                if entries is not None or remaining <= 0:
+                    return entries or []
+                try:
+                    await asyncio.wait_for(event.wait(), self._nap(remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            LISTENERS.discard(listener)
+
+    def respond(self, entries):
+        return 200, json.dumps(entries).encode("utf-8"), "application/json", [("X-Next-Cursor", self.cursor)]
+
+    def _events(self, entries):
+        if not entries:
+            return b": keep-alive\n\n"
+        events = [f"data: {json.dumps(entry)}\n\n" for entry in entries]
+        events[-1] = f"id: {self.cursor}\n" + events[-1]
+        return "".join(events).encode("utf-8")
+
+    def _slice(self, end, now):
+        return self.HEARTBEAT if end is None else min(self.HEARTBEAT, end - now)
+
+    def events_blocking(self):
+        end = None if self.timeout is None else time.monotonic() + self.timeout
+        yield b"retry: 1000\n\n"
+        while end is None or time.monotonic() < end:
+            yield self._events(self.wait_blocking(self._slice(end, time.monotonic())))
+
+    async def events_async(self):
+        loop = asyncio.get_running_loop()
+        end = None if self.timeout is None else loop.time() + self.timeout
+        yield b"retry: 1000\n\n"
+        while end is None or loop.time() < end:
+            yield self._events(await self.wait_async(self._slice(end, loop.time())))
+
+
+def route_post(parsed, headers, body):
+    """Return ``(status, payload, content_type[, headers])`` for a POST request."""
+    if parsed.path in ("/api/v1/rtb/bid", "/api/v1/rtb/pod"):
+        if STATE["auction"] is None:
+            # Without --auction, always respond no-fill to keep flows simple.
+            return 204, None, "application/json"
+        auction = STATE["auction"]
+        status, payload, delay = (auction.bid if parsed.path == "/api/v1/rtb/bid" else auction.pod)(body)
+        return status, Delayed(payload, delay) if delay else payload, "application/json"
+    if parsed.path == "/api/v1/sdk/metrics":
+        queue = STATE["ingest"]
+        key = headers.get("idempotency-key")
+        if queue is None:
+            record_upload(body.decode("utf-8") if body else "", key)
+        elif not queue.offer((body or b"", key)):
+            # 429 asks the client to back off; 503 means this process is shutting down.
+            status, error = (503, "ingest is shutting down") if queue.closed else (429, "ingest queue is full")
+            return status, json.dumps({"error": error}).encode("utf-8"), "application/json", [("Retry-After", "1")]
+        return 200, b"{}", "application/json"
+    if parsed.path == "/api/v1/sdk/metrics/batch":
+        status, report = record_batch(body or b"", headers.get("idempotency-key"))
+        return status, json.dumps(report).encode("utf-8"), "application/json"
+    if parsed.path == "/admin/toggle_metrics":
+        params = parse_qs(parsed.query)
+        value = params.get("enabled", ["false"])[0].lower() in {"1", "true", "yes"}
+        set_metrics_enabled(value)
+        print(f"[config] metricsEnabled set to {value}")
+        return 200, json.dumps({"metricsEnabled": value}).encode("utf-8"), "application/json"
+    return 404, b"{}", "application/json"
+
+
+def _page(source, params, allow_since_ts):
+    """Stream one local page of ``source``; the next cursor is known before the body.
+
+    With ``since_ts`` (segment log only) and no cursor, the page starts at
+    the first record the timestamp index finds, and ``limit`` counts
+    matching records only.
+    """
+    since = params.get("since", [""])[0]
+    # "now" skips everything stored so far and just resolves the current cursor.
+    after = source.next_seq - 1 if since == "now" else (int(since) if since else None)
+    limit = int(params["limit"][0]) if "limit" in params else None
+    if limit is not None and limit < 0:
+        raise ValueError("limit must not be negative")
+    since_ts = int(params["since_ts"][0]) if allow_since_ts and "since_ts" in params else None
+    if since_ts is not None:
+        end = source.next_seq
+        if after is None:
+            first = source.scan(since=since_ts, limit=1)
+            after = (first[0][0] if first else end) - 1
+        if limit is not None:
+            records = source.scan(since=since_ts, after=after, limit=limit) if limit else []
+            # A short page means everything up to ``end`` was looked at.
+            last = records[-1][0] if records else after
+            cursor = last if len(records) == limit else max(last, end - 1)
+            body = [b"[", b", ".join(view for _seq, _ts, view in records), b"]"]
+            return body, str(cursor)
+    start, stop = source.page_bounds(after, limit)
+    body = source.iter_encoded(start, stop, since=since_ts)
+    cursor = stop - 1 if stop > start else (after if after is not None else start - 1)
+    return body, str(cursor)
+
+
+def paged_response(parsed, source, since_ts=False):
+    """``?since=<cursor>&limit=N`` over a sequenced store, streamed as a JSON array.
+
+    The cursor for the next page comes back in ``X-Next-Cursor``; ``since=now``
+    starts from the end. ``after`` is accepted for ``since``, as on
+    /admin/metrics/wait. Across workers the cursor is a comma-separated list
+    with one position per worker.
+    """
+    params = parse_qs(parsed.query)
+    if "since" not in params and "after" in params:
+        params["since"] = params.pop("after")
+    try:
+        if not fans_out(parsed):
+            body, cursor = _page(source, params, since_ts)
+            return 200, body, "application/json", [("X-Next-Cursor", cursor)]
+        since = params.get("since", [""])[0]
+        cursors = ["now"] * len(WORKER["admin_ports"]) if since == "now" else since.split(",")
+        entries, next_cursors = [], []
+        for index, port in enumerate(WORKER["admin_ports"]):
+            cursor = cursors[index] if index < len(cursors) else ""
+            if index == WORKER["index"]:
+                body, next_cursor = _page(source, dict(params, since=[cursor]), since_ts)
+                entries.extend(json.loads(b"".join(body)))
+            else:
+                query = {key: values[0] for key, values in params.items() if key != "since"}
+                query.update(since=cursor, scope="local")
+                headers, payload = fetch_worker(index, port, f"{parsed.path}?{urlencode(query)}")
+                entries.extend(json.loads(payload) if payload else [])
+                next_cursor = headers.get("x-next-cursor", cursor)
+            next_cursors.append(next_cursor)
+    except ValueError as exc:
+        return 400, json.dumps({"error": f"bad pagination parameter: {exc}"}).encode("utf-8"), "application/json"
+    return 200, json.dumps(entries).encode("utf-8"), "application/json", [("X-Next-Cursor", ",".join(next_cursors))]
+
+
+def sampled_log(parsed):
+    """``/admin/metrics_log`` in sampling mode: the reservoir contents, oldest first.
+
+    ``appId`` and ``errors=1|0`` (with --sample-stratify) pick reservoirs
+    and ``limit`` keeps the newest N. The sampling rate behind the answer,
+    kept / seen over the picked reservoirs, comes back in
+    ``X-Sample-Rate`` with the two counts in ``X-Sample-Seen`` and
+    ``X-Sample-Kept``. Internal ``format=reservoir`` calls get the same
+    as one JSON object so a worker can merge the others' reservoirs.
+    """
+    params = parse_qs(parsed.query)
+    try:
+        limit = int(params["limit"][0]) if "limit" in params else None
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+    except ValueError as exc:
+        return 400, json.dumps({"error": f"bad pagination parameter: {exc}"}).encode("utf-8"), "application/json"
+    errors = {"1": True, "0": False}.get(params.get("errors", [""])[0])
+    fragments, seen, kept = STATE["sampler"].sample(params.get("appId", [None])[0], errors, limit)
+    if params.get("format") == ["reservoir"]:
+        body = f'{{"seen": {seen}, "kept": {kept}, "samples": [{", ".join(fragments)}]}}'
+        return 200, body.encode("utf-8"), "application/json"
+    if fans_out(parsed):
+        samples = [json.loads(fragment) for fragment in fragments]
+        query = {key: values[0] for key, values in params.items()}
+        query.update(format="reservoir")
+        for part in gather(f"{parsed.path}?{urlencode(query)}", lambda: None):
+            if part is not None:
+                seen += part["seen"]
+                kept += part["kept"]
+                samples.extend(part["samples"])
+        if limit is not None:
+            samples = samples[-limit:] if limit else []
+        body = json.dumps(samples).encode("utf-8")
+    else:
+        body = f"[{', '.join(fragments)}]".encode("utf-8")
+    rate = kept / seen if seen else 1.0
+    return 200, body, "application/json", [
+        ("X-Sample-Rate", f"{rate:.6g}"), ("X-Sample-Seen", str(seen)), ("X-Sample-Kept", str(kept)),
+    ]
+
+
+def fans_out(parsed):
+    """True when an admin read should cover every worker rather than just this one."""
+    return WORKER["admin_ports"] is not None and parse_qs(parsed.query).get("scope") != ["local"]
+
+
+def fetch_worker(index, port, path):
+    """GET ``path`` from another worker's admin listener; ``({}, b"")`` if it is unreachable."""
+    if not port:
+        return {}, b""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return {name.lower(): value for name, value in response.getheaders()}, response.read()
+    except OSError as exc:
+        print(f"[workers] worker {index} unreachable: {exc}")
+        return {}, b""
+    finally:
+        conn.close()
+
+
+def gather(path, local):
+    """Return ``local()`` plus every other worker's ``?scope=local`` answer for ``path``."""
+    parts = []
+    for index, port in enumerate(WORKER["admin_ports"]):
+        if index == WORKER["index"]:
+            parts.append(local())
+            continue
+        _headers, payload = fetch_worker(index, port, f"{path}{'&' if '?' in path else '?'}scope=local")
+        try:
+            parts.append(json.loads(payload))
+        except ValueError:
+            continue
+    return parts
+
+
+def gather_sum(path, stats):
+    """Sum the numeric ``stats`` of every worker key by key."""
+    parts = gather(path, lambda: stats)
+    return {key: sum(part.get(key, 0) for part in parts) for key in stats}
+
+
+def exposition_state():
+    """This worker's additive /metrics samples plus its raw 1m latency, as JSON-friendly data."""
+    uploads, counters = STATE["totals"].snapshot()
+    samples = [
+        ["metrics_stub_uploads_total", [["appId", app], ["sdk", sdk]], count]
+        for (app, sdk), count in uploads.items()
+    ]
+    samples += [
+        ["metrics_stub_sdk_counter_total", [["appId", app], ["sdk", sdk], ["counter", name]], value]
+        for (app, sdk, name), value in counters.items()
+    ]
+    sliding = STATE["aggregates"].snapshot(("1m", "5m"), ("sliding",))["windows"]
+    for window, data in sliding.items():
+        for app, values in data["sliding"].get("app", {}).items():
+            samples.append(["metrics_stub_ingest_uploads_per_second", [["appId", app], ["window", window]],
+                            values.get("uploads", 0) / WINDOWS[window]])
+    with _REQUEST_LOCK:
+        requests = [(key, list(value)) for key, value in REQUEST_STATS.items()]
+    for (method, route, status), (count, seconds) in requests:
+        samples.append(["metrics_stub_http_requests_total",
+                        [["method", method], ["route", route], ["status", str(status)]], count])
+        samples.append(["metrics_stub_http_request_seconds_total",
+                        [["method", method], ["route", route], ["status", str(status)]], seconds])
+    samples.append(["metrics_stub_ring_entries", [], len(STATE["metrics"])])
+    if STATE["ingest"] is not None:
+        ingest = STATE["ingest"].stats()
+        samples.append(["metrics_stub_ingest_queue_depth", [], ingest["depth"]])
+        samples.append(["metrics_stub_ingest_rejected_total", [], ingest["rejected"]])
+    if STATE["dedup"] is not None:
+        samples.append(["metrics_stub_dedup_duplicates_total", [], STATE["dedup"].stats()["duplicates"]])
+    if STATE["cardinality"] is not None:
+        samples.append(["metrics_stub_cardinality_folded_keys_total", [], STATE["cardinality"].folded_keys])
+    return {"samples": samples, "latency": STATE["latency"].latency(("1m",), raw=True)}
+
+
+def exposition_samples(fan_out):
+    """``{(family, labels): value}`` for /metrics, summed across workers when ``fan_out``."""
+    parts = gather("/metrics?format=samples", exposition_state) if fan_out else [exposition_state()]
+    samples, latency = {}, {}
+    for part in parts:
+        for family, labels, value in part["samples"]:
+            key = (family, tuple(tuple(pair) for pair in labels))
+            samples[key] = samples.get(key, 0) + value
+        merge_counts(latency, part["latency"])
+    if latency:
+        for app, group in render_latency(latency)["windows"]["1m"].get("app", {}).items():
+            for quantile, value in (group.get("quantiles") or {}).items():
+                if quantile.startswith("p"):
+                    labels = (("appId", app), ("quantile", f"{float(quantile[1:]) / 100:g}"))
+                    samples[("metrics_stub_request_latency_ms", labels)] = value
+    return samples
+
+
+# Routes reported by name in /metrics request stats; anything else is "other".
+ROUTES = frozenset({
+    "/api/v1/sdk/config", "/api/v1/sdk/metrics", "/api/v1/sdk/metrics/batch", "/api/v1/rtb/bid", "/api/v1/rtb/pod",
+    "/admin/toggle_metrics", "/metrics", *(f"/api/v1/track/{event}" for event in TRACKING_EVENTS),
+})
+
+
+def dispatch(method, target, headers, body=b""):
+    """Engine-independent entry point shared by the threaded and asyncio servers."""
+    started = time.perf_counter()
+    parsed = urlparse(target)
+    if method == "GET":
+        response = route_get(parsed, headers)
+    elif method == "POST":
+        response = route_post(parsed, headers, body)
+    else:
+        response = 501, b"{}", "application/json"
+    known = parsed.path in ROUTES or (parsed.path.startswith("/admin/") and response[0] != 404)
+    route = parsed.path if known else "other"
+    key = (method if method in ("GET", "POST") else "other", route, response[0])
+    with _REQUEST_LOCK:
+        stats = REQUEST_STATS.get(key)
+        if stats is None:
+            stats = REQUEST_STATS[key] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started
+    return response
+
 
 class Handler(BaseHTTPRequestHandler):
     server_version = "MetricsStub/1.0"
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are dropped after this many seconds.
+    timeout = IDLE_TIMEOUT
 
-    def _set_headers(self, status=200, content_type="application/json"):
-        self.send_response(status)
-        self.send_header("Content-Type", content_type)
-        self.end_headers()
-
-    def do_GET(self):  # noqa: N802 (stdlib signature)
-        parsed = urlparse(self.path)
-        if parsed.path == "/api/v1/sdk/config":
-            body = {
-                "version": 1,
-                "rolloutPercent": 100,
-                "features": {
-                    "killSwitch": False,
-                    "disableShow": False,
-                    "metricsEnabled": STATE["metrics_enabled"],
-                },
-                "placements": {},
-            }
-            payload = json.dumps(body).encode("utf-8")
-            self._set_headers(200)
-            self.wfile.write(payload)
+    def _respond(self, method, body=b""):
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        fault = plan_fault(self.path, body)
+        if fault is not None:
+            self._respond_faulted(fault, method, headers, body)
+            return
+        response = dispatch(method, self.path, headers, body)
+        if isinstance(response[1], Delayed):
+            # Waited out on the timer exactly like an injected delay.
+            self._respond_faulted(Fault(), method, headers, body, response)
+            return
+        waiter = response[1]
+        if isinstance(waiter, MetricsWaiter):
+            if waiter.stream:
+                response = (response[0], waiter.events_blocking(), *response[2:])
+            else:
+                response = waiter.respond(waiter.wait_blocking(waiter.timeout))
+        if is_stream(response[1]):
+            self.log_request(response[0], "-")
+            chunked = self.request_version == "HTTP/1.1"
+            if not chunked:
+                self.close_connection = True
+            try:
+                self.wfile.write(render_head(*without_body(response), keep_alive=not self.close_connection, chunked=chunked))
+                for chunk in response[1]:
+                    if chunk:
+                        self.wfile.write(frame_chunk(chunk) if chunked else chunk)
+                if chunked:
+                    self.wfile.write(LAST_CHUNK)
+            except ConnectionError:
+                self.close_connection = True
             return
-        if parsed.path == "/admin/metrics" or parsed.path == "/admin/metrics_log":
-            payload = json.dumps(STATE["metrics"]).encode("utf-8")
-            self._set_headers(200)
-            self.wfile.write(payload)
+        self.log_request(response[0], len(response[1]) if response[1] else "-")
+        # Status line, headers and body go out in a single sendall.
+        self.wfile.write(render_response(*response, keep_alive=not self.close_connection))
+
+    def _respond_faulted(self, fault, method, headers, body, response=None):
+        keep_alive = not self.close_connection
+        data = fault_output(fault, method, self.path, headers, body, keep_alive=keep_alive, response=response)
+        self.log_request(fault.status or (response[0] if response else "-"), "-")
+        if not (fault.delay or fault.reset or fault.truncate):
+            self.wfile.write(data)
             return
-        self._set_headers(404)
-        self.wfile.write(b"{}")
+        # Once this handler returns, the timer owns the socket and this thread
+        # goes back to the pool. A keep-alive connection is handed back to the
+        # server after its response is sent, to be served by a new handler.
+        self.close_connection = True
+        resume = None
+        if data is not None and keep_alive and not fault.truncate:
+            resume = functools.partial(self.server.process_request, self.connection, self.client_address)
+        if fault.delay:
+            handoff = functools.partial(STATE["timer"].call_later, fault.delay, finish_faulted, self.connection, data,
+                                        None, resume)
+        else:
+            handoff = functools.partial(finish_faulted, self.connection, data, None, resume)
+        self.server.detach(self.connection, handoff)
+
+    def do_GET(self):  # noqa: N802 (stdlib signature)
+        self._respond("GET")
 
     def do_POST(self):  # noqa: N802 (stdlib signature)
-        parsed = urlparse(self.path)
         length = int(self.headers.get("Content-Length", "0"))
         body = self.rfile.read(length) if length else b""
-        if parsed.path == "/api/v1/rtb/bid":
-            # Always respond no-fill to keep flows simple.
-            self._set_headers(204)
-            return
-        if parsed.path == "/api/v1/sdk/metrics":
-            text = body.decode("utf-8") if body else ""
-            STATE["metrics"].append(text)
-            print(f"[metrics] {text}")
-            self._set_headers(200)
-            self.wfile.write(b"{}")
-            return
-        if parsed.path == "/admin/toggle_metrics":
-            params = parse_qs(parsed.query)
-            value = params.get("enabled", ["false"])[0].lower() in {"1", "true", "yes"}
-            STATE["metrics_enabled"] = value
-            print(f"[config] metricsEnabled set to {value}")
-            self._set_headers(200)
-            self.wfile.write(json.dumps({"metricsEnabled": value}).encode("utf-8"))
+        self._respond("POST", body)
+
+
+_DATE_CACHE = [0, ""]
+
+
+def _http_date():
+    now = int(time.time())
+    if _DATE_CACHE[0] != now:
+        _DATE_CACHE[0], _DATE_CACHE[1] = now, formatdate(now, usegmt=True)
+    return _DATE_CACHE[1]
+
+
+LAST_CHUNK = b"0\r\n\r\n"
+_RESET = struct.pack("ii", 1, 0)
+# Detached responses the socket cannot take at once are retried this often, for this long.
+SEND_RETRY = 0.005
+SEND_TIMEOUT = 30.0
+
+
+class Delayed:
+    """A route's payload that must not go out for ``delay`` seconds (see AuctionEngine.bid)."""
+
+    __slots__ = ("payload", "delay")
+
+    def __init__(self, payload, delay):
+        self.payload = payload
+        self.delay = delay
+
+
+def plan_fault(target, body):
+    """The injected Fault for a request, or None; admin routes and /metrics are never faulted."""
+    if STATE["faults"] is None or target.startswith(("/admin/", "/metrics")):
+        return None
+    return STATE["faults"].plan(target, body)
+
+
+def fault_output(fault, method, target, headers, body, keep_alive, response=None):
+    """The bytes to send for a request that drew ``fault``; None means reset the connection.
+
+    An injected status replaces the route's answer without running it;
+    otherwise the route runs (unless its ``response`` is already known)
+    and only what goes on the wire is damaged. A ``Delayed`` answer adds
+    its delay to the fault's. A truncated response promises its full
+    Content-Length and carries half the body (half the head when there
+    is no body) and closes the connection; a delay alone keeps it open.
+    """
+    if fault.reset:
+        return None
+    if fault.status is not None:
+        payload = json.dumps({"error": f"injected {fault.status}"}).encode("utf-8")
+        response = (fault.status, payload, "application/json")
+        if fault.status in (429, 503):
+            response += ([("Retry-After", "1")],)
+    elif response is None:
+        response = dispatch(method, target, headers, body)
+    if isinstance(response[1], Delayed):
+        fault.delay += response[1].delay
+        response = (response[0], response[1].payload, *response[2:])
+    keep_alive = keep_alive and not fault.truncate
+    data = render_response(*response, keep_alive=keep_alive)
+    if fault.truncate:
+        payload = response[1] if response[0] not in (204, 304) else None
+        data = data[:len(data) - (len(payload) - len(payload) // 2)] if payload else data[:len(data) // 2]
+    return data
+
+
+def finish_faulted(sock, data, deadline=None, resume=None):
+    """Send ``data`` (or reset when it is None) on a detached socket without blocking.
+
+    Whatever the socket buffer does not take yet is sent from a timer
+    callback, so a large response is never cut short; a client that stops
+    reading for ``SEND_TIMEOUT`` seconds gets the connection closed. Once
+    everything is sent the socket is closed, or passed to ``resume()``
+    when the connection stays open.
+    """
+    try:
+        if data is None:
+            # SO_LINGER with a zero timeout turns close() into a TCP RST.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _RESET)
+        else:
+            sock.setblocking(False)
+            try:
+                sent = sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            if sent < len(data):
+                now = time.monotonic()
+                deadline = now + SEND_TIMEOUT if deadline is None else deadline
+                if now < deadline:
+                    STATE["timer"].call_later(SEND_RETRY, finish_faulted, sock, memoryview(data)[sent:], deadline,
+                                              resume)
+                    return
+                resume = None
+            elif resume is not None:
+                resume()
+                return
+    except OSError:
+        pass
+    sock.close()
+
+
+def is_stream(payload):
+    """Routes may return an iterable of byte chunks instead of a complete body."""
+    return payload is not None and not isinstance(payload, (bytes, bytearray))
+
+
+def without_body(response):
+    status, _payload, content_type, *rest = response
+    return (status, content_type, *rest)
+
+
+def frame_chunk(chunk):
+    return b"%x\r\n%s\r\n" % (len(chunk), chunk)
+
+
+def render_head(status, content_type, headers=None, keep_alive=False, length=None, chunked=False):
+    lines = [
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+        f"Server: {Handler.server_version}",
+        f"Date: {_http_date()}",
+        f"Content-Type: {content_type}",
+    ]
+    lines.extend(f"{name}: {value}" for name, value in headers or ())
+    if chunked:
+        lines.append("Transfer-Encoding: chunked")
+    elif length is not None:
+        lines.append(f"Content-Length: {length}")
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def render_response(status, payload, content_type, headers=None, keep_alive=False):
+    """Serialize status line, headers and body into one buffer."""
+    # 204 and 304 responses carry neither a body nor a Content-Length.
+    has_body = status not in (204, 304)
+    length = (len(payload) if payload else 0) if has_body else None
+    head = render_head(status, content_type, headers, keep_alive, length)
+    return head + payload if payload and has_body else head
+
+
+def wants_keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        return None
+    method, target, version = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    body = await reader.readexactly(length) if length else b""
+    return method, target, version, headers, body
+
+
+async def _write_chunks(writer, chunks, chunked):
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            if chunk:
+                writer.write(frame_chunk(chunk) if chunked else chunk)
+                await writer.drain()
+        return
+    for chunk in chunks:
+        if chunk:
+            writer.write(frame_chunk(chunk) if chunked else chunk)
+            await writer.drain()
+
+
+async def _serve_connection(reader, writer):
+    try:
+        while True:
+            request = await asyncio.wait_for(_read_request(reader), IDLE_TIMEOUT)
+            if request is None:
+                return
+            method, target, version, headers, body = request
+            keep_alive = wants_keep_alive(version, headers)
+            fault = plan_fault(target, body)
+            if fault is not None:
+                if target.startswith(("/api/v1/sdk/metrics/batch", "/api/v1/rtb/pod")):
+                    loop = asyncio.get_running_loop()
+                    data = await loop.run_in_executor(None, fault_output, fault, method, target, headers, body, keep_alive)
+                else:
+                    data = fault_output(fault, method, target, headers, body, keep_alive)
+                if fault.delay:
+                    await asyncio.sleep(fault.delay)
+                if data is None:
+                    writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _RESET)
+                    writer.transport.abort()
+                    return
+                writer.write(data)
+                await writer.drain()
+                if fault.truncate or not keep_alive:
+                    return
+                continue
+            if target.startswith(("/admin/", "/metrics", "/api/v1/sdk/metrics/batch", "/api/v1/rtb/pod")):
+                # Admin routes and /metrics may block (worker fan-out, large dumps), and
+                # batches (to parse) and pods (to assemble) are CPU-heavy; keep them off the loop.
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(None, dispatch, method, target, headers, body)
+            else:
+                response = dispatch(method, target, headers, body)
+            if isinstance(response[1], Delayed):
+                await asyncio.sleep(response[1].delay)
+                response = (response[0], response[1].payload, *response[2:])
+            waiter = response[1]
+            if isinstance(waiter, MetricsWaiter):
+                if waiter.stream:
+                    response = (response[0], waiter.events_async(), *response[2:])
+                else:
+                    response = waiter.respond(await waiter.wait_async(waiter.timeout))
+            if is_stream(response[1]):
+                chunked = version == "HTTP/1.1"
+                keep_alive = keep_alive and chunked
+                writer.write(render_head(*without_body(response), keep_alive=keep_alive, chunked=chunked))
+                await _write_chunks(writer, response[1], chunked)
+                if chunked:
+                    writer.write(LAST_CHUNK)
+            else:
+                writer.write(render_response(*response, keep_alive=keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_asyncio(host, port, reuse_port=False, on_admin_port=None):
+    """Serve every route from a single event loop instead of a thread per connection."""
+    server = await asyncio.start_server(
+        _serve_connection, host, port, backlog=1024, reuse_port=reuse_port or None
+    )
+    if on_admin_port is not None:
+        admin = await asyncio.start_server(_serve_connection, host, 0)
+        on_admin_port(admin.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # socketserver listens with a backlog of 5; match the asyncio engine's 1024
+    # so a burst of new connections is not dropped into SYN retransmits.
+    request_queue_size = 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._detached = {}
+
+    def detach(self, request, handoff):
+        """Leave ``request``'s socket open after its handler returns and call ``handoff()`` then.
+
+        ``handoff`` owns the socket from that point. Waiting for the handler
+        to finish means it has flushed its writes and no longer touches the
+        socket, even when ``handoff`` hands it straight back to the server.
+        Requests a client pipelined behind the detached one are not kept.
+        """
+        self._detached[request] = handoff
+
+    def shutdown_request(self, request):
+        handoff = self._detached.pop(request, None)
+        if handoff is not None:
+            handoff()
             return
-        self._set_headers(404)
-        self.wfile.write(b"{}")
+        super().shutdown_request(request)
 
 
-def main():
-    port = int(os.environ.get("METRICS_STUB_PORT", "8123"))
-    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
-    print(f"Metrics stub running on http://127.0.0.1:{port}")
-    print("Use POST /admin/toggle_metrics?enabled=true|false to flip the feature flag")
+class ReusePortHTTPServer(StubHTTPServer):
+    allow_reuse_port = True
+
+
+def serve_threaded(host, port, reuse_port=False, on_admin_port=None):
+    server_class = ReusePortHTTPServer if reuse_port else StubHTTPServer
+    server = server_class((host, port), Handler)
+    if on_admin_port is not None:
+        admin = StubHTTPServer((host, 0), Handler)
+        on_admin_port(admin.server_address[1])
+        threading.Thread(target=admin.serve_forever, daemon=True).start()
     server.serve_forever()
 
 
+def serve(engine, host, port, **kwargs):
+    # SIGTERM unwinds like Ctrl-C so shutdown() can drain queued uploads.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if engine == "asyncio":
+            asyncio.run(serve_asyncio(host, port, **kwargs))
+        else:
+            serve_threaded(host, port, **kwargs)
+    except KeyboardInterrupt:
+        pass
+
+
+def open_log(options, worker=None):
+    """Open the segment log for this process; each worker gets its own subdirectory."""
+    if not options.log_dir:
+        return
+    directory = options.log_dir if worker is None else os.path.join(options.log_dir, f"worker-{worker}")
+    started = time.perf_counter()
+    STATE["log"] = SegmentLog(directory, options.log_segment_bytes, options.log_max_segments)
+    stats = STATE["log"].stats()
+    print(
+        f"[log] {directory}: {stats['segments']} segments, next seq {stats['next_seq']}, "
+        f"reopened in {(time.perf_counter() - started) * 1000:.1f} ms"
+    )
+
+
+def open_sqlite(options, worker=None):
+    """Open this process's SQLite store; each worker writes its own file."""
+    if not options.sqlite:
+        return
+    path = options.sqlite
+    if worker is not None:
+        base, ext = os.path.splitext(path)
+        path = f"{base}.worker-{worker}{ext}"
+    STATE["sqlite"] = SqliteStore(path)
+    print(f"[sqlite] {path}: {STATE['sqlite'].stats()['next_id']} uploads on disk")
+
+
+def open_auction(options, worker=None):
+    """Build this process's auction engine; workers seed their own generators."""
+    if not options.auction:
+        return
+    seed = options.auction_seed if worker is None or options.auction_seed is None else f"{options.auction_seed}/{worker}"
+    STATE["auction"] = AuctionEngine(options.auction_config, f"http://127.0.0.1:{options.port}/api/v1/track", seed,
+                                     options.auction_batch)
+
+
+def open_faults(options, worker=None):
+    """Build this process's fault injector and its timer thread (after any fork)."""
+    if options.faults is not None:
+        seed = options.faults.get("seed")
+        STATE["faults"] = FaultInjector(options.faults, seed if worker is None or seed is None else f"{seed}/{worker}")
+    if options.faults is not None or options.auction:
+        STATE["timer"] = DelayScheduler()
+
+
+def start_retention(options):
+    """Start this process's compaction thread (after any fork, and after open_sqlite)."""
+    if options.retention:
+        STATE["retention"] = RetentionManager(STATE["columns"], STATE["sqlite"], interval=options.compact_interval)
+        STATE["retention"].start()
+
+
+def start_ingest(options):
+    """Start this process's ingest threads; they must be created after any fork."""
+    if options.ingest_workers > 0:
+        STATE["ingest"] = IngestQueue(ingest_bodies, options.ingest_queue_depth, options.ingest_workers,
+                                      options.ingest_batch)
+
+
+def shutdown():
+    """Drain the ingest queue, then commit what the SQLite writer still holds."""
+    if STATE["ingest"] is not None:
+        STATE["ingest"].close()
+    if STATE["retention"] is not None:
+        STATE["retention"].close()
+    if STATE["sqlite"] is not None:
+        STATE["sqlite"].close()
+
+
+def serve_workers(engine, host, port, workers, options):
+    """Fork ``workers`` processes that share ``port`` through SO_REUSEPORT."""
+    admin_ports = multiprocessing.RawArray("i", workers)
+    pids = []
+    sys.stdout.flush()
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            WORKER["index"], WORKER["admin_ports"] = index, admin_ports
+            open_log(options, index)
+            open_sqlite(options, index)
+            open_auction(options, index)
+            open_faults(options, index)
+            start_retention(options)
+            start_ingest(options)
+
+            def publish(admin_port, index=index):
+                admin_ports[index] = admin_port
+
+            try:
+                serve(engine, host, port, reuse_port=True, on_admin_port=publish)
+                shutdown()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    def stop(_signum, _frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=int(os.environ.get("METRICS_STUB_PORT", "8123")))
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=os.environ.get("METRICS_STUB_ENGINE", "threaded"),
+        help="threaded: ThreadingHTTPServer (default); asyncio: single event loop",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="seconds an idle keep-alive connection is held open",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_WORKERS", "1")),
+        help="fork N processes onto the same port with SO_REUSEPORT",
+    )
+    parser.add_argument(
+        "--max-entries",
+        type=int,
+        default=STATE["metrics"].max_entries,
+        help="metrics uploads kept per worker before the oldest are evicted",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=STATE["metrics"].max_bytes,
+        help="encoded bytes of metrics uploads kept per worker before the oldest are evicted",
+    )
+    parser.add_argument(
+        "--max-rows",
+        type=int,
+        default=STATE["columns"].max_rows,
+        help="parsed uploads kept per worker in the columnar store",
+    )
+    parser.add_argument(
+        "--log-dir",
+        default=os.environ.get("METRICS_STUB_LOG_DIR"),
+        help="persist uploads to rotating segment files here; /admin/metrics_log then reads them",
+    )
+    parser.add_argument("--log-segment-bytes", type=int, default=DEFAULT_SEGMENT_BYTES)
+    parser.add_argument(
+        "--sample-reservoir",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_SAMPLE_RESERVOIR", "0")),
+        help="keep a uniform sample of this many raw uploads per app for /admin/metrics_log "
+             "(and /admin/metrics and --log-dir) instead of every one; aggregates still see every upload. 0 keeps all",
+    )
+    parser.add_argument(
+        "--sample-stratify",
+        action="store_true",
+        default=os.environ.get("METRICS_STUB_SAMPLE_STRATIFY", "").lower() in {"1", "true", "yes"},
+        help="sample uploads with and without errors into separate reservoirs per app",
+    )
+    parser.add_argument("--log-max-segments", type=int, default=DEFAULT_MAX_SEGMENTS)
+    parser.add_argument(
+        "--sqlite",
+        default=os.environ.get("METRICS_STUB_SQLITE"),
+        help="also keep parsed uploads in this SQLite file; query with /admin/metrics/summary?source=sqlite",
+    )
+    parser.add_argument(
+        "--retention",
+        action="store_true",
+        default=os.environ.get("METRICS_STUB_RETENTION", "").lower() in {"1", "true", "yes"},
+        help="keep raw rows for 1h, 1m rollups for a day and 1h rollups for 30 days",
+    )
+    parser.add_argument("--compact-interval", type=float, default=DEFAULT_COMPACT_INTERVAL,
+                        help="seconds between retention compaction passes")
+    parser.add_argument(
+        "--auction",
+        action="store_true",
+        default=os.environ.get("METRICS_STUB_AUCTION", "").lower() in {"1", "true", "yes"},
+        help="answer /api/v1/rtb/bid and /api/v1/rtb/pod from the auction engine instead of always 204",
+    )
+    parser.add_argument(
+        "--auction-config",
+        default=os.environ.get("METRICS_STUB_AUCTION_CONFIG"),
+        help="JSON file of per-placement fillRate, cpm, adapters and AuctionWin fields; implies --auction",
+    )
+    parser.add_argument("--auction-seed", default=os.environ.get("METRICS_STUB_AUCTION_SEED"),
+                        help="seed for reproducible auction outcomes (per worker)")
+    parser.add_argument(
+        "--auction-batch",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_AUCTION_BATCH", "0")),
+        help="pre-draw this many outcomes per placement at a time (vectorized with NumPy when installed) "
+             "instead of drawing per bid; 0 draws per bid",
+    )
+    parser.add_argument(
+        "--faults",
+        default=os.environ.get("METRICS_STUB_FAULTS"),
+        help="JSON file of per-route (and per-placement) latency, status, reset and truncation rules",
+    )
+    parser.add_argument(
+        "--ingest-workers",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_INGEST_WORKERS", str(DEFAULT_INGEST_WORKERS))),
+        help="background threads storing metrics uploads per worker; 0 stores them on the request thread",
+    )
+    parser.add_argument(
+        "--ingest-queue-depth",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_INGEST_QUEUE_DEPTH", str(DEFAULT_QUEUE_DEPTH))),
+        help="uploads waiting for the ingest threads before POSTs get 429",
+    )
+    parser.add_argument("--ingest-batch", type=int, default=DEFAULT_INGEST_BATCH)
+    parser.add_argument(
+        "--metrics-cache-seconds",
+        type=float,
+        default=float(os.environ.get("METRICS_STUB_METRICS_CACHE_SECONDS", "5")),
+        help="how long a rendered /metrics body is reused between scrapes (default: one 5 s scrape interval)",
+    )
+    parser.add_argument(
+        "--max-counter-keys",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_MAX_COUNTER_KEYS", str(DEFAULT_MAX_KEYS_PER_APP))),
+        help="distinct counter names kept per app before new ones fold into __other__; 0 disables the cap",
+    )
+    parser.add_argument(
+        "--dedup-keys",
+        type=int,
+        default=int(os.environ.get("METRICS_STUB_DEDUP_KEYS", str(DEFAULT_DEDUP_KEYS))),
+        help="recent upload keys remembered per worker to drop retried uploads; 0 disables dedup",
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.sample_reservoir < 0:
+        parser.error("--sample-reservoir must not be negative")
+    if args.auction_batch < 0:
+        parser.error("--auction-batch must not be negative")
+    if args.auction_config:
+        args.auction = True
+        try:
+            args.auction_config = load_auction_config(args.auction_config)
+            AuctionEngine(args.auction_config)
+        except (OSError, ValueError, TypeError) as exc:
+            parser.error(f"--auction-config: {exc}")
+    if args.faults:
+        try:
+            args.faults = load_fault_config(args.faults)
+            FaultInjector(args.faults)
+        except (OSError, ValueError, TypeError) as exc:
+            parser.error(f"--faults: {exc}")
+    if args.ingest_workers < 0 or args.ingest_queue_depth < 1 or args.ingest_batch < 1:
+        parser.error("--ingest-workers must not be negative; --ingest-queue-depth and --ingest-batch must be positive")
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not provide")
+    return args
+
+
+def main(argv=None):
+    global IDLE_TIMEOUT
+    args = parse_args(argv)
+    IDLE_TIMEOUT = Handler.timeout = args.idle_timeout
+    STATE["metrics"] = RingStore(args.max_entries, args.max_bytes)
+    STATE["columns"] = ColumnarStore(args.max_rows)
+    EXPOSITION.max_age = args.metrics_cache_seconds
+    STATE["cardinality"] = CardinalityGuard(args.max_counter_keys) if args.max_counter_keys > 0 else None
+    STATE["dedup"] = DedupWindow(args.dedup_keys) if args.dedup_keys > 0 else None
+    if args.sample_reservoir > 0:
+        STATE["sampler"] = ReservoirSampler(args.sample_reservoir, args.sample_stratify)
+    port = args.port
+    workers = f", {args.workers} workers" if args.workers > 1 else ""
+    print(f"Metrics stub running on http://127.0.0.1:{port} ({args.engine} engine{workers})")
+    print("Use POST /admin/toggle_metrics?enabled=true|false to flip the feature flag")
+    if args.workers > 1:
+        serve_workers(args.engine, "127.0.0.1", port, args.workers, args)
+    else:
+        open_log(args)
+        open_sqlite(args)
+        open_auction(args)
+        open_faults(args)
+        start_retention(args)
+        start_ingest(args)
+        serve(args.engine, "127.0.0.1", port)
+        shutdown()
+
+
 if __name__ == "__main__":
     main()
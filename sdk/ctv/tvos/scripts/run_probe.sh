@@ -12,9 +12,17 @@ cleanup() {
   fi
 }
 trap cleanup EXIT
-METRICS_ENABLED="$FLAG" METRICS_STUB_PORT="$PORT" python3 "$(dirname "$0")/metrics_stub.py" >"$LOG_FILE" 2>&1 &
+METRICS_ENABLED="$FLAG" METRICS_STUB_PORT="$PORT" METRICS_STUB_LOG_DIR="$LOG_DIR/segments" python3 "$(dirname "$0")/metrics_stub.py" >"$LOG_FILE" 2>&1 &
 STUB_PID=$!
 sleep 1
 API_BASE_URL="$BASE" swift run --package-path sdk/ctv/tvos CTVSDKDevProbe
-sleep 1
+if [[ "$FLAG" == "true" ]]; then
+  # Returns as soon as the first upload lands instead of guessing a delay.
+  curl -s "http://127.0.0.1:${PORT}/admin/metrics/wait?after=-1&timeout=10" >/dev/null
+else
+  sleep 1
+fi
 cat "$LOG_FILE"
+echo "[probe] persisted uploads:"
+curl -s "http://127.0.0.1:${PORT}/admin/metrics_log"
+echo
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Benchmark for metrics_sqlite.SqliteStore: sustained inserts/sec and summary query latency."""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from metrics_sqlite import DEFAULT_BATCH, SqliteStore
+
+COUNTERS = ("requests_total", "requests_success", "requests_error_timeout", "playback_start", "tracker_impression_ok")
+
+
+def make_records(count, start_ts, apps, rng):
+    records = []
+    for offset in range(count):
+        names = rng.sample(COUNTERS, rng.randint(2, len(COUNTERS)))
+        records.append({
+            "timestamp": start_ts + offset,
+            "appId": f"app-{rng.randrange(apps)}",
+            "sdk": "tvos",
+            "counters": {name: rng.randint(1, 20) for name in names},
+            "latency": (80.0, 140.0, 210.0) if rng.random() < 0.5 else None,
+        })
+    return records
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    return round(statistics.median(samples), 2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000_000, help="uploads to insert")
+    parser.add_argument("--apps", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="records per group commit")
+    parser.add_argument("--db", help="SQLite file (default: a temporary file, removed afterwards)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per query; the median is reported")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    directory = None
+    path = args.db
+    if path is None:
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "bench.db")
+    rng = random.Random(7)
+    chunk = 10_000
+    pool = make_records(chunk, 0, args.apps, rng)
+    store = SqliteStore(path, batch=args.batch)
+    started = time.perf_counter()
+    for first in range(0, args.rows, chunk):
+        count = min(chunk, args.rows - first)
+        store.ingest_many([dict(record, timestamp=first + offset) for offset, record in enumerate(pool[:count])])
+    store.flush()
+    elapsed = time.perf_counter() - started
+    stats = store.stats()
+
+    window = max(1, args.rows // 24)  # an "hour" of a day-long run
+    queries = {
+        "one_app_all_time": lambda: store.summary(app_id="app-1"),
+        "one_app_last_hour": lambda: store.summary(app_id="app-1", since=args.rows - window),
+        "one_app_one_minute": lambda: store.summary(app_id="app-1", since=args.rows - window // 60),
+        "all_apps_all_time": lambda: store.summary(),
+    }
+    results = {
+        "rows": args.rows,
+        "insert_seconds": round(elapsed, 2),
+        "inserts_per_sec": round(args.rows / elapsed),
+        "commits": stats["commits"],
+        "mean_commit_ms": stats["mean_commit_ms"],
+        "db_bytes": stats["bytes"],
+        "query_ms": {name: timed(query, args.repeat) for name, query in queries.items()},
+    }
+    store.close()
+    if directory is not None:
+        directory.cleanup()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{results['rows']} uploads in {results['insert_seconds']} s: {results['inserts_per_sec']} inserts/s "
+          f"({results['commits']} commits, {results['mean_commit_ms']} ms each, {results['db_bytes'] >> 20} MiB)")
+    for name, ms in results["query_ms"].items():
+        print(f"  {name:<20} {ms:>10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,617 @@
+"""Configurable auction engine behind metrics_stub.py's /api/v1/rtb/bid."""
+
+import functools
+import itertools
+import json
+import math
+import operator
+import random
+import re
+import threading
+from urllib.parse import quote
+
+from metrics_aggregates import bin_key, sketch_quantiles
+
+try:
+    import numpy
+except ImportError:  # OutcomeBatches falls back to drawing with random.Random
+    numpy = None
+
+BATCH_BACKEND = "python" if numpy is None else "numpy"
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_CURRENCY = "USD"
+DEFAULT_PLACEMENT = "*"
+DEFAULT_BATCH_SIZE = 4096
+DEFAULT_POD_DURATIONS = (15, 30)
+POD_CANDIDATES_PER_SLOT = 2
+MAX_POD_SLOTS = 20
+MAX_BREAK_SECONDS = 600
+TRACKING_EVENTS = (
+    "impression", "click", "start", "firstQuartile", "midpoint", "thirdQuartile",
+    "complete", "pause", "resume", "mute", "unmute", "close",
+)
+
+# Used when --auction is given without --auction-config.
+DEFAULT_CONFIG = {
+    "placements": {
+        DEFAULT_PLACEMENT: {
+            "fillRate": 0.8,
+            "cpm": {"dist": "lognormal", "mu": 1.0, "sigma": 0.5},
+            "adapters": ["stub-dsp"],
+        },
+    },
+}
+
+# json.loads on bytes sniffs the encoding per call; bid bodies are UTF-8.
+_decode = json.JSONDecoder().decode
+
+# Per-request values are spliced into the compiled JSON where these markers sit.
+_REQUEST_ID, _BID_ID, _CPM = "@@requestId@@", "@@bidId@@", "@@cpm@@"
+_PLACEMENT_ID = "@@placementId@@"  # URLs of the "*" profile, which serves any unknown placement
+_TTL, _DURATION = "@@ttlSeconds@@", "@@durationSeconds@@"  # pod wins only
+_SLOTS = {f'"{_REQUEST_ID}"': ("%s", 0), _BID_ID: ("%s", 1), f'"{_CPM}"': ("%.2f", 2), _PLACEMENT_ID: ("%s", 3),
+          f'"{_TTL}"': ("%d", 4), f'"{_DURATION}"': ("%d", 5)}
+_SLOT = re.compile("(" + "|".join(re.escape(marker) for marker in _SLOTS) + ")")
+
+
+def _compile(win):
+    """``(template, getter)``: ``template % getter((request id JSON, bid id, cpm, placement id[, ttl, duration]))``
+    is the win's JSON; the placement id is URL-quoted."""
+    parts = _SLOT.split(json.dumps(win, separators=(",", ":")).replace("%", "%%"))
+    template, order = [], []
+    for index, part in enumerate(parts):
+        if index % 2:
+            template.append(_SLOTS[part][0])
+            order.append(_SLOTS[part][1])
+        else:
+            template.append(part)
+    return "".join(template), operator.itemgetter(*order)
+
+
+def distribution(spec):
+    """A ``rng -> value`` callable for a config entry such as ``cpm`` (a bare number is fixed)."""
+    if isinstance(spec, (int, float)):
+        spec = {"dist": "fixed", "value": spec}
+    dist = spec.get("dist", "fixed")
+    try:
+        if dist == "fixed":
+            value = float(spec["value"])
+            return lambda rng: value
+        if dist == "uniform":
+            low, high = float(spec["min"]), float(spec["max"])
+            return lambda rng: rng.uniform(low, high)
+        if dist == "lognormal":
+            mu, sigma = float(spec["mu"]), float(spec["sigma"])
+            return lambda rng: rng.lognormvariate(mu, sigma)
+        if dist == "normal":
+            mean, stddev = float(spec["mean"]), float(spec["stddev"])
+            return lambda rng: max(0.0, rng.gauss(mean, stddev))
+        if dist == "exponential":
+            mean = float(spec["mean"])
+            if mean <= 0:
+                raise ValueError("exponential distribution needs a positive mean")
+            rate = 1.0 / mean
+            return lambda rng: rng.expovariate(rate)
+    except KeyError as exc:
+        raise ValueError(f"distribution {dist!r} needs {exc.args[0]!r}") from None
+    raise ValueError(f"unknown distribution {dist!r}; use fixed, uniform, lognormal, normal or exponential")
+
+
+def batch_distribution(spec):
+    """A ``(generator, n) -> array`` callable drawing ``n`` values of ``distribution(spec)`` with NumPy."""
+    distribution(spec)  # same validation and errors
+    if isinstance(spec, (int, float)):
+        spec = {"dist": "fixed", "value": spec}
+    dist = spec.get("dist", "fixed")
+    if dist == "fixed":
+        value = float(spec["value"])
+        return lambda gen, n: numpy.full(n, value)
+    if dist == "uniform":
+        low, high = float(spec["min"]), float(spec["max"])
+        return lambda gen, n: gen.uniform(low, high, n)
+    if dist == "lognormal":
+        mu, sigma = float(spec["mu"]), float(spec["sigma"])
+        return lambda gen, n: gen.lognormal(mu, sigma, n)
+    if dist == "normal":
+        mean, stddev = float(spec["mean"]), float(spec["stddev"])
+        return lambda gen, n: numpy.maximum(0.0, gen.normal(mean, stddev, n))
+    mean = float(spec["mean"])
+    return lambda gen, n: gen.exponential(mean, n)
+
+
+class DemandSource:
+    """A simulated demand partner: how long it takes to answer, how often it bids, and at what CPM."""
+
+    def __init__(self, config, auction_timeout=None):
+        self.source_id = str(config["id"])
+        self.latency_spec = config.get("latencyMs", 50)
+        self.latency = distribution(self.latency_spec)
+        timeouts = [float(value) for value in (config.get("timeoutMs"), auction_timeout) if value is not None]
+        self.timeout = min(timeouts) if timeouts else math.inf
+        self.fill_rate = float(config.get("fillRate", 1.0))
+        if not 0.0 <= self.fill_rate <= 1.0:
+            raise ValueError(f"source {self.source_id!r}: fillRate must be between 0 and 1")
+        self.cpm_spec = config.get("cpm", {"dist": "fixed", "value": 1.0})
+        self.draw_cpm = distribution(self.cpm_spec)
+        self.ttl = int(config["ttlSeconds"]) if "ttlSeconds" in config else None
+
+    def answer(self, rng):
+        """``(latency ms, cpm)`` for one request; the cpm is -1 for no bid and is not drawn after a timeout."""
+        latency = self.latency(rng)
+        if latency > self.timeout or rng.random() >= self.fill_rate:
+            return latency, -1.0
+        return latency, round(self.draw_cpm(rng), 2)
+
+
+class Placement:
+    """One placement's fill rate, CPM distribution and precompiled win templates (one per adapter).
+
+    With demand sources the placement asks ``sources`` instead (all of
+    them unless its config lists ids), and each source is an adapter
+    with its own ``ttlSeconds`` if it sets one. Pod ads draw their length
+    from ``durations`` (seconds), and a pod runs ``podCandidates``
+    auctions (``POD_CANDIDATES_PER_SLOT`` per slot when unset).
+    """
+
+    def __init__(self, placement_id, config, defaults, sources=None):
+        merged = dict(defaults, **config)
+        self.placement_id = placement_id
+        self.fill_rate = float(merged.get("fillRate", 1.0))
+        if not 0.0 <= self.fill_rate <= 1.0:
+            raise ValueError(f"placement {placement_id!r}: fillRate must be between 0 and 1")
+        self.cpm_spec = merged.get("cpm", {"dist": "fixed", "value": 1.0})
+        self.draw_cpm = distribution(self.cpm_spec)
+        self.sources = []
+        if sources:
+            try:
+                self.sources = [sources[source_id] for source_id in merged.get("sources", sources)]
+            except KeyError as exc:
+                raise ValueError(f"placement {placement_id!r}: unknown source {exc.args[0]!r}") from None
+            adapters = [source.source_id for source in self.sources]
+        else:
+            adapters = merged.get("adapters") or ["stub-dsp"]
+        ttl = int(merged.get("ttlSeconds", DEFAULT_TTL_SECONDS))
+        self.ttls = [ttl if source.ttl is None else source.ttl for source in self.sources] or [ttl] * len(adapters)
+        self.templates = [self._template(str(adapter), adapter_ttl, merged)
+                          for adapter, adapter_ttl in zip(adapters, self.ttls)]
+        self.pod_templates = [self._template(str(adapter), _TTL, merged, _DURATION) for adapter in adapters]
+        try:
+            self.durations = sorted({int(duration) for duration in merged.get("durations", DEFAULT_POD_DURATIONS)})
+        except (TypeError, ValueError):
+            raise ValueError(f"placement {placement_id!r}: durations must be a list of seconds") from None
+        if not self.durations or self.durations[0] <= 0:
+            raise ValueError(f"placement {placement_id!r}: durations must be positive")
+        # 0 stands for unset: POD_CANDIDATES_PER_SLOT auctions per slot.
+        self.pod_candidates = 0
+        if merged.get("podCandidates") is not None:
+            try:
+                self.pod_candidates = int(merged["podCandidates"])
+            except (TypeError, ValueError):
+                raise ValueError(f"placement {placement_id!r}: podCandidates must be an integer") from None
+            if self.pod_candidates < 1:
+                raise ValueError(f"placement {placement_id!r}: podCandidates must be at least 1")
+
+    def _template(self, adapter, ttl, config, duration=None):
+        # The "*" profile answers for whichever placement was asked for, so its id varies too.
+        placement_id = _PLACEMENT_ID if self.placement_id == DEFAULT_PLACEMENT else quote(self.placement_id, safe="")
+
+        def url(pattern):
+            # {bidId} varies per response; the rest is fixed per template.
+            return (pattern.replace("{placementId}", placement_id)
+                    .replace("{adapter}", quote(adapter, safe="")).replace("{bidId}", _BID_ID))
+
+        base = config.get("trackingBase", "")
+        tracking = {event: f"{base}/{event}?bid={{bidId}}" for event in TRACKING_EVENTS}
+        tracking.update(config.get("tracking", {}))
+        return _compile({
+            "requestId": _REQUEST_ID,
+            "bidId": _BID_ID,
+            "adapter": adapter,
+            "cpm": _CPM,
+            "currency": config.get("currency", DEFAULT_CURRENCY),
+            "ttlSeconds": ttl,
+            "creativeUrl": url(config.get("creativeUrl", "https://cdn.example.com/{adapter}/{placementId}.mp4")),
+            "tracking": {event: url(pattern) for event, pattern in tracking.items() if pattern is not None},
+            **({} if duration is None else {"durationSeconds": duration}),
+        })
+
+
+def assemble_pod(candidates, break_seconds, slots):
+    """Indices of the ``(cpm, duration)`` candidates worth the most with at most ``slots`` of them in ``break_seconds``.
+
+    A 0/1 knapsack over (ads, seconds). Durations are counted in units of
+    their gcd with the break, so 15s and 30s spots in a 120s break fill an
+    8-unit table. Only the ``slots`` best candidates of each length can
+    ever be used, so the rest are dropped first.
+    """
+    by_duration = {}
+    for index, (cpm, duration) in enumerate(candidates):
+        if 0 < duration <= break_seconds and cpm > 0:
+            by_duration.setdefault(duration, []).append(index)
+    items = [index for indices in by_duration.values()
+             for index in sorted(indices, key=lambda index: -candidates[index][0])[:slots]]
+    if not items:
+        return []
+    unit = functools.reduce(math.gcd, by_duration, break_seconds)
+    capacity = break_seconds // unit
+    # best[k][c]: (total cpm, chosen-item bitmask) for exactly k ads in at most c units, or None.
+    best = [[(0.0, 0)] * (capacity + 1)] + [[None] * (capacity + 1) for _ in range(slots)]
+    for position, index in enumerate(items):
+        cpm, duration = candidates[index]
+        weight = duration // unit
+        for count in range(min(slots, position + 1), 0, -1):
+            previous, row = best[count - 1], best[count]
+            for used in range(capacity, weight - 1, -1):
+                base = previous[used - weight]
+                if base is not None and (row[used] is None or base[0] + cpm > row[used][0]):
+                    row[used] = (base[0] + cpm, base[1] | 1 << position)
+    _total, chosen = max((row[capacity] for row in best if row[capacity] is not None), key=lambda cell: cell[0])
+    return [index for position, index in enumerate(items) if chosen >> position & 1]
+
+
+class OutcomeBatches:
+    """One placement's outcomes drawn ``size`` at a time and served from a lock-free cursor.
+
+    A row is ``(cpm, template index, bid id)`` with a cpm of -1 for no
+    fill, or ``(per-source (latency ms, cpm) answers, bid id)`` for a
+    placement with demand sources. The floor is applied when a row is
+    served. With NumPy installed a batch is a few vectorized draws,
+    otherwise the same distributions are drawn with ``random.Random``.
+    Either way, rows come out in draw order for a given seed.
+
+    ``take`` only calls ``next`` on the batch's ``itertools.count``,
+    which is atomic under the GIL. The thread that runs off the end of
+    a batch takes the lock to draw the next one.
+    """
+
+    def __init__(self, placement, size=DEFAULT_BATCH_SIZE, seed=None):
+        self.placement = placement
+        self.size = size
+        self.rng = random.Random(seed)
+        if numpy is not None:
+            self._generator = numpy.random.default_rng(self.rng.getrandbits(128))
+            if placement.sources:
+                self._batch_draws = [(batch_distribution(source.latency_spec), batch_distribution(source.cpm_spec))
+                                     for source in placement.sources]
+            else:
+                self._batch_cpm = batch_distribution(placement.cpm_spec)
+        self._lock = threading.Lock()
+        self.drawn = 0
+        self._current = (self._draw(), itertools.count())
+
+    def take(self):
+        while True:
+            rows, cursor = self._current
+            index = next(cursor)
+            if index < len(rows):
+                return rows[index]
+            with self._lock:
+                if self._current[0] is rows:
+                    self._current = (self._draw(), itertools.count())
+
+    def _draw(self):
+        self.drawn += 1
+        placement, n = self.placement, self.size
+        if numpy is None:
+            rng = self.rng
+            if placement.sources:
+                return [(tuple(source.answer(rng) for source in placement.sources), f"{rng.getrandbits(64):016x}")
+                        for _ in range(n)]
+            adapters, rows = len(placement.templates), []
+            for _ in range(n):
+                cpm = round(placement.draw_cpm(rng), 2) if rng.random() < placement.fill_rate else -1.0
+                rows.append((cpm, int(rng.random() * adapters), f"{rng.getrandbits(64):016x}"))
+            return rows
+        gen = self._generator
+        bid_ids = [f"{value:016x}" for value in gen.integers(0, 1 << 64, n, dtype=numpy.uint64).tolist()]
+        if placement.sources:
+            answers = []
+            for source, (latency, cpm) in zip(placement.sources, self._batch_draws):
+                latencies = latency(gen, n)
+                bids = (latencies <= source.timeout) & (gen.random(n) < source.fill_rate)
+                answers.append(zip(latencies.tolist(), numpy.where(bids, numpy.round(cpm(gen, n), 2), -1.0).tolist()))
+            return list(zip(zip(*answers), bid_ids))
+        cpm = numpy.where(gen.random(n) < placement.fill_rate, numpy.round(self._batch_cpm(gen, n), 2), -1.0)
+        return list(zip(cpm.tolist(), gen.integers(0, len(placement.templates), n).tolist(), bid_ids))
+
+    def stats(self):
+        return {"batches": self.drawn, "rows": self.drawn * self.size}
+
+
+class AuctionEngine:
+    """Answers ``{"body": {...}}`` bid requests from per-placement profiles.
+
+    A request wins with its placement's ``fillRate`` and draws a CPM from
+    the placement's distribution; a draw below ``floorCpm`` loses, so
+    raising the floor lowers the fill the SDK sees. Wins are rendered by
+    %-formatting a template compiled once per placement and adapter, so a
+    response costs one string format rather than building and encoding a
+    dict. Placements missing from the config use the ``"*"`` profile.
+
+    With ``sources`` configured, every bid asks each of its placement's
+    demand sources instead. Each source draws its answer time and either
+    times out (``timeoutMs``, capped by ``auctionTimeoutMs``), passes, or
+    bids. The highest bid at or above the floor wins at its own price
+    (first price). The answers are drawn together, so the auction closes
+    when the slowest source answers or times out. ``bid`` returns that
+    time as the response delay, for the caller to wait out on a timer or
+    the event loop rather than on a thread per source.
+
+    With ``batch`` set, each placement's outcomes come from its own
+    OutcomeBatches, seeded from ``seed`` and the placement id, instead of
+    being drawn per bid.
+
+    ``pod`` fills a CTV break in one round trip. It runs several of these
+    auctions at once and keeps the set of winners worth the most that
+    fits the break (see ``assemble_pod``). The ads come back highest CPM
+    first, in play order. Each ad's ``ttlSeconds`` is its adapter's TTL
+    plus the seconds it waits in the break before it plays.
+    """
+
+    def __init__(self, config=None, tracking_base="", seed=None, batch=0):
+        config = DEFAULT_CONFIG if config is None else config
+        skip = ("placements", "seed", "sources", "auctionTimeoutMs")
+        defaults = {key: value for key, value in config.items() if key not in skip}
+        defaults.setdefault("trackingBase", tracking_base)
+        sources = {}
+        for source_config in config.get("sources") or ():
+            source = DemandSource(source_config, config.get("auctionTimeoutMs"))
+            sources[source.source_id] = source
+        placements = dict(config.get("placements") or {})
+        # Top-level keys apply to every placement; "*" adds to them for the rest.
+        fallback = dict(defaults, **placements.pop(DEFAULT_PLACEMENT, {}))
+        self.placements = {DEFAULT_PLACEMENT: Placement(DEFAULT_PLACEMENT, {}, fallback, sources)}
+        for placement_id, profile in placements.items():
+            self.placements[placement_id] = Placement(placement_id, profile, fallback, sources)
+        self.rng = random.Random(seed)
+        self._batches = None
+        if batch:
+            self._batches = {
+                placement_id: OutcomeBatches(placement, batch, None if seed is None else f"{seed}/{placement_id}")
+                for placement_id, placement in self.placements.items()
+            }
+        self._lock = threading.Lock()
+        self._stats = {
+            placement_id: {"bids": 0, "wins": 0, "no_fill": 0, "below_floor": 0, "revenue": 0.0}
+            for placement_id in self.placements
+        }
+        # Pod auctions are counted apart; "unused" cleared the floor but did not make the pod.
+        self._pods = {
+            placement_id: {"pods": 0, "filled": 0, "bids": 0, "wins": 0, "unused": 0, "no_fill": 0,
+                           "below_floor": 0, "revenue": 0.0, "seconds": 0, "break_seconds": 0}
+            for placement_id in self.placements
+        }
+        self._sources = {
+            source_id: {"requests": 0, "bids": 0, "wins": 0, "no_bid": 0, "below_floor": 0, "timeouts": 0,
+                        "revenue": 0.0, "latency": {}}
+            for source_id in sources
+        }
+        self._auction_ms = {}  # sketch bins of fan-out auction durations
+        self.bad_requests = 0
+        self.tracked = {event: 0 for event in TRACKING_EVENTS}
+
+    def _parse(self, body):
+        """``(request, placement id, placement, request id, floor, url id)`` for a bid or pod body.
+
+        An unknown placement is served (and counted) as ``"*"``; ``url id``
+        is then the requested id, URL-quoted for its win URLs, else None.
+        """
+        request = _decode(body.decode("utf-8")) if body else {}
+        request = request.get("body", request) if isinstance(request, dict) else None
+        if not isinstance(request, dict):
+            raise ValueError("expected a JSON object")
+        placement_id = str(request.get("placementId") or "")
+        request_id = request.get("requestId") or f"{self.rng.getrandbits(64):016x}"
+        floor = float(request.get("floorCpm") or 0.0)
+        placement = self.placements.get(placement_id)
+        url_id = None
+        if placement is None or placement_id == DEFAULT_PLACEMENT:
+            url_id = quote(placement_id or DEFAULT_PLACEMENT, safe="")
+            placement_id = DEFAULT_PLACEMENT
+            placement = self.placements[DEFAULT_PLACEMENT]
+        return request, placement_id, placement, request_id, floor, url_id
+
+    def _bad_request(self, kind, exc):
+        with self._lock:
+            self.bad_requests += 1
+        return 400, json.dumps({"error": f"bad {kind} request: {exc}"}).encode("utf-8"), 0.0
+
+    def bid(self, body):
+        """``(status, payload, delay)`` for one /api/v1/rtb/bid body; send 200/204/400 after ``delay`` seconds."""
+        try:
+            _request, placement_id, placement, request_id, floor, url_id = self._parse(body)
+        except (AttributeError, TypeError, ValueError) as exc:
+            return self._bad_request("bid", exc)
+        outcome, cpm, index, bid_id, answers, closes = self._auction(placement_id, placement, floor)
+        with self._lock:
+            self._record(self._stats[placement_id], outcome, cpm, index, answers, closes)
+        if outcome != "wins":
+            return 204, None, closes / 1000
+        return 200, self._render(placement, index, request_id, cpm, bid_id, url_id=url_id), closes / 1000
+
+    def pod(self, body):
+        """``(status, payload, delay)`` for one /api/v1/rtb/pod body: up to ``slots`` ads within ``breakDurationSeconds``."""
+        try:
+            request, placement_id, placement, request_id, floor, url_id = self._parse(body)
+            break_seconds, slots = int(request["breakDurationSeconds"]), int(request["slots"])
+            if not 0 < break_seconds <= MAX_BREAK_SECONDS or not 0 < slots <= MAX_POD_SLOTS:
+                raise ValueError(f"breakDurationSeconds must be 1-{MAX_BREAK_SECONDS} and slots 1-{MAX_POD_SLOTS}")
+        except KeyError as exc:
+            return self._bad_request("pod", f"missing {exc.args[0]}")
+        except (AttributeError, TypeError, ValueError) as exc:
+            return self._bad_request("pod", exc)
+        auctions = [self._auction(placement_id, placement, floor)
+                    for _ in range(placement.pod_candidates or POD_CANDIDATES_PER_SLOT * slots)]
+        # Every cleared auction gets a creative length; the knapsack picks among them.
+        durations = {index: self.rng.choice(placement.durations)
+                     for index, auction in enumerate(auctions) if auction[0] == "wins"}
+        cleared = list(durations)
+        chosen = [cleared[index] for index in assemble_pod(
+            [(auctions[index][1], durations[index]) for index in cleared], break_seconds, slots)]
+        chosen.sort(key=lambda index: -auctions[index][1])
+        seconds = sum(durations[index] for index in chosen)
+        closes = max(auction[5] for auction in auctions)
+        with self._lock:
+            stats = self._pods[placement_id]
+            stats["pods"] += 1
+            stats["filled"] += 1 if chosen else 0
+            stats["seconds"] += seconds
+            stats["break_seconds"] += break_seconds
+            for index, (outcome, cpm, adapter, _bid_id, answers, auction_closes) in enumerate(auctions):
+                if outcome == "wins" and index not in chosen:
+                    outcome = "unused"
+                self._record(stats, outcome, cpm, adapter, answers, auction_closes)
+        if not chosen:
+            return 204, None, closes / 1000
+        ads, offset = [], 0
+        for index in chosen:
+            _outcome, cpm, adapter, bid_id, _answers, _closes = auctions[index]
+            ads.append(self._render(placement, adapter, request_id, cpm, bid_id, (offset, durations[index]), url_id))
+            offset += durations[index]
+        payload = b'{"requestId":%s,"breakDurationSeconds":%d,"durationSeconds":%d,"ads":[%s]}' % (
+            json.dumps(str(request_id)).encode("utf-8"), break_seconds, seconds, b",".join(ads))
+        return 200, payload, closes / 1000
+
+    def _auction(self, placement_id, placement, floor):
+        """One auction: ``(outcome, cpm, template index, bid id, source answers, closes ms)``.
+
+        ``outcome`` is wins, no_fill or below_floor. The template index
+        and bid id are None when ``_render`` should draw them. Answers are
+        ``(source, outcome, latency ms)`` per demand source.
+        """
+        if placement.sources:
+            return self._fan_out(placement_id, placement, floor)
+        if self._batches is not None:
+            cpm, index, bid_id = self._batches[placement_id].take()
+            outcome = "no_fill" if cpm < 0 else "below_floor" if cpm < floor else "wins"
+            return outcome, cpm, index, bid_id, (), 0.0
+        rng = self.rng
+        if rng.random() >= placement.fill_rate:
+            return "no_fill", 0.0, None, None, (), 0.0
+        cpm = round(placement.draw_cpm(rng), 2)
+        return "below_floor" if cpm < floor else "wins", cpm, None, None, (), 0.0
+
+    def _fan_out(self, placement_id, placement, floor):
+        if self._batches is not None:
+            draws, bid_id = self._batches[placement_id].take()
+        else:
+            draws, bid_id = [source.answer(self.rng) for source in placement.sources], None
+        answers = []  # (source, outcome, latency ms)
+        best, winner, closes = -1.0, None, 0.0
+        for index, (source, (latency, cpm)) in enumerate(zip(placement.sources, draws)):
+            if latency > source.timeout:
+                outcome = "timeouts"
+                closes = max(closes, source.timeout)
+            else:
+                closes = max(closes, latency)
+                if cpm < 0:
+                    outcome = "no_bid"
+                else:
+                    outcome = "bids" if cpm >= floor else "below_floor"
+                    if outcome == "bids" and cpm > best:
+                        best, winner = cpm, index
+            answers.append((source, outcome, latency))
+        if winner is not None:
+            outcome = "wins"
+        elif any(answer[1] == "below_floor" for answer in answers):
+            outcome = "below_floor"
+        else:
+            outcome = "no_fill"
+        return outcome, best, winner, bid_id, answers, closes
+
+    def _record(self, stats, outcome, cpm, index, answers, closes):
+        """Count one auction into ``stats`` and its sources' stats; the caller holds the lock."""
+        stats["bids"] += 1
+        stats[outcome] += 1
+        if outcome == "wins":
+            stats["revenue"] += cpm / 1000
+        if not answers:
+            return
+        for position, (source, source_outcome, latency) in enumerate(answers):
+            source_stats = self._sources[source.source_id]
+            source_stats["requests"] += 1
+            source_stats[source_outcome] += 1
+            key = bin_key(latency)
+            source_stats["latency"][key] = source_stats["latency"].get(key, 0) + 1
+            if outcome == "wins" and position == index:
+                source_stats["wins"] += 1
+                source_stats["revenue"] += cpm / 1000
+        key = bin_key(closes)
+        self._auction_ms[key] = self._auction_ms.get(key, 0) + 1
+
+    def _render(self, placement, index, request_id, cpm, bid_id=None, pod=None, url_id=None):
+        """One AuctionWin's JSON; ``pod`` is ``(seconds into the break, duration)`` for a pod ad.
+
+        ``url_id`` fills the placement id into the ``"*"`` profile's URLs.
+        """
+        if index is None:
+            index = int(self.rng.random() * len(placement.templates))
+        if bid_id is None:
+            bid_id = f"{self.rng.getrandbits(64):016x}"
+        if pod is None:
+            template, values = placement.templates[index]
+            return (template % values((json.dumps(str(request_id)), bid_id, cpm, url_id))).encode("utf-8")
+        template, values = placement.pod_templates[index]
+        offset, duration = pod
+        ttl = placement.ttls[index] + offset
+        return (template % values((json.dumps(str(request_id)), bid_id, cpm, url_id, ttl, duration))).encode("utf-8")
+
+    def track(self, event):
+        """Count a tracking beacon; False for an event AuctionWin does not carry."""
+        if event not in self.tracked:
+            return False
+        with self._lock:
+            self.tracked[event] += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "placements": {placement_id: dict(stats) for placement_id, stats in self._stats.items()},
+                "pods": {placement_id: dict(stats) for placement_id, stats in self._pods.items()},
+                "sources": {source_id: dict(stats, latency=dict(stats["latency"]))
+                            for source_id, stats in self._sources.items()},
+                "auction_ms": dict(self._auction_ms),
+                "batches": {placement_id: batches.stats() for placement_id, batches in (self._batches or {}).items()},
+                "bad_requests": self.bad_requests,
+                "tracked": dict(self.tracked),
+            }
+
+
+def render_stats(stats):
+    """Add rates and latency quantiles to ``AuctionEngine.stats`` (possibly merged across workers).
+
+    Sketch bins are additive, so workers' stats are merged first and
+    rendered once.
+    """
+    sources = {}
+    for source_id, raw in stats.get("sources", {}).items():
+        source = {key: value for key, value in raw.items() if key != "latency"}
+        requests = raw.get("requests", 0)
+        for name, key in (("win_rate", "wins"), ("bid_rate", "bids"), ("timeout_rate", "timeouts")):
+            source[name] = raw.get(key, 0) / requests if requests else 0.0
+        source["latency_ms"] = sketch_quantiles(raw.get("latency", {}))[1]
+        sources[source_id] = source
+    pods = {}
+    for placement_id, raw in stats.get("pods", {}).items():
+        pod = pods[placement_id] = dict(raw)
+        pod["duration_fill"] = raw["seconds"] / raw["break_seconds"] if raw.get("break_seconds") else 0.0
+        pod["ads_per_pod"] = raw["wins"] / raw["pods"] if raw.get("pods") else 0.0
+    rendered = dict(stats, sources=sources, pods=pods)
+    if stats.get("batches"):
+        rendered["batch_backend"] = BATCH_BACKEND
+    if stats.get("auction_ms"):
+        rendered["auction_ms"] = sketch_quantiles(stats["auction_ms"])[1]
+    else:
+        rendered.pop("auction_ms", None)
+    return rendered
+
+
+def load_config(path):
+    """Read an auction config file (see DEFAULT_CONFIG for the shape)."""
+    with open(path, encoding="utf-8") as handle:
+        config = json.load(handle)
+    if not isinstance(config, dict) or not isinstance(config.get("placements", {}), dict):
+        raise ValueError(f"{path}: expected an object with a placements object")
+    return config
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Load benchmark for metrics_stub.py engines (requests/sec and latency percentiles)."""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics_stub.py")
+
+# Each metrics request gets its own timestamp (see _next_request) so the stub's
+# dedup window does not drop every upload after the first. Millisecond stamps
+# stay 13 digits wide, so the request's Content-Length never changes.
+_STAMPS = itertools.count(int(time.time() * 1000))
+STAMP = str(next(_STAMPS)).encode("ascii")
+METRICS_BODY = json.dumps({
+    "timestamp": int(STAMP),
+    "sdk": "tvos",
+    "appId": "bench-app",
+    "counters": {"requests_total": 3, "requests_success": 2, "requests_error_timeout": 1},
+    "request_latency_ms": {"p50": 80, "p95": 140, "p99": 210},
+}).encode("utf-8")
+BID_BODY = json.dumps({"body": {"requestId": "bench", "placementId": "bench", "adFormat": "video", "floorCpm": 0}}).encode("utf-8")
+
+
+def _build_requests(version):
+    def post(path, body):
+        return (
+            f"POST {path} {version}\r\nHost: bench\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode("latin-1") + body
+
+    return (
+        f"GET /api/v1/sdk/config?appId=bench-app {version}\r\nHost: bench\r\n\r\n".encode("latin-1"),
+        post("/api/v1/rtb/bid", BID_BODY),
+        post("/api/v1/sdk/metrics", METRICS_BODY),
+    )
+
+
+REQUESTS = _build_requests("HTTP/1.0")
+KEEP_ALIVE_REQUESTS = _build_requests("HTTP/1.1")
+
+
+def _next_request(requests, i):
+    request = requests[i % len(requests)]
+    if STAMP in request:
+        return request.replace(STAMP, str(next(_STAMPS)).encode("ascii"), 1)
+    return request
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"stub did not start on port {port}")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = int((len(sorted_values) - 1) * fraction)
+    return sorted_values[max(0, min(len(sorted_values) - 1, index))]
+
+
+async def _read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1."):
+        raise ConnectionError("bad response")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line[:15].lower() == b"content-length:":
+            length = int(line[15:])
+    if length:
+        await reader.readexactly(length)
+
+
+async def _client(port, deadline, latencies, errors, offset):
+    i = offset
+    while time.monotonic() < deadline:
+        request = _next_request(REQUESTS, i)
+        i += 1
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            if not response.startswith(b"HTTP/1."):
+                raise ConnectionError("bad response")
+        except (OSError, asyncio.IncompleteReadError):
+            errors[0] += 1
+            await asyncio.sleep(0.01)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000.0)
+
+
+async def _keep_alive_client(port, deadline, latencies, errors, offset):
+    i = offset
+    writer = None
+    while time.monotonic() < deadline:
+        request = _next_request(KEEP_ALIVE_REQUESTS, i)
+        i += 1
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            await writer.drain()
+            await _read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            errors[0] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    if writer is not None:
+        writer.close()
+
+
+async def _drive(port, concurrency, duration, keep_alive=False):
+    latencies, errors = [], [0]
+    deadline = time.monotonic() + duration
+    client = _keep_alive_client if keep_alive else _client
+    await asyncio.gather(*(client(port, deadline, latencies, errors, n) for n in range(concurrency)))
+    return latencies, errors[0]
+
+
+def run_engine(engine, concurrency, duration, keep_alive=False, workers=1, auction=False, auction_batch=0):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        METRICS_STUB_PORT=str(port),
+        METRICS_STUB_ENGINE=engine,
+        METRICS_STUB_WORKERS=str(workers),
+        METRICS_ENABLED="true",
+        METRICS_STUB_AUCTION="true" if auction else "",
+        METRICS_STUB_AUCTION_BATCH=str(auction_batch),
+    )
+    proc = subprocess.Popen([sys.executable, STUB], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        started = time.monotonic()
+        latencies, errors = asyncio.run(_drive(port, concurrency, duration, keep_alive))
+        elapsed = time.monotonic() - started
+    finally:
+        proc.terminate()
+        proc.wait()
+    latencies.sort()
+    return {
+        "engine": engine,
+        "keep_alive": keep_alive,
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--keep-alive", action="store_true", help="reuse one HTTP/1.1 connection per client")
+    parser.add_argument("--workers", type=int, default=1, help="stub worker processes (SO_REUSEPORT)")
+    parser.add_argument("--auction", action="store_true", help="answer bids from the stub's auction engine")
+    parser.add_argument("--auction-batch", type=int, default=0,
+                        help="with --auction, pre-draw outcomes in batches of this size")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+    results = [
+        run_engine(engine, args.concurrency, args.duration, args.keep_alive, args.workers, args.auction,
+                   args.auction_batch)
+        for engine in args.engines
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'engine':<10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        print(f"{r['engine']:<10} {r['requests']:>9} {r['errors']:>7} {r['rps']:>9.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Latency and fault injection for metrics_stub.py routes."""
+
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import traceback
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from stub_auction import distribution
+
+ANY_ROUTE = "*"
+
+
+class Fault:
+    """What one request drew: a delay in seconds, then a reset, an injected status and/or a truncated body."""
+
+    __slots__ = ("delay", "status", "reset", "truncate")
+
+    def __init__(self, delay=0.0, status=None, reset=False, truncate=False):
+        self.delay = delay
+        self.status = status
+        self.reset = reset
+        self.truncate = truncate
+
+
+class FaultRule:
+    """One ``rules`` entry: which requests it matches and what they may draw.
+
+    ``latencyMs`` is a distribution (see ``stub_auction.distribution``),
+    ``status`` maps status codes to probabilities, and ``reset`` and
+    ``truncate`` are probabilities. A reset wins over an injected status,
+    which wins over a truncated body.
+    """
+
+    def __init__(self, config):
+        self.route = config.get("route", ANY_ROUTE)
+        self.placement = config.get("placement")
+        self.latency = distribution(config["latencyMs"]) if "latencyMs" in config else None
+        self.statuses = []  # (cumulative probability, status)
+        total = 0.0
+        for status, probability in (config.get("status") or {}).items():
+            total += float(probability)
+            self.statuses.append((total, HTTPStatus(int(status)).value))
+        self.reset = float(config.get("reset", 0.0))
+        self.truncate = float(config.get("truncate", 0.0))
+        if total > 1.0 or not 0.0 <= self.reset <= 1.0 or not 0.0 <= self.truncate <= 1.0:
+            raise ValueError(f"rule for {self.route!r}: probabilities must lie between 0 and 1")
+        self.stats = {"matched": 0, "delayed": 0, "delay_ms": 0.0, "statuses": {}, "resets": 0, "truncated": 0}
+
+    def draw(self, rng):
+        delay = self.latency(rng) / 1000 if self.latency is not None else 0.0
+        status = None
+        if self.statuses:
+            roll = rng.random()
+            for threshold, candidate in self.statuses:
+                if roll < threshold:
+                    status = candidate
+                    break
+        return Fault(delay, status, rng.random() < self.reset, rng.random() < self.truncate)
+
+
+def _placement(query, body):
+    """The request's placementId: from the query string, else from a JSON (or enveloped) body."""
+    values = parse_qs(query).get("placementId")
+    if values:
+        return values[0]
+    try:
+        request = json.loads(body) if body else None
+    except ValueError:
+        return None
+    if isinstance(request, dict):
+        request = request.get("body", request)
+    return request.get("placementId") if isinstance(request, dict) else None
+
+
+class FaultInjector:
+    """Matches requests to ``rules`` (first match wins) and draws their faults.
+
+    Rules for a route are tried in config order, then ``"*"`` rules. A rule
+    with a ``placement`` only matches requests naming that placement, and
+    bodies are only parsed for routes that have such rules.
+    """
+
+    def __init__(self, config, seed=None):
+        self.rules = [FaultRule(rule) for rule in config.get("rules") or ()]
+        wildcard = [rule for rule in self.rules if rule.route == ANY_ROUTE]
+        self._by_route = {}
+        for rule in self.rules:
+            if rule.route != ANY_ROUTE:
+                self._by_route.setdefault(rule.route, []).append(rule)
+        for rules in self._by_route.values():
+            rules.extend(wildcard)
+        self._wildcard = wildcard
+        self._by_placement = {route for route, rules in self._by_route.items()
+                              if any(rule.placement is not None for rule in rules)}
+        self._wildcard_by_placement = any(rule.placement is not None for rule in wildcard)
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def plan(self, target, body=b""):
+        """The Fault for one request, or None when no rule matches."""
+        path, _, query = target.partition("?")
+        rules = self._by_route.get(path)
+        if rules is None:
+            rules = self._wildcard
+            by_placement = self._wildcard_by_placement
+        else:
+            by_placement = path in self._by_placement
+        if not rules:
+            return None
+        placement = _placement(query, body) if by_placement else None
+        for rule in rules:
+            if rule.placement is None or rule.placement == placement:
+                break
+        else:
+            return None
+        fault = rule.draw(self.rng)
+        with self._lock:
+            stats = rule.stats
+            stats["matched"] += 1
+            if fault.delay:
+                stats["delayed"] += 1
+                stats["delay_ms"] += fault.delay * 1000
+            if fault.reset:
+                stats["resets"] += 1
+            elif fault.status is not None:
+                stats["statuses"][fault.status] = stats["statuses"].get(fault.status, 0) + 1
+            elif fault.truncate:
+                stats["truncated"] += 1
+        return fault
+
+    def stats(self):
+        with self._lock:
+            return [
+                dict(rule.stats, route=rule.route, placement=rule.placement, statuses=dict(rule.stats["statuses"]))
+                for rule in self.rules
+            ]
+
+
+class DelayScheduler:
+    """Runs callbacks at their deadlines on one thread.
+
+    Delayed responses from the threaded engine are handed over here, so
+    ten thousand requests waiting out injected latency (or an auction's
+    simulated fan-out) cost ten thousand heap entries instead of ten
+    thousand sleeping handler threads.
+    Callbacks must not block.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._heap = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.high_water = 0
+        self.fired = 0
+        self._thread = threading.Thread(target=self._run, name="fault-timer", daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, callback, *args):
+        entry = (self._clock() + delay, next(self._order), callback, args)
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if len(self._heap) > self.high_water:
+                self.high_water = len(self._heap)
+            if self._heap[0] is entry:
+                # The new deadline is the earliest; wake the timer to shorten its wait.
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._heap or self._heap[0][0] > self._clock()):
+                    self._cond.wait(self._heap[0][0] - self._clock() if self._heap else None)
+                if self._closed:
+                    return
+                due = []
+                now = self._clock()
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap))
+                self.fired += len(due)
+            for _deadline, _order, callback, args in due:
+                try:
+                    callback(*args)
+                except Exception:  # one bad callback must not stop the timer
+                    traceback.print_exc()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._heap), "high_water": self.high_water, "fired": self.fired}
+
+
+def load_config(path):
+    """Read a fault config file: ``{"seed": ..., "rules": [{"route": ..., ...}]}``."""
+    with open(path, encoding="utf-8") as handle:
+        config = json.load(handle)
+    if not isinstance(config, dict) or not isinstance(config.get("rules", []), list):
+        raise ValueError(f"{path}: expected an object with a rules list")
+    return config
@@ -0,0 +1,93 @@
+import asyncio
+import http.client
+import os
+import sys
+import threading
+
+import pytest
+
+# The scripts are run in place rather than installed; import them from the parent directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics_stub  # noqa: E402
+from metrics_aggregates import CounterTotals, LatencyAggregator, WindowAggregator  # noqa: E402
+from metrics_store import CardinalityGuard, ColumnarStore, DedupWindow, RingStore  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    """metrics_stub with fresh stores, the same defaults ``main`` starts from."""
+    saved = dict(metrics_stub.STATE)
+    metrics_stub.STATE.update(
+        metrics=RingStore(), columns=ColumnarStore(), aggregates=WindowAggregator(), latency=LatencyAggregator(),
+        totals=CounterTotals(), cardinality=CardinalityGuard(), dedup=DedupWindow(), log=None, sampler=None,
+        retention=None, sqlite=None, ingest=None, auction=None, faults=None, timer=None,
+    )
+    metrics_stub.EXPOSITION.__init__()
+    try:
+        yield metrics_stub
+    finally:
+        for name in ("ingest", "sqlite", "timer"):
+            if metrics_stub.STATE[name] is not None:
+                metrics_stub.STATE[name].close()
+        metrics_stub.STATE.update(saved)
+        metrics_stub.LISTENERS.clear()
+
+
+def _start_threaded():
+    server = metrics_stub.StubHTTPServer(("127.0.0.1", 0), metrics_stub.Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    return server.server_address[1], stop
+
+
+def _start_asyncio():
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(metrics_stub._serve_connection, "127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        async def close():
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return server.sockets[0].getsockname()[1], stop
+
+
+@pytest.fixture(params=metrics_stub.ENGINES)
+def server(request, stub):
+    """``(engine, port)`` of a stub serving on an ephemeral port, once per engine."""
+    port, stop = (_start_asyncio if request.param == "asyncio" else _start_threaded)()
+    try:
+        yield request.param, port
+    finally:
+        stop()
+
+
+@pytest.fixture
+def fetch(server):
+    """``fetch(method, path, body=None, headers=None) -> (status, headers, body)`` on a new connection."""
+    _engine, port = server
+
+    def fetch(method, path, body=None, headers=None, timeout=10):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, {k.lower(): v for k, v in response.getheaders()}, response.read()
+        finally:
+            conn.close()
+
+    return fetch
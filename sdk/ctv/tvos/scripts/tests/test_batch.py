@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from metrics_store import iter_batch
+
+
+def upload(i):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": "app", "counters": {"n": i}})
+
+
+def post_batch(stub, body, key=None):
+    headers = {} if key is None else {"idempotency-key": key}
+    status, payload, _content_type = stub.dispatch("POST", "/api/v1/sdk/metrics/batch", headers, body)[:3]
+    return status, json.loads(payload)
+
+
+def test_ndjson_and_array_batches_split_into_the_same_items():
+    items = [upload(i) for i in range(3)]
+    ndjson = [text for text, _record in iter_batch("\n".join(items[:2]) + "\n\n" + items[2] + "\n")]
+    array = [text for text, _record in iter_batch(" [ " + ",\n".join(items) + " ] ")]
+    assert ndjson == array == items
+    assert list(iter_batch("[]")) == []
+
+
+@pytest.mark.parametrize("body", ["[" + upload(0) + ", {oops}]", "[" + upload(0), "[" + upload(0) + "] x"])
+def test_a_broken_array_is_rejected_as_a_whole(body):
+    with pytest.raises(ValueError):
+        list(iter_batch(body))
+
+
+def test_bad_items_are_reported_by_index_and_the_rest_stored(stub):
+    body = "\n".join([upload(0), "not json", "[1, 2]", upload(1)]).encode("utf-8")
+    assert post_batch(stub, body) == (200, {"accepted": 2, "rejected": 2, "duplicates": 0, "rejected_items": [1, 2]})
+    assert len(stub.STATE["metrics"]) == 2
+    assert stub.STATE["totals"].snapshot() == ({("app", "tvos"): 2}, {("app", "tvos", "n"): 1})
+
+
+def test_a_malformed_body_gets_400(stub):
+    status, report = post_batch(stub, ("[" + upload(0) + ", nope]").encode("utf-8"))
+    assert status == 400 and report["accepted"] == 0
+    assert post_batch(stub, b"\xff\xfe")[0] == 400
+    assert len(stub.STATE["metrics"]) == 0
+
+
+def test_replaying_a_keyed_batch_drops_every_item(stub):
+    body = ("[" + ", ".join(upload(i) for i in range(3)) + "]").encode("utf-8")
+    assert post_batch(stub, body, "batch-1")[1]["duplicates"] == 0
+    assert post_batch(stub, body, "batch-1")[1] == {"accepted": 3, "rejected": 0, "duplicates": 3}
+    assert len(stub.STATE["metrics"]) == 3
+
+
+def test_batches_over_http(fetch):
+    body = "\n".join(upload(i) for i in range(4)).encode("utf-8")
+    status, _headers, payload = fetch("POST", "/api/v1/sdk/metrics/batch", body)
+    assert (status, json.loads(payload)["accepted"]) == (200, 4)
+    assert len(json.loads(fetch("GET", "/admin/metrics")[2])) == 4
@@ -0,0 +1,47 @@
+import json
+
+from metrics_store import OVERFLOW_KEY, CardinalityGuard
+
+
+def record(app, *names):
+    return {"appId": app, "sdk": "tvos", "timestamp": 1, "counters": {name: 1 for name in names}, "latency": None}
+
+
+def test_names_past_the_per_app_cap_fold_into_other():
+    guard = CardinalityGuard(max_keys_per_app=2)
+    assert guard.apply(record("a", "x", "y"))["counters"] == {"x": 1, "y": 1}
+    assert guard.apply(record("a", "x", "z", "w"))["counters"] == {"x": 1, OVERFLOW_KEY: 2}
+    # Another app has its own allowance and shares the interned strings.
+    assert guard.apply(record("b", "z", "x"))["counters"] == {"z": 1, "x": 1}
+    stats = guard.stats()
+    assert (stats["folded_keys"], stats["folded_uploads"]) == (2, 1)
+    assert stats["limited_apps"] == {"a": {"keys": 2, "folded_keys": 2}}
+
+
+def test_cycled_apps_are_evicted_least_recent_first():
+    guard = CardinalityGuard(max_keys_per_app=1, max_apps=3)
+    for i in range(1_000):
+        guard.apply(record(f"app-{i}", "x", "y"))
+    stats = guard.stats()
+    assert (stats["apps"], stats["evicted_apps"]) == (3, 997)
+    assert set(stats["limited_apps"]) == {"app-997", "app-998", "app-999"}
+    # Seeing an app again makes it the most recent; the oldest other app goes next.
+    guard.apply(record("app-997", "x"))
+    guard.apply(record("new", "x"))
+    assert set(guard.stats()["limited_apps"]) == {"app-997", "app-999"}
+
+
+def test_interned_names_are_capped_across_apps():
+    guard = CardinalityGuard(max_keys_per_app=10, max_names=3)  # __other__ plus two names
+    guard.apply(record("a", "x", "y"))
+    assert guard.apply(record("b", "x", "fresh"))["counters"] == {"x": 1, OVERFLOW_KEY: 1}
+    assert guard.stats()["interned_names"] == 3
+
+
+def test_cardinality_route_reports_evictions(stub):
+    stub.STATE["cardinality"] = CardinalityGuard(max_apps=1)
+    for app in ("a", "b"):
+        stub.record_upload(json.dumps({"timestamp": 1, "sdk": "tvos", "appId": app, "counters": {"n": 1}}))
+    status, body, _content_type = stub.dispatch("GET", "/admin/cardinality", {})[:3]
+    assert status == 200
+    assert (json.loads(body)["apps"], json.loads(body)["evicted_apps"]) == (1, 1)
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def config(stub):
+    """The stub with its shared feature flag restored after the test."""
+    enabled = bool(stub.STATE["metrics_enabled"].value)
+    try:
+        yield stub
+    finally:
+        stub.set_metrics_enabled(enabled)
+
+
+def get_config(stub, if_none_match=None):
+    headers = {} if if_none_match is None else {"if-none-match": if_none_match}
+    status, payload, _content_type, extra = stub.dispatch("GET", "/api/v1/sdk/config", headers)
+    return status, payload, dict(extra)
+
+
+def test_config_is_encoded_once_per_version(config):
+    status, payload, headers = get_config(config)
+    assert status == 200
+    assert headers["Cache-Control"] == "no-cache"
+    assert get_config(config)[1] is payload
+    assert json.loads(payload)["version"] == config.STATE["config_version"].value
+
+
+def test_matching_etags_get_304_without_a_body(config):
+    _status, payload, headers = get_config(config)
+    etag = headers["ETag"]
+    before = dict(config.CONFIG_STATS)
+    assert get_config(config, etag) == (304, None, headers)
+    assert get_config(config, f'"stale", {etag}')[0] == 304
+    assert get_config(config, "*")[0] == 304
+    assert get_config(config, '"stale"')[:2] == (200, payload)
+    after = config.CONFIG_STATS
+    assert after["not_modified"] - before["not_modified"] == 3
+    assert after["bytes_sent"] - before["bytes_sent"] == len(payload)
+
+
+def test_toggling_changes_the_etag_only_on_a_real_change(config):
+    config.set_metrics_enabled(True)
+    etag = get_config(config)[2]["ETag"]
+    config.set_metrics_enabled(True)
+    assert get_config(config, etag)[0] == 304
+    config.dispatch("POST", "/admin/toggle_metrics?enabled=false", {})
+    status, payload, headers = get_config(config, etag)
+    assert status == 200 and headers["ETag"] != etag
+    assert json.loads(payload)["features"]["metricsEnabled"] is False
+
+
+def test_304_over_http_has_no_body(fetch, config):
+    _status, headers, _body = fetch("GET", "/api/v1/sdk/config")
+    status, headers, body = fetch("GET", "/api/v1/sdk/config", headers={"If-None-Match": headers["etag"]})
+    assert (status, body) == (304, b"")
+    assert "content-length" not in headers
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from metrics_store import DedupWindow, parse_upload, upload_key
+
+
+def upload(i, **extra):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": "app", "counters": {"n": i, "m": 1}, **extra})
+
+
+def post(stub, body, key=None):
+    headers = {} if key is None else {"idempotency-key": key}
+    return stub.dispatch("POST", "/api/v1/sdk/metrics", headers, body.encode("utf-8"))[0]
+
+
+def test_content_keys_ignore_field_order_and_extra_fields():
+    record = parse_upload(upload(1))
+    reordered = parse_upload(json.dumps({"counters": {"m": 1, "n": 1}, "appId": "app", "timestamp": 1_001,
+                                         "sdk": "tvos", "deviceModel": "AppleTV"}))
+    assert upload_key(record) == upload_key(reordered)
+    assert upload_key(record) != upload_key(parse_upload(upload(2)))
+    assert upload_key(record, "k1") == upload_key(None, "k1") != upload_key(record)
+    assert upload_key(None) is None
+
+
+def test_window_forgets_the_least_recently_seen_key():
+    window = DedupWindow(max_keys=2)
+    assert not window.seen(b"a") and not window.seen(b"b")
+    assert window.seen(b"a")  # "a" is now the most recent
+    assert not window.seen(b"c")  # evicts "b"
+    assert window.seen(b"a") and not window.seen(b"b")
+    assert window.stats() == {"keys": 2, "max_keys": 2, "checked": 6, "duplicates": 2, "forgotten": 2}
+
+
+def test_retried_uploads_are_dropped(stub):
+    assert [post(stub, upload(1)) for _ in range(3)] == [200] * 3
+    assert post(stub, upload(2), key="k") == post(stub, upload(3), key="k") == 200
+    assert len(stub.STATE["metrics"]) == 2
+    assert stub.STATE["dedup"].stats()["duplicates"] == 3
+
+
+def test_a_failed_store_releases_its_keys(stub, monkeypatch):
+    def broken(texts, records):
+        raise RuntimeError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(stub, "record_uploads", broken)
+        with pytest.raises(RuntimeError):
+            stub.store_uploads([upload(1)], [parse_upload(upload(1))], ["retry-me"])
+    # The retry of the failed upload is stored, not dropped as a duplicate.
+    assert stub.store_uploads([upload(1)], [parse_upload(upload(1))], ["retry-me"]) == ([upload(1)], 0)
+
+
+def test_dedup_can_be_turned_off(stub):
+    stub.STATE["dedup"] = None
+    post(stub, upload(1))
+    post(stub, upload(1))
+    assert len(stub.STATE["metrics"]) == 2
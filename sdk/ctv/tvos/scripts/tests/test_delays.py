@@ -0,0 +1,53 @@
+import http.client
+import json
+import threading
+import time
+
+from stub_auction import AuctionEngine
+from stub_faults import DelayScheduler, FaultInjector
+
+AUCTION = {"sources": [{"id": "slow", "latencyMs": 150, "cpm": 2.0}]}
+FAULTS = {"rules": [{"route": "/api/v1/sdk/config", "latencyMs": 150}]}
+BID = json.dumps({"body": {"placementId": "home", "requestId": "r1"}}).encode("utf-8")
+
+
+def delayed(stub):
+    stub.STATE["timer"] = DelayScheduler()
+    stub.STATE["auction"] = AuctionEngine(AUCTION, seed=1)
+    stub.STATE["faults"] = FaultInjector(FAULTS, seed=1)
+
+
+def handler_threads():
+    return [thread for thread in threading.enumerate() if "process_request_thread" in thread.name]
+
+
+def test_delayed_responses_keep_the_connection_alive(stub, server):
+    engine, port = server
+    delayed(stub)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        for method, path, body in [("POST", "/api/v1/rtb/bid", BID), ("GET", "/api/v1/sdk/config", None)] * 2:
+            started = time.monotonic()
+            conn.request(method, path, body=body)
+            if engine == "threaded":
+                time.sleep(0.05)
+                # The delay is waited out on the timer, not on a handler thread.
+                assert handler_threads() == []
+            response = conn.getresponse()
+            response.read()
+            assert time.monotonic() - started >= 0.14
+            assert response.status == 200
+            assert response.getheader("Connection") == "keep-alive"
+            if path == "/api/v1/rtb/bid":
+                sock = conn.sock
+            assert conn.sock is sock
+    finally:
+        conn.close()
+
+
+def test_delayed_responses_close_when_asked(stub, fetch):
+    delayed(stub)
+    started = time.monotonic()
+    status, headers, _body = fetch("POST", "/api/v1/rtb/bid", BID, {"Connection": "close"})
+    assert time.monotonic() - started >= 0.14
+    assert (status, headers["connection"]) == (200, "close")
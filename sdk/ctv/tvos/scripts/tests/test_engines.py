@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+UPLOAD = json.dumps({"timestamp": 1_000, "sdk": "tvos", "appId": "app", "counters": {"plays": 2}}).encode("utf-8")
+
+
+def test_both_engines_serve_the_same_routes(fetch):
+    status, headers, body = fetch("GET", "/api/v1/sdk/config")
+    assert (status, headers["content-type"]) == (200, "application/json")
+    assert json.loads(body)["features"]["metricsEnabled"] in (True, False)
+    assert fetch("POST", "/api/v1/sdk/metrics", UPLOAD)[:1] == (200,)
+    status, _headers, body = fetch("GET", "/admin/metrics")
+    assert (status, json.loads(body)) == (200, [UPLOAD.decode("utf-8")])
+    status, _headers, body = fetch("GET", "/admin/aggregates")
+    assert status == 200 and json.loads(body)
+    assert fetch("GET", "/nowhere")[0] == 404
+    assert fetch("POST", "/nowhere", b"{}")[0] == 404
+
+
+@pytest.mark.parametrize("route", ["/api/v1/rtb/bid", "/api/v1/rtb/pod"])
+def test_both_engines_answer_bids_without_an_auction(fetch, route):
+    status, headers, body = fetch("POST", route, b'{"body": {}}')
+    assert (status, body) == (204, b"")
+    assert "content-length" not in headers
+
+
+def test_both_engines_count_requests_for_metrics(stub, fetch):
+    fetch("GET", "/api/v1/sdk/config")
+    fetch("GET", "/nowhere")
+    assert stub.REQUEST_STATS[("GET", "/api/v1/sdk/config", 200)][0] >= 1
+    assert stub.REQUEST_STATS[("GET", "other", 404)][0] >= 1
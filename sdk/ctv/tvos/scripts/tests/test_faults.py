@@ -0,0 +1,110 @@
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from stub_faults import DelayScheduler, FaultInjector
+
+
+def injector(*rules, seed=1):
+    return FaultInjector({"rules": list(rules)}, seed)
+
+
+def test_rules_match_by_route_then_placement_then_wildcard():
+    faults = injector({"route": "/api/v1/rtb/bid", "placement": "home", "status": {"503": 1.0}},
+                      {"route": "/api/v1/rtb/bid", "reset": 1.0},
+                      {"route": "*", "truncate": 1.0})
+    assert faults.plan("/api/v1/rtb/bid", b'{"body": {"placementId": "home"}}').status == 503
+    assert faults.plan("/api/v1/rtb/bid?placementId=home").status == 503
+    assert faults.plan("/api/v1/rtb/bid", b'{"placementId": "row"}').reset
+    assert faults.plan("/api/v1/sdk/config").truncate
+    assert [rule["matched"] for rule in faults.stats()] == [2, 1, 1]
+    assert faults.stats()[0]["statuses"] == {503: 2}
+
+
+def test_no_matching_rule_means_no_fault():
+    faults = injector({"route": "/api/v1/rtb/bid", "placement": "home", "latencyMs": 5})
+    assert faults.plan("/api/v1/sdk/config") is None
+    assert faults.plan("/api/v1/rtb/bid", b"not json") is None
+
+
+def test_latency_draws_are_seeded():
+    rule = {"route": "*", "latencyMs": {"dist": "uniform", "min": 10, "max": 20}}
+    delays = [injector(rule, seed=7).plan("/x").delay for _ in range(2)]
+    assert delays[0] == delays[1] and 0.01 <= delays[0] <= 0.02
+
+
+@pytest.mark.parametrize("rule", [{"status": {"500": 0.7, "503": 0.4}}, {"reset": 1.5}, {"truncate": -0.1}])
+def test_bad_probabilities_are_rejected(rule):
+    with pytest.raises(ValueError):
+        injector(rule)
+
+
+def test_scheduler_fires_callbacks_in_deadline_order():
+    timer = DelayScheduler()
+    fired, done = [], threading.Event()
+    try:
+        timer.call_later(0.2, lambda: (fired.append("late"), done.set()))
+        timer.call_later(0.05, fired.append, "early")
+        timer.call_later(0.1, lambda: 1 / 0)  # a failing callback does not stop the timer
+        assert done.wait(5)
+        assert fired == ["early", "late"]
+        assert timer.stats() == {"pending": 0, "high_water": 3, "fired": 3}
+    finally:
+        timer.close()
+
+
+@pytest.fixture
+def faulted(stub, server):
+    _engine, port = server
+    stub.STATE["timer"] = DelayScheduler()
+
+    def use(*rules):
+        stub.STATE["faults"] = injector(*rules)
+        return http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+
+    return use
+
+
+def test_injected_status_replaces_the_route(faulted):
+    conn = faulted({"route": "/api/v1/sdk/config", "status": {"503": 1.0}})
+    conn.request("GET", "/api/v1/sdk/config")
+    response = conn.getresponse()
+    assert response.status == 503
+    response.read()
+    # Admin routes are never faulted.
+    conn.request("GET", "/admin/metrics")
+    assert conn.getresponse().status == 200
+    conn.close()
+
+
+def test_reset_drops_the_connection(faulted):
+    conn = faulted({"route": "/api/v1/sdk/config", "reset": 1.0})
+    conn.request("GET", "/api/v1/sdk/config")
+    with pytest.raises((ConnectionError, http.client.RemoteDisconnected)):
+        conn.getresponse()
+    conn.close()
+
+
+def test_truncate_sends_half_the_body_and_closes(faulted):
+    conn = faulted({"route": "/api/v1/sdk/config", "truncate": 1.0})
+    conn.request("GET", "/api/v1/sdk/config")
+    response = conn.getresponse()
+    assert response.getheader("Connection") == "close"
+    with pytest.raises(http.client.IncompleteRead):
+        response.read()
+    conn.close()
+
+
+def test_injected_delay_holds_the_response(faulted):
+    conn = faulted({"route": "/api/v1/sdk/metrics", "latencyMs": 150})
+    started = time.monotonic()
+    body = json.dumps({"appId": "app", "sdk": "tvos", "counters": {}})
+    conn.request("POST", "/api/v1/sdk/metrics", body=body)
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 200
+    assert time.monotonic() - started >= 0.14
+    conn.close()
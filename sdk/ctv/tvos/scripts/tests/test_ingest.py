@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+
+from metrics_ingest import IngestQueue
+
+
+def upload(i):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": "app", "counters": {"n": i}})
+
+
+def test_bodies_reach_the_sink_in_batches():
+    seen = []
+    queue = IngestQueue(lambda batch: seen.extend(batch), workers=1, batch=4)
+    try:
+        for i in range(10):
+            assert queue.offer(i)
+        assert queue.drain(10)
+        assert sorted(seen) == list(range(10))
+        stats = queue.stats()
+        assert (stats["processed"], stats["errors"], stats["depth"], stats["in_flight"]) == (10, 0, 0, 0)
+    finally:
+        queue.close()
+
+
+def test_a_full_queue_refuses_and_a_closed_one_too():
+    release = threading.Event()
+    queue = IngestQueue(lambda batch: release.wait(10) and None, max_depth=2, workers=1, batch=1)
+    try:
+        queue.offer("held")  # taken by the worker, which then blocks
+        while queue.stats()["in_flight"] == 0:
+            time.sleep(0.001)
+        assert queue.offer("a") and queue.offer("b")
+        assert not queue.offer("c")
+        assert (queue.stats()["rejected"], queue.stats()["high_water"]) == (1, 2)
+    finally:
+        release.set()
+        queue.close()
+    assert queue.closed and not queue.offer("late")
+    # Closing lets the workers finish what was already queued.
+    assert queue.stats()["processed"] == 3
+
+
+def test_sink_failures_are_counted_and_the_workers_keep_going():
+    def sink(batch):
+        if "boom" in batch:
+            raise RuntimeError("boom")
+        return sum(1 for item in batch if item == "bad")
+
+    queue = IngestQueue(sink, workers=1, batch=1)
+    try:
+        for item in ("ok", "boom", "bad", "ok"):
+            queue.offer(item)
+        assert queue.drain(10)
+        assert (queue.stats()["processed"], queue.stats()["errors"]) == (2, 2)
+    finally:
+        queue.close()
+
+
+def test_queued_uploads_are_stored_after_the_reply(stub):
+    stub.STATE["ingest"] = IngestQueue(stub.ingest_bodies, workers=2, batch=8)
+    for i in range(20):
+        assert stub.dispatch("POST", "/api/v1/sdk/metrics", {}, upload(i).encode("utf-8"))[0] == 200
+    assert stub.STATE["ingest"].drain(10)
+    assert len(stub.STATE["metrics"]) == 20
+    stats = json.loads(stub.dispatch("GET", "/admin/ingest_stats", {})[1])
+    assert (stats["enqueued"], stats["processed"]) == (20, 20)
+
+
+def test_a_full_queue_answers_429_and_a_closed_one_503(stub):
+    release = threading.Event()
+    stub.STATE["ingest"] = IngestQueue(lambda batch: release.wait(10) and None, max_depth=1, workers=1, batch=1)
+    try:
+        statuses = [stub.dispatch("POST", "/api/v1/sdk/metrics", {}, upload(i).encode("utf-8"))
+                    for i in range(5)]
+        rejected = [response for response in statuses if response[0] == 429]
+        assert rejected and dict(rejected[0][3])["Retry-After"] == "1"
+    finally:
+        release.set()
+    stub.STATE["ingest"].close()
+    assert stub.dispatch("POST", "/api/v1/sdk/metrics", {}, upload(9).encode("utf-8"))[0] == 503
@@ -0,0 +1,73 @@
+import http.client
+import socket
+
+
+def read_response(stream):
+    """One response's bytes from ``stream`` (a socket's makefile); the body length comes from Content-Length."""
+    head, length = b"", 0
+    for line in iter(stream.readline, b""):
+        head += line
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+        if line == b"\r\n":
+            break
+    return head + stream.read(length)
+
+
+def test_http11_connections_are_reused(server):
+    _engine, port = server
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        socks = set()
+        for _ in range(3):
+            conn.request("GET", "/api/v1/sdk/config")
+            response = conn.getresponse()
+            response.read()
+            assert (response.status, response.getheader("Connection")) == (200, "keep-alive")
+            socks.add(conn.sock)
+        assert len(socks) == 1
+    finally:
+        conn.close()
+
+
+def test_pipelined_requests_are_answered_in_order(server):
+    _engine, port = server
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+        sock.sendall(b"GET /api/v1/sdk/config HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /nowhere HTTP/1.1\r\nHost: x\r\n\r\n")
+        stream = sock.makefile("rb")
+        assert read_response(stream).startswith(b"HTTP/1.1 200 ")
+        assert read_response(stream).startswith(b"HTTP/1.1 404 ")
+
+
+def test_http10_and_connection_close_end_the_connection(server):
+    _engine, port = server
+    for request in (b"GET /api/v1/sdk/config HTTP/1.0\r\n\r\n",
+                    b"GET /api/v1/sdk/config HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"):
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+            sock.sendall(request)
+            stream = sock.makefile("rb")
+            assert b"\r\nConnection: close\r\n" in read_response(stream)
+            assert stream.read(1) == b""
+
+
+def test_http10_keep_alive_is_honored(server):
+    _engine, port = server
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+        stream = sock.makefile("rb")
+        for _ in range(2):
+            sock.sendall(b"GET /api/v1/sdk/config HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+            assert b"\r\nConnection: keep-alive\r\n" in read_response(stream)
+
+
+def test_responses_are_rendered_into_one_buffer(stub):
+    data = stub.render_response(200, b'{"ok":1}', "application/json", [("ETag", '"v1"')], keep_alive=True)
+    head, _, body = data.partition(b"\r\n\r\n")
+    assert body == b'{"ok":1}'
+    lines = head.split(b"\r\n")
+    assert lines[0] == b"HTTP/1.1 200 OK"
+    assert {b'ETag: "v1"', b"Content-Length: 8", b"Connection: keep-alive"} <= set(lines)
+    # 204 and 304 carry neither a body nor a Content-Length.
+    data = stub.render_response(304, b"ignored", "application/json")
+    assert data.endswith(b"Connection: close\r\n\r\n")
+    assert b"Content-Length" not in data
@@ -0,0 +1,136 @@
+import json
+import math
+
+import pytest
+
+from metrics_aggregates import (
+    MAX_SKETCH_BINS,
+    SKETCH_MAX_MS,
+    SKETCH_MIN_MS,
+    WindowAggregator,
+    bin_key,
+    sketch_bins,
+    sketch_quantiles,
+)
+
+
+class Clock:
+    def __init__(self, now=6_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def record(app, sdk="tvos", **counters):
+    return {"appId": app, "sdk": sdk, "timestamp": 1, "counters": counters, "latency": None}
+
+
+def sliding(aggregator, window="1m"):
+    return aggregator.snapshot([window], ("sliding",))["windows"][window]["sliding"]
+
+
+def test_windows_total_counters_per_app_sdk_and_fleet():
+    aggregator = WindowAggregator(clock=Clock())
+    aggregator.add_many([record("a", plays=2), record("a", "android", plays=1, errors=1), record("b", plays=5)])
+    totals = sliding(aggregator)
+    assert totals["app"] == {"a": {"plays": 3, "errors": 1, "uploads": 2}, "b": {"plays": 5, "uploads": 1}}
+    assert totals["sdk"] == {"tvos": {"plays": 7, "uploads": 2}, "android": {"plays": 1, "errors": 1, "uploads": 1}}
+    assert totals["all"] == {"*": {"plays": 8, "errors": 1, "uploads": 3}}
+
+
+def test_sliding_windows_drop_uploads_older_than_the_window():
+    clock = Clock()
+    aggregator = WindowAggregator(clock=clock)
+    aggregator.add(record("a", plays=1))
+    clock.now += 30
+    aggregator.add(record("a", plays=2))
+    clock.now += 31
+    assert sliding(aggregator)["app"]["a"] == {"plays": 2, "uploads": 1}
+    assert sliding(aggregator, "5m")["app"]["a"] == {"plays": 3, "uploads": 2}
+    clock.now += 60
+    # Counters that reach zero are removed rather than reported as 0.
+    assert sliding(aggregator) == {}
+
+
+def test_tumbling_windows_keep_the_previous_period():
+    clock = Clock(6_000.0)  # the start of a 1m period
+    aggregator = WindowAggregator(clock=clock)
+    aggregator.add(record("a", plays=1))
+    clock.now += 60
+    aggregator.add(record("a", plays=4))
+    tumbling = aggregator.snapshot(["1m"], ("tumbling",))["windows"]["1m"]["tumbling"]
+    assert tumbling["start"] == 6_060_000
+    assert (tumbling["previous"]["app"]["a"]["plays"], tumbling["current"]["app"]["a"]["plays"]) == (1, 4)
+    # A period with no uploads in between leaves nothing to call "previous".
+    clock.now += 120
+    tumbling = aggregator.snapshot(["1m"], ("tumbling",))["windows"]["1m"]["tumbling"]
+    assert (tumbling["previous"], tumbling["current"]) == ({}, {})
+
+
+def test_aggregates_route(stub):
+    stub.record_upload(json.dumps({"timestamp": 1, "sdk": "tvos", "appId": "a", "counters": {"plays": 2}}))
+    status, body, _content_type = stub.dispatch("GET", "/admin/aggregates?window=5m&mode=sliding", {})[:3]
+    snapshot = json.loads(body)
+    assert status == 200
+    assert list(snapshot["windows"]) == ["5m"]
+    assert snapshot["windows"]["5m"]["sliding"]["all"]["*"] == {"plays": 2, "uploads": 1}
+    assert stub.dispatch("GET", "/admin/aggregates?window=2m", {})[0] == 400
+
+
+def index(key):
+    return int(key[1:])
+
+
+def test_sketch_bins_accepts_dict_and_pair_forms():
+    expected = {"b10": 3, "b20": 1, "zero": 2}
+    assert sketch_bins({"bins": {"10": 3, "20": 1}, "zeroCount": 2}) == expected
+    assert sketch_bins({"alpha": 0.01, "bins": [[10, 3], [20, 1]], "zeroCount": 2}) == expected
+
+
+def test_sketch_bins_skips_empty_counts():
+    assert sketch_bins({"bins": {"10": 0, "11": -4, "12": 1}}) == {"b12": 1}
+    assert sketch_bins({"bins": {"10": 0}}) is None
+    assert sketch_bins({}) is None
+
+
+@pytest.mark.parametrize("sketch", [
+    None,
+    [1, 2],
+    {"alpha": 0, "bins": {"1": 1}},
+    {"alpha": 1, "bins": {"1": 1}},
+    {"alpha": "x", "bins": {"1": 1}},
+    {"bins": {"x": 1}},
+    {"bins": {"1": "many"}},
+    {"bins": [[1]]},
+])
+def test_sketch_bins_rejects_malformed_sketches(sketch):
+    assert sketch_bins(sketch) is None
+
+
+def test_sketch_bins_clamps_indexes_to_the_latency_range():
+    low, high = index(bin_key(SKETCH_MIN_MS)), index(bin_key(SKETCH_MAX_MS))
+    bins = sketch_bins({"bins": {"100000": 2, "-100000": 3, str(high - 1): 1}})
+    assert bins == {f"b{high}": 2, f"b{low}": 3, f"b{high - 1}": 1}
+    # Huge indexes from another alpha are re-binned in log space without overflowing.
+    assert sketch_bins({"alpha": 0.5, "bins": {str(10 ** 30): 1}}) == {f"b{high}": 1}
+    _total, quantiles = sketch_quantiles(bins)
+    assert all(math.isfinite(value) for value in quantiles.values())
+
+
+def test_sketch_bins_caps_bins_per_sketch():
+    assert sketch_bins({"bins": {str(i): 1 for i in range(MAX_SKETCH_BINS)}}) is not None
+    assert sketch_bins({"bins": {str(i): 1 for i in range(MAX_SKETCH_BINS + 1)}}) is None
+    assert sketch_bins({"bins": [[1, 1]] * (MAX_SKETCH_BINS + 1)}) is None
+
+
+@pytest.mark.parametrize("alpha", [0.005, 0.02, 0.05])
+def test_sketch_bins_rebins_other_alphas_near_the_same_value(alpha):
+    gamma = (1 + alpha) / (1 - alpha)
+    for value in (0.5, 12.0, 250.0, 9_000.0):
+        foreign = math.ceil(math.log(value) / math.log(gamma))
+        (key,) = sketch_bins({"alpha": alpha, "bins": {str(foreign): 1}})
+        # Within one bin of where the server would have put the value itself,
+        # plus the width of the coarser source bin.
+        slack = 1 + math.ceil(math.log(gamma) / math.log((1.01) / (0.99)))
+        assert abs(index(key) - index(bin_key(value))) <= slack
@@ -0,0 +1,75 @@
+import json
+import threading
+
+from metrics_exposition import Exposition
+
+
+def samples(uploads):
+    return {("metrics_stub_uploads_total", (("appId", "app"), ("sdk", "tvos"))): uploads,
+            ("metrics_stub_ring_entries", ()): uploads}
+
+
+def test_render_formats_families_and_labels():
+    body = Exposition().render(samples(3)).decode("utf-8")
+    assert body == (
+        "# HELP metrics_stub_ring_entries Raw uploads held in the ring buffer.\n"
+        "# TYPE metrics_stub_ring_entries gauge\n"
+        "metrics_stub_ring_entries 3\n"
+        "# HELP metrics_stub_uploads_total Metrics uploads stored, by app and SDK.\n"
+        "# TYPE metrics_stub_uploads_total counter\n"
+        'metrics_stub_uploads_total{appId="app",sdk="tvos"} 3\n'
+    )
+
+
+def test_latency_quantiles_are_a_summary():
+    body = Exposition().render({("metrics_stub_request_latency_ms", (("appId", "a"), ("quantile", "0.5"))): 1.5})
+    assert b"# TYPE metrics_stub_request_latency_ms summary\n" in body
+    assert b'metrics_stub_request_latency_ms{appId="a",quantile="0.5"} 1.5\n' in body
+
+
+def test_default_cache_outlives_a_scrape_interval():
+    assert Exposition().max_age >= 5
+
+
+def test_cached_body_expires_after_max_age():
+    clock = [0.0]
+    exposition = Exposition(max_age=5, clock=lambda: clock[0])
+    assert exposition.cached() is None
+    body = exposition.render(samples(1))
+    clock[0] = 4.9
+    assert exposition.cached() is body
+    clock[0] = 5.0
+    assert exposition.cached() is None
+    assert (exposition.renders, exposition.cache_hits) == (1, 1)
+
+
+def test_scopes_are_cached_apart():
+    exposition = Exposition()
+    local = exposition.render(samples(1), scope=False)
+    fleet = exposition.render(samples(4), scope=True)
+    assert exposition.cached(False) is local
+    assert exposition.cached(True) is fleet
+    assert local != fleet
+
+
+def test_cached_reads_wait_for_a_render_in_progress():
+    exposition = Exposition()
+    results = []
+    with exposition._lock:
+        reader = threading.Thread(target=lambda: results.append(exposition.cached()))
+        reader.start()
+        reader.join(0.1)
+        assert reader.is_alive()
+    reader.join()
+    assert results == [None]
+
+
+def test_metrics_route_reuses_the_body_between_scrapes(stub):
+    stub.record_upload(json.dumps({"timestamp": 1, "sdk": "tvos", "appId": "app", "counters": {"n": 1}}))
+    first = stub.dispatch("GET", "/metrics", {})
+    stub.record_upload(json.dumps({"timestamp": 2, "sdk": "tvos", "appId": "app", "counters": {"n": 1}}))
+    second = stub.dispatch("GET", "/metrics", {})
+    assert first[1] is second[1]
+    assert b'metrics_stub_uploads_total{appId="app",sdk="tvos"} 1\n' in first[1]
+    stub.EXPOSITION.__init__(max_age=0)
+    assert b'metrics_stub_uploads_total{appId="app",sdk="tvos"} 2\n' in stub.dispatch("GET", "/metrics", {})[1]
@@ -0,0 +1,144 @@
+import os
+import struct
+
+from metrics_log import SegmentLog
+
+
+class Clock:
+    def __init__(self, now=1_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def fill(directory, count, **options):
+    log = SegmentLog(str(directory), index_every=4, **options)
+    for i in range(count):
+        log.append(f'"upload-{i}"')
+    log.close()
+
+
+def contents(log, **scan):
+    return [(seq, bytes(view).decode("utf-8")) for seq, _ts, view in log.scan(**scan)]
+
+
+def paths(directory):
+    base = os.path.join(str(directory), f"{0:020d}")
+    return base + ".log", base + ".idx"
+
+
+def test_reopen_continues_the_sequence(tmp_path):
+    fill(tmp_path, 10)
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert log.next_seq == 10
+    assert log.append('"after"') == 10
+    assert contents(log)[-2:] == [(9, '"upload-9"'), (10, '"after"')]
+    log.close()
+
+
+def test_reopen_drops_a_torn_record(tmp_path):
+    fill(tmp_path, 10)
+    log_path, _idx_path = paths(tmp_path)
+    size = os.path.getsize(log_path)
+    with open(log_path, "r+b") as handle:
+        handle.truncate(size - 3)
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert log.next_seq == 9
+    assert os.path.getsize(log_path) < size - 3
+    assert log.append('"retry"') == 9
+    assert contents(log)[-2:] == [(8, '"upload-8"'), (9, '"retry"')]
+    log.close()
+
+
+def test_reopen_drops_a_corrupt_record(tmp_path):
+    fill(tmp_path, 6)
+    log_path, _idx_path = paths(tmp_path)
+    with open(log_path, "r+b") as handle:
+        handle.seek(-2, os.SEEK_END)
+        handle.write(b"!!")
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert [seq for seq, _text in contents(log)] == [0, 1, 2, 3, 4]
+    log.close()
+
+
+def test_reopen_ignores_index_entries_past_the_log(tmp_path):
+    fill(tmp_path, 10)
+    log_path, idx_path = paths(tmp_path)
+    # Keep the index but lose every record after the first: the crash lost log writes.
+    with open(log_path, "rb") as handle:
+        first = len(handle.read()) // 10
+    with open(log_path, "r+b") as handle:
+        handle.truncate(first)
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert os.path.getsize(log_path) == first
+    assert log.next_seq == 1
+    for i in range(8):
+        log.append(f'"again-{i}"')
+    log.close()
+    # A second reopen must not trust the stale entries that were cut from the index.
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert contents(log) == [(0, '"upload-0"')] + [(i + 1, f'"again-{i}"') for i in range(8)]
+    assert contents(log, after=6) == [(7, '"again-6"'), (8, '"again-7"')]
+    log.close()
+    assert os.path.getsize(idx_path) % 24 == 0
+
+
+def test_reopen_cuts_an_index_entry_at_a_torn_record(tmp_path):
+    fill(tmp_path, 10)
+    log_path, idx_path = paths(tmp_path)
+    with open(idx_path, "rb") as handle:
+        entries = list(struct.iter_unpack("<qQQ", handle.read()))
+    assert [seq for _ts, seq, _offset in entries] == [0, 4, 8]
+    # The last indexed record (seq 8) is torn: its entry is inside the log but its bytes are not.
+    with open(log_path, "r+b") as handle:
+        handle.truncate(entries[-1][2] + 3)
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert log.next_seq == 8
+    assert os.path.getsize(log_path) == entries[-1][2]
+    assert os.path.getsize(idx_path) == 2 * 24
+    log.append('"next"')
+    log.close()
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert contents(log, after=6) == [(7, '"upload-7"'), (8, '"next"')]
+    log.close()
+
+
+def test_reopen_with_an_empty_log_and_a_full_index(tmp_path):
+    fill(tmp_path, 10)
+    log_path, idx_path = paths(tmp_path)
+    open(log_path, "wb").close()
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert (log.next_seq, os.path.getsize(idx_path)) == (0, 0)
+    log.append('"first"')
+    log.close()
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert contents(log) == [(0, '"first"')]
+    log.close()
+
+
+def test_reopen_ignores_a_torn_index_entry(tmp_path):
+    fill(tmp_path, 10)
+    _log_path, idx_path = paths(tmp_path)
+    with open(idx_path, "ab") as handle:
+        handle.write(b"\x01\x02\x03")
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert log.next_seq == 10
+    log.append('"next"')
+    log.close()
+    log = SegmentLog(str(tmp_path), index_every=4)
+    assert contents(log, after=8) == [(9, '"upload-9"'), (10, '"next"')]
+    log.close()
+
+
+def test_since_seeks_by_timestamp_after_reopen(tmp_path):
+    clock = Clock()
+    log = SegmentLog(str(tmp_path), index_every=4, clock=clock)
+    for i in range(12):
+        clock.now = 1_000.0 + i
+        log.append(f'"upload-{i}"')
+    log.close()
+    log = SegmentLog(str(tmp_path), index_every=4, clock=clock)
+    assert [seq for seq, _text in contents(log, since=1_009_000)] == [9, 10, 11]
+    assert contents(log, since=1_005_000, limit=2) == [(5, '"upload-5"'), (6, '"upload-6"')]
+    log.close()
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+from metrics_sqlite import SqliteStore
+
+
+def record(i, counters=None):
+    return {"timestamp": 1_000 + i, "appId": "app", "sdk": "tvos", "counters": counters or {"n": 1},
+            "latency": None}
+
+
+class Gate(dict):
+    """Counters whose write holds the writer thread until ``release``."""
+
+    def __init__(self):
+        super().__init__(n=1)
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def items(self):
+        self.entered.set()
+        assert self.released.wait(10)
+        return super().items()
+
+    def release(self):
+        self.released.set()
+
+
+@pytest.fixture
+def store(tmp_path):
+    stores = []
+
+    def open_store(**options):
+        stores.append(SqliteStore(str(tmp_path / "metrics.db"), **options))
+        return stores[-1]
+
+    yield open_store
+    for opened in stores:
+        opened.close()
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_groups_are_written_and_summarized(store):
+    sqlite = store()
+    sqlite.ingest_many([record(i) for i in range(5)] + [None])
+    assert sqlite.flush(10)
+    assert sqlite.summary()["rows"] == 5
+    assert sqlite.summary(since=1_003)["counters"] == {"n": 2}
+    assert (sqlite.stats()["written"], sqlite.stats()["errors"]) == (5, 0)
+
+
+def test_a_failing_group_is_counted_and_the_writer_keeps_going(store):
+    sqlite = store(batch=1, linger=0)
+    broken = record(0)
+    del broken["sdk"]
+    sqlite.ingest_many([broken])
+    assert sqlite.flush(10)
+    sqlite.ingest_many([record(1)])
+    assert sqlite.flush(10)
+    stats = sqlite.stats()
+    assert (stats["errors"], stats["written"], stats["pending"]) == (1, 1, 0)
+    assert sqlite.summary()["rows"] == 1
+
+
+def test_prune_runs_while_uploads_keep_arriving(store):
+    sqlite = store(batch=1, linger=0, prune_every=2)
+    sqlite.ingest_many([record(i) for i in range(3)])
+    assert sqlite.flush(10)
+    # Keep the queue from ever draining: each group is held until the next one is queued.
+    gates = [Gate() for _ in range(3)]
+    sqlite.ingest_many([record(3, gates[0])])
+    assert gates[0].entered.wait(10)
+    sqlite.prune(3)
+    for held, queued in zip(gates, gates[1:]):
+        sqlite.ingest_many([record(4, queued)])
+        held.release()
+        assert queued.entered.wait(10)
+    wait_until(lambda: sqlite.stats()["pruned"] == 2)
+    assert sqlite.stats()["pending"] > 0
+    gates[-1].release()
+    assert sqlite.flush(10)
+    assert sqlite.summary()["rows"] == 4
@@ -0,0 +1,66 @@
+import json
+import math
+
+from metrics_store import INT64_MAX, INT64_MIN, ColumnarStore, normalize_upload, parse_upload
+
+
+def upload(**fields):
+    payload = {"timestamp": 1_000, "sdk": "tvos", "appId": "app", "counters": {"requests_total": 3}}
+    payload.update(fields)
+    return payload
+
+
+def test_normalize_keeps_a_well_formed_upload():
+    record = normalize_upload(upload(request_latency_ms={"p50": 80, "p95": 140, "p99": 210}))
+    assert record["timestamp"] == 1_000
+    assert (record["appId"], record["sdk"]) == ("app", "tvos")
+    assert record["counters"] == {"requests_total": 3}
+    assert record["latency"] == (80.0, 140.0, 210.0)
+
+
+def test_normalize_rejects_non_finite_and_out_of_range_values():
+    for bad in (math.inf, -math.inf, math.nan, INT64_MAX + 1, INT64_MIN - 1, 1e300):
+        assert normalize_upload(upload(timestamp=bad)) is None
+        assert normalize_upload(upload(counters={"requests_total": bad})) is None
+    assert normalize_upload(upload(timestamp=INT64_MAX, counters={"x": INT64_MIN})) is not None
+
+
+def test_parse_upload_rejects_json_infinity():
+    assert parse_upload('{"appId": "app", "counters": {"x": Infinity}}') is None
+    assert parse_upload('{"appId": "app", "timestamp": NaN}') is None
+    assert parse_upload("not json") is None
+    assert parse_upload("[1, 2]") is None
+
+
+def test_normalize_skips_non_numeric_counters_and_latency():
+    record = normalize_upload(upload(counters={"ok": 2, "flag": True, "name": "x"},
+                                     request_latency_ms={"p50": "fast", "p95": math.inf, "p99": 5}))
+    assert record["counters"] == {"ok": 2}
+    assert math.isnan(record["latency"][0]) and math.isnan(record["latency"][1])
+    assert record["latency"][2] == 5.0
+
+
+def test_columnar_store_counts_rejected_uploads_and_stays_consistent():
+    store = ColumnarStore()
+    texts = [
+        json.dumps(upload(timestamp=1_000, counters={"requests_total": 2})),
+        '{"appId": "app", "counters": {"requests_total": Infinity}}',
+        json.dumps(upload(timestamp=2_000, counters={"requests_total": 5, "requests_error_timeout": 1})),
+        json.dumps(upload(timestamp=INT64_MAX + 1)),
+    ]
+    store.ingest_many([parse_upload(text) for text in texts])
+    stats = store.stats()
+    assert len(store) == 2
+    assert stats["parse_errors"] == 2
+    summary = store.summary()
+    assert summary["rows"] == 2
+    assert summary["counters"] == {"requests_total": 7, "requests_error_timeout": 1}
+    assert store.summary(since=1_500)["counters"] == {"requests_total": 5, "requests_error_timeout": 1}
+
+
+def test_columnar_store_eviction_keeps_columns_aligned():
+    store = ColumnarStore(max_rows=8)
+    store.ingest_many([normalize_upload(upload(timestamp=ts, counters={"n": ts})) for ts in range(20)])
+    assert len(store) <= 8
+    assert len(store.ts) == len(store.app) == len(store.sdk) == len(store.cell_start)
+    assert store.summary()["counters"]["n"] == sum(store.ts)
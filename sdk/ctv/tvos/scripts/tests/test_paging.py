@@ -0,0 +1,93 @@
+import json
+from urllib.parse import urlparse
+
+import pytest
+
+from metrics_log import SegmentLog
+from metrics_store import RingStore
+
+
+def upload(i):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": "app", "counters": {"n": i}})
+
+
+def get(stub, target):
+    status, body, _content_type, *rest = stub.dispatch("GET", target, {})
+    if not isinstance(body, bytes):
+        body = b"".join(body)
+    headers = dict(rest[0]) if rest else {}
+    return status, json.loads(body), headers
+
+
+def test_ring_iter_encoded_filters_on_arrival_time():
+    clock = [10.0]
+    ring = RingStore(clock=lambda: clock[0])
+    for i in range(4):
+        clock[0] = 10.0 + i
+        ring.append(f"upload-{i}")
+    start, stop = ring.page_bounds()
+    assert json.loads(b"".join(ring.iter_encoded(start, stop))) == [f"upload-{i}" for i in range(4)]
+    assert json.loads(b"".join(ring.iter_encoded(start, stop, since=12_000))) == ["upload-2", "upload-3"]
+    assert json.loads(b"".join(ring.iter_encoded(start, stop, since=99_000))) == []
+
+
+@pytest.mark.parametrize("cursor", ["since", "after"])
+def test_metrics_pages_through_the_ring(stub, cursor):
+    for i in range(7):
+        stub.record_upload(upload(i))
+    pages, position = [], ""
+    while True:
+        status, entries, headers = get(stub, f"/admin/metrics?limit=3&{cursor}={position}")
+        assert status == 200
+        if not entries:
+            break
+        pages.append(entries)
+        position = headers["X-Next-Cursor"]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [entry for page in pages for entry in page] == [upload(i) for i in range(7)]
+    assert position == "6"
+
+
+def test_metrics_without_a_limit_streams_everything(stub):
+    for i in range(3):
+        stub.record_upload(upload(i))
+    assert get(stub, "/admin/metrics") == (200, [upload(i) for i in range(3)], {"X-Next-Cursor": "2"})
+    assert get(stub, "/admin/metrics?since=now") == (200, [], {"X-Next-Cursor": "2"})
+    assert get(stub, "/admin/metrics?since=1") == (200, [upload(2)], {"X-Next-Cursor": "2"})
+
+
+def test_metrics_log_reads_the_ring_without_a_log_dir(stub):
+    stub.record_upload(upload(0))
+    assert get(stub, "/admin/metrics_log?limit=5")[1] == [upload(0)]
+
+
+def test_metrics_log_pages_by_arrival_time(stub, tmp_path):
+    clock = [100.0]
+    stub.STATE["log"] = SegmentLog(str(tmp_path), index_every=2, clock=lambda: clock[0])
+    try:
+        for i in range(6):
+            clock[0] = 100.0 + i
+            stub.record_upload(upload(i))
+        status, entries, headers = get(stub, "/admin/metrics_log?since_ts=102000&limit=2")
+        assert (status, entries, headers["X-Next-Cursor"]) == (200, [upload(2), upload(3)], "3")
+        status, entries, headers = get(stub, f"/admin/metrics_log?since_ts=102000&since={headers['X-Next-Cursor']}")
+        assert entries == [upload(4), upload(5)]
+    finally:
+        stub.STATE["log"].close()
+
+
+def test_bad_pagination_parameters_get_400(stub):
+    assert stub.paged_response(urlparse("/admin/metrics?limit=-1"), stub.STATE["metrics"])[0] == 400
+    assert stub.paged_response(urlparse("/admin/metrics?since=x"), stub.STATE["metrics"])[0] == 400
+
+
+def test_metrics_pages_over_http(fetch):
+    for i in range(5):
+        status, _headers, _body = fetch("POST", "/api/v1/sdk/metrics", upload(i).encode("utf-8"))
+        assert status == 200
+    status, headers, body = fetch("GET", "/admin/metrics?limit=2&after=")
+    assert status == 200
+    assert headers["transfer-encoding"] == "chunked"
+    assert (json.loads(body), headers["x-next-cursor"]) == ([upload(0), upload(1)], "1")
+    status, headers, body = fetch("GET", "/admin/metrics?limit=10&after=1")
+    assert (json.loads(body), headers["x-next-cursor"]) == ([upload(i) for i in range(2, 5)], "4")
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from metrics_store import ColumnarStore, parse_upload
+
+UPLOADS = [
+    ("a", "tvos", 1_000, {"video.plays": 1, "video.errors": 0, "ads.shown": 2}),
+    ("a", "tvos", 2_000, {"video.plays": 2, "ads.shown": 1}),
+    ("a", "android", 3_000, {"video.plays": 4}),
+    ("b", "tvos", 4_000, {"video.plays": 8}),
+    ("a", "tvos", 5_000, {"video.plays": 16}),
+]
+
+
+def upload(app, sdk, ts, counters):
+    return json.dumps({"appId": app, "sdk": sdk, "timestamp": ts, "counters": counters})
+
+
+@pytest.fixture
+def store():
+    columns = ColumnarStore()
+    columns.ingest_many([parse_upload(upload(*fields)) for fields in UPLOADS])
+    return columns
+
+
+def test_filters_narrow_rows_and_counters(store):
+    result = store.query(app_id="a", sdk="tvos", since=1_500, prefix="video.")
+    assert (result["rows"], result["first_ts"], result["last_ts"]) == (2, 2_000, 5_000)
+    assert result["sums"] == {"video.plays": 18}
+    assert store.query(prefix="ads.")["sums"] == {"ads.shown": 3}
+    assert store.query(until=3_000)["counts"] == {"video.plays": 2, "video.errors": 1, "ads.shown": 2}
+
+
+def test_app_queries_scan_only_that_apps_rows(store):
+    assert store.query(app_id="b")["scanned"] == 1
+    assert store.query(app_id="a", since=2_000, until=4_000)["scanned"] == 2
+    assert store.query(app_id="nobody")["rows"] == 0
+    assert store.query(sdk="roku")["rows"] == 0
+
+
+def query(stub, target):
+    status, body, _content_type = stub.dispatch("GET", target, {})[:3]
+    return status, json.loads(body)
+
+
+def test_query_route_reports_sum_count_and_rate(stub):
+    for fields in UPLOADS:
+        stub.record_upload(upload(*fields))
+    status, report = query(stub, "/admin/metrics/query?appId=a&prefix=video.plays&agg=sum,count,rate"
+                                 "&since=1000&until=5000")
+    assert status == 200
+    assert report["sum"] == {"video.plays": 7}
+    assert report["count"] == {"uploads": 3, "counters": {"video.plays": 3}}
+    assert report["rate"] == {"seconds": 4.0, "per_second": {"video.plays": 1.75}}
+    assert report["tiers"] == [{"tier": "raw", "since": 1_000, "until": 5_000}]
+    # Without a full range the rate spans the first and last matching uploads.
+    assert query(stub, "/admin/metrics/query?appId=b&agg=rate")[1]["rate"] == {"seconds": 0.0, "per_second": {}}
+
+
+@pytest.mark.parametrize("target, status", [
+    ("/admin/metrics/query?agg=median", 400),
+    ("/admin/metrics/query?since=yesterday", 400),
+    ("/admin/metrics/query?tier=weekly", 400),
+    ("/admin/metrics/query?tier=1h", 404),
+])
+def test_bad_queries(stub, target, status):
+    assert stub.dispatch("GET", target, {})[0] == status
@@ -0,0 +1,86 @@
+import json
+
+from metrics_retention import MAX_CLOCK_SKEW, RAW_RETENTION, RetentionManager
+from metrics_store import ColumnarStore, parse_upload
+
+NOW = 100 * 86_400  # seconds; a whole day, so every tier's buckets line up with it
+MINUTE, HOUR, DAY = 60_000, 3_600_000, 86_400_000
+
+
+class Clock:
+    def __init__(self, now=NOW):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def record(ts, plays=1, app="app"):
+    return parse_upload(json.dumps({"appId": app, "sdk": "tvos", "timestamp": ts, "counters": {"plays": plays}}))
+
+
+def retention(clock=None):
+    columns = ColumnarStore()
+    return columns, RetentionManager(columns, clock=clock or Clock())
+
+
+def test_uploads_roll_into_minute_buckets():
+    _columns, manager = retention()
+    now = NOW * 1000
+    manager.add_many([record(now - 90_000, 1), record(now - 70_000, 2), record(now - 10_000, 4)])
+    assert manager.query("1m", None, None, None, None, "")["sums"] == {"plays": 7}
+    minute = manager.query("1m", None, None, now - 2 * MINUTE, now - MINUTE, "")
+    assert (minute["rows"], minute["sums"], minute["first_ts"]) == (2, {"plays": 3}, now - 2 * MINUTE)
+
+
+def test_uploads_from_the_future_or_past_every_tier_are_dropped():
+    _columns, manager = retention()
+    now = NOW * 1000
+    manager.add_many([record(now + MAX_CLOCK_SKEW * 1000 - 1), record(now + MAX_CLOCK_SKEW * 1000 + 1_000),
+                      record(now - 31 * DAY)])
+    stats = manager.stats()
+    assert (stats["future_dropped"], stats["late_dropped"]) == (1, 1)
+    assert stats["tiers"]["1m"]["groups"] == 1
+
+
+def test_compaction_folds_old_minutes_into_hours():
+    clock = Clock()
+    _columns, manager = retention(clock)
+    now = NOW * 1000
+    manager.add_many([record(now + i * MINUTE, i + 1) for i in range(3)])
+    clock.now += 86_400 + 2 * 3600
+    manager.compact()
+    stats = manager.stats()
+    assert (stats["tiers"]["1m"]["buckets"], stats["tiers"]["1h"]["buckets"]) == (0, 1)
+    hour = manager.query("1h", "app", "tvos", now, now + HOUR, "")
+    assert (hour["rows"], hour["sums"]) == (3, {"plays": 6})
+
+
+def test_raw_rows_expire_by_arrival_age():
+    clock = Clock()
+    columns, manager = retention(clock)
+    columns.ingest_many([record(NOW * 1000) for _ in range(3)])
+    manager.compact()  # marks the three rows as arrived by now
+    columns.ingest_many([record(NOW * 1000)])
+    clock.now += RAW_RETENTION + 1
+    manager.compact()
+    assert manager.stats()["raw_expired"] == 3
+    assert columns.query()["rows"] == 1
+
+
+def test_plan_uses_the_coarsest_tier_that_lines_up():
+    _columns, manager = retention()
+    now = NOW * 1000
+    assert manager.plan(now - 2 * MINUTE, now) == [("1m", now - 2 * MINUTE, now)]
+    # Recent edges that split a minute are answered from raw rows.
+    assert manager.plan(now - 90_000, now - 1_000) == [("raw", now - 90_000, now - 1_000)]
+    # Older than a day is served from hours, the rest from minutes.
+    assert manager.plan(now - 3 * DAY, now) == [("1h", now - 3 * DAY, now - DAY), ("1m", now - DAY, now)]
+
+
+def test_auto_tier_queries_through_the_route(stub):
+    stub.STATE["retention"] = RetentionManager(stub.STATE["columns"])
+    stub.record_upload(json.dumps({"appId": "app", "sdk": "tvos", "counters": {"plays": 5}}))
+    status, body, _content_type = stub.dispatch("GET", "/admin/metrics/query?tier=1m", {})[:3]
+    assert (status, json.loads(body)["sum"]) == (200, {"plays": 5})
+    assert json.loads(stub.dispatch("GET", "/admin/metrics/query", {})[1])["sum"] == {"plays": 5}
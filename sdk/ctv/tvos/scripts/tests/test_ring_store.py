@@ -0,0 +1,61 @@
+import json
+
+from metrics_store import RingStore
+
+
+def entries(ring, after=None, limit=None):
+    return json.loads(b"".join(ring.iter_encoded(*ring.page_bounds(after, limit))))
+
+
+def test_entry_cap_evicts_the_oldest():
+    ring = RingStore(max_entries=3)
+    for i in range(5):
+        ring.append(f"u{i}")
+    assert entries(ring) == ["u2", "u3", "u4"]
+    stats = ring.stats()
+    assert (stats["entries"], stats["appended"], stats["dropped_entries"]) == (3, 5, 2)
+    assert stats["dropped_bytes"] == 2 * len(json.dumps("u0"))
+
+
+def test_byte_cap_evicts_until_the_ring_fits():
+    size = len(json.dumps("u0"))
+    ring = RingStore(max_bytes=3 * size)
+    for i in range(4):
+        ring.append(f"u{i}")
+    assert entries(ring) == ["u1", "u2", "u3"]
+    assert ring.stats()["bytes"] == 3 * size
+    # An upload larger than the whole ring is dropped without evicting anything.
+    ring.append("x" * (3 * size))
+    assert entries(ring) == ["u1", "u2", "u3"]
+    assert (ring.stats()["dropped_entries"], ring.next_seq) == (2, 4)
+
+
+def test_cursors_survive_compaction():
+    ring = RingStore(max_entries=10)
+    for i in range(5_000):
+        ring.append(f"u{i}")
+    assert len(ring) == 10
+    assert ring.page_bounds() == (4_990, 5_000)
+    assert entries(ring, after=4_994, limit=2) == ["u4995", "u4996"]
+    # A cursor that fell behind the ring resumes at the oldest kept entry.
+    assert entries(ring, after=10, limit=1) == ["u4990"]
+
+
+def test_entries_evicted_mid_response_are_skipped():
+    ring = RingStore(max_entries=4)
+    for i in range(4):
+        ring.append(f"u{i}")
+    body = ring.iter_encoded(*ring.page_bounds(), batch=1)
+    head = [next(body), next(body)]
+    for i in range(4, 7):
+        ring.append(f"u{i}")
+    assert json.loads(b"".join(head + list(body))) == ["u0", "u3"]
+
+
+def test_ring_stats_route(stub):
+    stub.STATE["metrics"] = RingStore(max_entries=2)
+    for i in range(3):
+        stub.record_upload(json.dumps({"timestamp": i, "sdk": "tvos", "appId": "app", "counters": {}}))
+    status, body, _content_type = stub.dispatch("GET", "/admin/metrics_stats", {})[:3]
+    stats = json.loads(body)
+    assert (status, stats["entries"], stats["max_entries"], stats["dropped_entries"]) == (200, 2, 2, 1)
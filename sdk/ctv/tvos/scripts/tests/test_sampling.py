@@ -0,0 +1,64 @@
+import json
+import random
+
+from metrics_store import OVERFLOW_KEY, ReservoirSampler, parse_upload
+
+
+def upload(i, app="app", errors=0):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": app,
+                       "counters": {"plays": 1, "requests_error_total": errors}})
+
+
+def offer(sampler, texts):
+    return sampler.extend(texts, [parse_upload(text) for text in texts])
+
+
+def test_reservoirs_keep_at_most_size_uploads_per_app():
+    sampler = ReservoirSampler(5, rng=random.Random(1))
+    admitted = offer(sampler, [upload(i, app) for i in range(200) for app in ("a", "b")])
+    for app in ("a", "b"):
+        fragments, seen, kept = sampler.sample(app)
+        assert (seen, kept, len(fragments)) == (200, 5, 5)
+        assert {json.loads(json.loads(fragment))["appId"] for fragment in fragments} == {app}
+    # The first `size` uploads fill the reservoir; later ones are admitted ever more rarely.
+    assert 10 < len(admitted) < 60
+
+
+def test_every_upload_is_equally_likely_to_be_kept():
+    kept = [0] * 20
+    for seed in range(2_000):
+        sampler = ReservoirSampler(4, rng=random.Random(seed))
+        offer(sampler, [upload(i) for i in range(20)])
+        for fragment in sampler.sample()[0]:
+            kept[json.loads(json.loads(fragment))["timestamp"] - 1_000] += 1
+    # 2000 draws of 4 in 20: each upload is expected 400 times.
+    assert all(320 < count < 480 for count in kept), kept
+
+
+def test_stratified_reservoirs_keep_rare_failures():
+    sampler = ReservoirSampler(3, stratify=True, rng=random.Random(2))
+    offer(sampler, [upload(i, errors=1 if i % 50 == 0 else 0) for i in range(500)])
+    failures, seen, kept = sampler.sample("app", errors=True)
+    assert (seen, kept) == (10, 3)
+    assert all(json.loads(json.loads(fragment))["counters"]["requests_error_total"] for fragment in failures)
+    assert sampler.sample("app", errors=False)[1:] == (490, 3)
+
+
+def test_apps_past_max_apps_share_the_overflow_reservoir():
+    sampler = ReservoirSampler(2, max_apps=2, rng=random.Random(3))
+    offer(sampler, [upload(0, "a"), upload(0, "b"), upload(0, "c"), upload(0, "d")])
+    assert sampler.sample(OVERFLOW_KEY)[1:] == (2, 2)
+    assert sampler.stats()["apps"] == 3
+
+
+def test_sampling_keeps_aggregates_exact(stub):
+    stub.STATE["sampler"] = ReservoirSampler(2, rng=random.Random(4))
+    for i in range(50):
+        stub.record_upload(upload(i))
+    assert len(stub.STATE["metrics"]) < 50
+    assert stub.STATE["totals"].snapshot()[1][("app", "tvos", "plays")] == 50
+    status, body, _content_type, headers = stub.dispatch("GET", "/admin/metrics_log?appId=app&limit=1", {})
+    headers = dict(headers)
+    assert (status, len(json.loads(body))) == (200, 1)
+    assert (headers["X-Sample-Seen"], headers["X-Sample-Kept"], headers["X-Sample-Rate"]) == ("50", "2", "0.04")
+    assert json.loads(stub.dispatch("GET", "/admin/sampling", {})[1])["size"] == 2
@@ -0,0 +1,204 @@
+import itertools
+import json
+import random
+
+import pytest
+
+from stub_auction import AuctionEngine, assemble_pod
+
+
+def bid(engine, **request):
+    return engine.bid(json.dumps({"body": request}).encode("utf-8"))
+
+
+def test_fill_rate_and_floor_decide_wins():
+    engine = AuctionEngine({"placements": {"always": {"fillRate": 1.0, "cpm": 2.5},
+                                           "never": {"fillRate": 0.0, "cpm": 2.5}}}, seed=1)
+    status, payload, delay = bid(engine, placementId="always", requestId="r1")
+    win = json.loads(payload)
+    assert (status, delay, win["requestId"], win["cpm"]) == (200, 0.0, "r1", 2.5)
+    assert bid(engine, placementId="always", floorCpm=3.0)[:2] == (204, None)
+    assert bid(engine, placementId="never")[:2] == (204, None)
+    stats = engine.stats()["placements"]
+    assert {key: stats["always"][key] for key in ("bids", "wins", "below_floor", "revenue")} == {
+        "bids": 2, "wins": 1, "below_floor": 1, "revenue": 0.0025}
+    assert (stats["never"]["bids"], stats["never"]["no_fill"]) == (1, 1)
+
+
+def test_malformed_bids_get_400():
+    engine = AuctionEngine(seed=1)
+    for body in (b"[1]", b"{", b'{"body": {"floorCpm": "high"}}'):
+        assert engine.bid(body)[0] == 400
+    assert engine.stats()["bad_requests"] == 3
+
+
+def test_unknown_placements_put_their_id_in_urls():
+    engine = AuctionEngine({"fillRate": 1.0, "trackingBase": "https://t.example",
+                            "tracking": {"impression": "https://t.example/{placementId}/imp?bid={bidId}"},
+                            "placements": {"home": {}}}, seed=1)
+    for requested, quoted in (("home", "home"), ("row/2 hero", "row%2F2%20hero"), ("", "%2A")):
+        status, payload, _delay = engine.bid(json.dumps({"placementId": requested, "requestId": "r"}).encode())
+        assert status == 200
+        win = json.loads(payload)
+        assert win["creativeUrl"].endswith(f"/{quoted}.mp4")
+        assert win["tracking"]["impression"] == f"https://t.example/{quoted}/imp?bid={win['bidId']}"
+    assert set(engine.stats()["placements"]) == {"*", "home"}
+
+
+def test_bid_route_and_tracking_beacons(stub):
+    request = json.dumps({"body": {"placementId": "home"}}).encode("utf-8")
+    assert stub.dispatch("POST", "/api/v1/rtb/bid", {}, request)[0] == 204
+    stub.STATE["auction"] = AuctionEngine({"fillRate": 1.0}, "http://stub/api/v1/track", seed=1)
+    status, payload, _content_type = stub.dispatch("POST", "/api/v1/rtb/bid", {}, request)[:3]
+    assert status == 200
+    impression = json.loads(payload)["tracking"]["impression"]
+    assert impression.startswith("http://stub/api/v1/track/impression")
+    assert stub.dispatch("GET", impression[len("http://stub"):], {})[0] == 204
+    assert stub.dispatch("GET", "/api/v1/track/nonsense", {})[0] == 404
+    assert stub.STATE["auction"].stats()["tracked"]["impression"] == 1
+
+
+SOURCES = {
+    "auctionTimeoutMs": 80,
+    "sources": [
+        {"id": "fast", "latencyMs": 10, "cpm": 3.0},
+        {"id": "slow", "latencyMs": 200, "timeoutMs": 50, "cpm": 9.0},
+        {"id": "cheap", "latencyMs": 20, "cpm": 1.0},
+        {"id": "late", "latencyMs": 120, "cpm": 8.0},
+    ],
+}
+
+
+def test_highest_timely_source_wins_at_its_own_price():
+    engine = AuctionEngine(SOURCES, seed=1)
+    status, payload, delay = bid(engine, placementId="home")
+    assert (status, json.loads(payload)["cpm"]) == (200, 3.0)
+    # The auction closes when the slowest source answers or times out.
+    assert delay == pytest.approx(0.08)
+    sources = engine.stats()["sources"]
+    assert {source: stats["timeouts"] for source, stats in sources.items()} == {
+        "fast": 0, "slow": 1, "cheap": 0, "late": 1}
+    assert (sources["fast"]["wins"], sources["fast"]["revenue"], sources["cheap"]["bids"]) == (1, 0.003, 1)
+
+
+def test_sources_below_the_floor_lose_the_auction():
+    engine = AuctionEngine(SOURCES, seed=1)
+    assert bid(engine, placementId="home", floorCpm=5.0)[:2] == (204, None)
+    stats = engine.stats()
+    assert stats["placements"]["*"]["below_floor"] == 1
+    assert stats["sources"]["fast"]["below_floor"] == 1
+
+
+def test_sources_can_be_batched():
+    engine = AuctionEngine(SOURCES, seed=1, batch=16)
+    answers = [bid(engine, placementId="home") for _ in range(20)]
+    assert {(status, json.loads(payload)["cpm"], delay) for status, payload, delay in answers} == {(200, 3.0, 0.08)}
+    assert engine.stats()["batches"]["*"]["batches"] == 2
+
+
+def test_batched_outcomes_are_seeded_per_placement():
+    config = {"placements": {"home": {"fillRate": 0.5, "cpm": {"dist": "uniform", "min": 1, "max": 4}},
+                             "row": {"fillRate": 0.5, "cpm": 2.0}}}
+
+    def outcomes(seed):
+        engine = AuctionEngine(config, seed=seed, batch=8)
+        return [(status, payload and json.loads(payload)["cpm"]) for status, payload, _delay in
+                (bid(engine, placementId=placement) for placement in ("home", "row") * 10)]
+
+    assert outcomes(3) == outcomes(3)
+    assert outcomes(3) != outcomes(4)
+    assert {status for status, _cpm in outcomes(3)} == {200, 204}
+
+
+def test_batched_floors_are_applied_when_served():
+    engine = AuctionEngine({"placements": {"home": {"fillRate": 1.0, "cpm": 2.5}}}, seed=1, batch=4)
+    assert [bid(engine, placementId="home", floorCpm=floor)[0] for floor in (1.0, 3.0, 2.5, 9.0, 0.0)] == [
+        200, 204, 200, 204, 200]
+    stats = engine.stats()
+    assert (stats["placements"]["home"]["wins"], stats["placements"]["home"]["below_floor"]) == (3, 2)
+    # Five bids from batches of four: the second batch has been drawn.
+    assert stats["batches"]["home"] == {"batches": 2, "rows": 8}
+
+
+def brute_force(candidates, break_seconds, slots):
+    """Best total CPM over every subset that fits, for checking the knapsack."""
+    best = 0.0
+    for size in range(1, min(slots, len(candidates)) + 1):
+        for subset in itertools.combinations(range(len(candidates)), size):
+            if sum(candidates[i][1] for i in subset) <= break_seconds:
+                best = max(best, sum(candidates[i][0] for i in subset))
+    return best
+
+
+def check(candidates, break_seconds, slots):
+    chosen = assemble_pod(candidates, break_seconds, slots)
+    assert len(set(chosen)) == len(chosen) <= slots
+    assert sum(candidates[i][1] for i in chosen) <= break_seconds
+    assert all(candidates[i][0] > 0 for i in chosen)
+    assert sum(candidates[i][0] for i in chosen) == pytest.approx(brute_force(candidates, break_seconds, slots))
+
+
+@pytest.mark.parametrize("durations, break_seconds, slots", [
+    ((15, 30), 60, 3),  # the default lengths
+    ((6, 15, 30), 90, 5),  # a gcd of 3 with the break
+    ((10, 20, 45, 60), 120, 4),
+    ((7, 13), 30, 5),  # coprime lengths: the table is in seconds
+    ((15, 30), 15, 1),  # one short slot
+])
+def test_assemble_pod_matches_brute_force(durations, break_seconds, slots):
+    rng = random.Random(f"{durations}/{break_seconds}/{slots}")
+    candidates = [(round(rng.lognormvariate(1.0, 0.7), 2), rng.choice(durations)) for _ in range(10)]
+    check(candidates, break_seconds, slots)
+
+
+def test_assemble_pod_skips_unusable_candidates():
+    assert assemble_pod([], 60, 3) == []
+    assert assemble_pod([(5.0, 90), (0.0, 15), (-1.0, 15)], 60, 3) == []
+    assert assemble_pod([(5.0, 90), (1.0, 30)], 60, 3) == [1]
+
+
+def test_assemble_pod_prefers_value_over_count():
+    # Two 30s spots at 4 beat four 15s spots at 1.5, and one 60s spot at 7.9.
+    candidates = [(4.0, 30), (4.0, 30)] + [(1.5, 15)] * 4 + [(7.9, 60)]
+    assert sorted(assemble_pod(candidates, 60, 4)) == [0, 1]
+    check(candidates, 60, 4)
+    # With one slot the 60s spot wins.
+    assert assemble_pod(candidates, 60, 1) == [6]
+
+
+def test_assemble_pod_fills_the_break_exactly():
+    candidates = [(2.0, 15)] * 6
+    assert len(assemble_pod(candidates, 60, 10)) == 4
+    check(candidates, 60, 10)
+
+
+@pytest.mark.parametrize("value", [0, -2, "many"])
+def test_pod_candidates_must_be_positive(value):
+    with pytest.raises(ValueError, match="podCandidates"):
+        AuctionEngine({"placements": {"home": {"podCandidates": value}}})
+
+
+def test_pod_returns_ads_in_play_order_within_the_break():
+    engine = AuctionEngine({"fillRate": 1.0, "cpm": {"dist": "uniform", "min": 1, "max": 9}, "ttlSeconds": 100,
+                            "durations": [15, 30]}, seed=3)
+    request = {"placementId": "home", "requestId": "p1", "breakDurationSeconds": 60, "slots": 3}
+    status, payload, _delay = engine.pod(json.dumps({"body": request}).encode("utf-8"))
+    pod = json.loads(payload)
+    assert (status, pod["requestId"], pod["breakDurationSeconds"]) == (200, "p1", 60)
+    ads = pod["ads"]
+    assert 0 < len(ads) <= 3
+    assert sum(ad["durationSeconds"] for ad in ads) == pod["durationSeconds"] <= 60
+    assert [ad["cpm"] for ad in ads] == sorted((ad["cpm"] for ad in ads), reverse=True)
+    # Each ad lives for its TTL plus the time it waits in the break.
+    waits = itertools.accumulate([0] + [ad["durationSeconds"] for ad in ads[:-1]])
+    assert [ad["ttlSeconds"] for ad in ads] == [100 + wait for wait in waits]
+    assert engine.stats()["pods"]["*"]["pods"] == 1
+
+
+@pytest.mark.parametrize("request_body", [
+    {"breakDurationSeconds": 60},
+    {"breakDurationSeconds": 0, "slots": 2},
+    {"breakDurationSeconds": 60, "slots": 99},
+])
+def test_malformed_pods_get_400(request_body):
+    assert AuctionEngine(seed=1).pod(json.dumps({"body": request_body}).encode("utf-8"))[0] == 400
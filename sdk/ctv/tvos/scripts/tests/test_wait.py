@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+
+from metrics_store import ReservoirSampler
+
+
+def upload(i, app="app"):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": app, "counters": {"n": i}}).encode("utf-8")
+
+
+def later(delay, action):
+    """Run ``action`` on a thread after ``delay`` seconds, while the caller blocks in a request."""
+    thread = threading.Timer(delay, action)
+    thread.start()
+    return thread
+
+
+def sse_data(body):
+    return [line[len("data: "):] for line in body.decode("utf-8").split("\n") if line.startswith("data: ")]
+
+
+def test_wait_wakes_when_an_upload_is_stored(fetch):
+    poster = later(0.2, lambda: fetch("POST", "/api/v1/sdk/metrics", upload(0)))
+    started = time.monotonic()
+    status, headers, body = fetch("GET", "/admin/metrics/wait?after=-1&timeout=10")
+    poster.join()
+    assert status == 200
+    assert time.monotonic() - started < 5
+    assert json.loads(body) == [upload(0).decode("utf-8")]
+    assert headers["x-next-cursor"] == "0"
+
+
+def test_wait_returns_stored_entries_at_once(fetch):
+    fetch("POST", "/api/v1/sdk/metrics", upload(0))
+    fetch("POST", "/api/v1/sdk/metrics", upload(1))
+    started = time.monotonic()
+    _status, headers, body = fetch("GET", "/admin/metrics/wait?after=0&timeout=10")
+    assert time.monotonic() - started < 1
+    assert (json.loads(body), headers["x-next-cursor"]) == ([upload(1).decode("utf-8")], "1")
+
+
+def test_wait_times_out_empty(fetch):
+    started = time.monotonic()
+    status, headers, body = fetch("GET", "/admin/metrics/wait?after=-1&timeout=0.3")
+    assert 0.25 <= time.monotonic() - started < 3
+    assert (status, json.loads(body), headers["x-next-cursor"]) == (200, [], "-1")
+
+
+def test_wait_rejects_a_bad_cursor(fetch):
+    assert fetch("GET", "/admin/metrics/wait?after=x")[0] == 400
+
+
+def test_stream_sends_one_event_per_upload(fetch):
+    def post_three():
+        for i in range(3):
+            fetch("POST", "/api/v1/sdk/metrics", upload(i))
+            time.sleep(0.05)
+
+    poster = later(0.2, post_three)
+    status, headers, body = fetch("GET", "/admin/metrics/stream?after=-1&timeout=1.5")
+    poster.join()
+    assert status == 200
+    assert headers["content-type"] == "text/event-stream"
+    assert body.startswith(b"retry: 1000\n\n")
+    assert [json.loads(data) for data in sse_data(body)] == [upload(i).decode("utf-8") for i in range(3)]
+    assert b"id: 2\n" in body
+
+
+class Steady:
+    """An rng for ReservoirSampler: with size 1 it admits the 1st, 3rd, 5th ... upload of an app."""
+
+    def random(self):
+        return 0.5
+
+
+def test_wait_wakes_on_uploads_the_sampler_skips(stub, fetch):
+    stub.STATE["sampler"] = ReservoirSampler(1, rng=Steady())
+    fetch("POST", "/api/v1/sdk/metrics", upload(0))
+    assert len(stub.STATE["metrics"]) == 1
+    poster = later(0.2, lambda: fetch("POST", "/api/v1/sdk/metrics", upload(1)))
+    started = time.monotonic()
+    status, headers, body = fetch("GET", "/admin/metrics/wait?after=0&timeout=10")
+    poster.join()
+    # The second upload is aggregated but not sampled: the waiter still answers, with nothing new.
+    assert len(stub.STATE["metrics"]) == 1
+    assert time.monotonic() - started < 5
+    assert (status, json.loads(body), headers["x-next-cursor"]) == (200, [], "0")
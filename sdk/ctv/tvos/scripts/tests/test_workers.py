@@ -0,0 +1,77 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import metrics_stub
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "metrics_stub.py")
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="--workers needs SO_REUSEPORT")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def call(port, method, path, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def eventually(check, timeout=15):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+@pytest.fixture(params=metrics_stub.ENGINES)
+def workers(request):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SCRIPT, "--port", str(port), "--workers", "2",
+                                "--engine", request.param], stdout=subprocess.DEVNULL)
+    try:
+        eventually(lambda: call(port, "GET", "/api/v1/sdk/config")[0] == 200)
+        yield port
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(15)
+
+
+def upload(i):
+    return json.dumps({"timestamp": 1_000 + i, "sdk": "tvos", "appId": "app", "counters": {"n": i}})
+
+
+def test_workers_share_the_toggle_and_fan_out_admin_reads(workers):
+    port = workers
+    for i in range(8):
+        assert call(port, "POST", "/api/v1/sdk/metrics", upload(i).encode("utf-8"))[0] == 200
+    expected = sorted(upload(i) for i in range(8))
+    # Each new connection may land on either worker; fanned-out reads still see every upload.
+    eventually(lambda: sorted(json.loads(call(port, "GET", "/admin/metrics")[1])) == expected)
+    for _ in range(4):
+        local = json.loads(call(port, "GET", "/admin/metrics?scope=local")[1])
+        assert set(local) <= set(expected)
+    assert call(port, "POST", "/admin/toggle_metrics?enabled=false")[0] == 200
+    for _ in range(8):
+        config = json.loads(call(port, "GET", "/api/v1/sdk/config")[1])
+        assert config["features"]["metricsEnabled"] is False